@@ -17,8 +17,20 @@ please see
 Note: this file is for support purposes only, and is not part of your
 submission.
 """
-from prefix_tree import SimplePrefixTree, CompressedPrefixTree
-from autocomplete_engines import SentenceAutocompleteEngine
+import asyncio
+import json
+import threading
+
+import pytest
+
+from prefix_tree import SimplePrefixTree, CompressedPrefixTree, \
+    CompactPrefixTree, ArrayPrefixTree, FrozenPrefixTree, \
+    ConcurrentAutocompleter
+from autocomplete_engines import SentenceAutocompleteEngine, \
+    MelodyAutocompleteEngine
+from autocomplete_server import AutocompleteServer, load_test
+from melody import Melody, create_midi_file, midi_cache_info, \
+    set_midi_cache_size
 
 
 def test_simple_prefix_tree_structure() -> None:
@@ -68,10 +80,10 @@ def test_simple_prefix_tree_autocomplete() -> None:
     # SimplePrefixTree.autocomplete.
     assert t.autocomplete([]) == [('dog', 4.0), ('car', 3.0), ('cat', 2.0)]
 
-    # But keep in mind that the greedy algorithm here does not necessarily
-    # return the highest-weight values!! In this case, the ['c'] subtree
-    # is recursed on first.
-    assert t.autocomplete([], 1) == [('car', 3.0)]
+    # With a limit, the heaviest values are returned, even though the ['c']
+    # subtree comes first in t.subtrees.
+    assert t.autocomplete([], 1) == [('dog', 4.0)]
+    assert t.autocomplete([], 2) == [('dog', 4.0), ('car', 3.0)]
 
 
 def test_simple_prefix_tree_remove() -> None:
@@ -138,6 +150,252 @@ def test_sentence_autocompleter() -> None:
     assert results[0][1] == 15.0 + 6.5
 
 
+def test_sentence_autocompleter_words() -> None:
+    """Test that a sentence engine storing lists of words gives the same
+    matches as one storing lists of characters, with one tree per word.
+    """
+    config = {
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum',
+        'cache_size': 10
+    }
+    letters = SentenceAutocompleteEngine(config)
+    words = SentenceAutocompleteEngine(dict(config, words=True))
+    assert words.autocompleter.subtrees[0].value == \
+        words._tokens.lookup(['a', 'star', 'is', 'born'])
+    for prefix in ['', 'a', 'a ', 'a st', 'a star is', 'nu', 'what a w',
+                   'x', 'a x']:
+        for limit in [None, 1]:
+            assert words.autocomplete(prefix, limit) == \
+                letters.autocomplete(prefix, limit)
+
+    words.insert('a stone', 30.0)
+    assert words.autocomplete('a st', 1) == [('a stone', 30.0)]
+    words.remove('a sta')
+    assert words.autocomplete('a') == [('a stone', 30.0)]
+    session = words.session()
+    session.push('a')
+    assert session.autocomplete() == [('a stone', 30.0)]
+
+
+def test_sentence_autocompleter_words_spaces() -> None:
+    """Test that in a sentence engine storing lists of words, a prefix ending
+    in a space matches only strings with more words, as with lists of
+    characters, while the number of spaces between words is ignored.
+    """
+    config = {
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum',
+        'cache_size': 10
+    }
+    letters = SentenceAutocompleteEngine(config)
+    words = SentenceAutocompleteEngine(dict(config, words=True))
+    for engine in [letters, words]:
+        engine.insert('a', 100.0)
+    for prefix in ['a', 'a ', 'a star ']:
+        for limit in [None, 1, 2]:
+            assert words.autocomplete(prefix, limit) == \
+                letters.autocomplete(prefix, limit)
+    assert ('a', 100.0) not in words.autocomplete('a ')
+
+    for engine in [letters, words]:
+        engine.remove('a ')
+    assert words.autocomplete('a') == letters.autocomplete('a') == \
+        [('a', 100.0)]
+
+    assert letters.autocomplete('what  a') == []
+    assert words.autocomplete('what  a') == words.autocomplete('what a') != []
+
+
+def test_autocomplete_fuzzy() -> None:
+    """Test that fuzzy autocomplete finds values up to k edits away from the
+    prefix, ordered by weight and then by distance.
+    """
+    words = {'cat': 1.0, 'car': 4.0, 'cart': 2.0, 'dog': 3.0, 'bat': 1.0}
+    for cls in [SimplePrefixTree, CompressedPrefixTree]:
+        t = cls('sum')
+        for word, weight in words.items():
+            t.insert(word, weight, list(word))
+        assert t.autocomplete_fuzzy(list('cat'), 0) == [('cat', 1.0)]
+        # 'car', 'cart' and 'bat' are one substitution away, and 'cat'
+        # comes before 'bat' because it is closer
+        assert t.autocomplete_fuzzy(list('cat'), 1) == \
+            [('car', 4.0), ('cart', 2.0), ('cat', 1.0), ('bat', 1.0)]
+        assert t.autocomplete_fuzzy(list('cat'), 1, 2) == \
+            [('car', 4.0), ('cart', 2.0)]
+        assert t.autocomplete_fuzzy(list('cxt'), 1) == [('cat', 1.0)]
+        assert t.autocomplete_fuzzy(list('dg'), 1) == [('dog', 3.0)]
+        assert t.autocomplete_fuzzy(list('xyz'), 2) == []
+        assert len(t.autocomplete_fuzzy(list('xyz'), 3)) == len(words)
+
+
+def test_melody_approximate_and_infix() -> None:
+    """Test that melodies are found from mistyped intervals, missing notes
+    and runs of intervals from the middle of a melody.
+    """
+    engine = MelodyAutocompleteEngine({
+        'file': 'data/songbook.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum'
+    })
+
+    def names(matches: list) -> list:
+        """Return the names of the melodies in <matches>."""
+        return [melody.name for melody, _ in matches]
+
+    # Ode to Joy starts 0, 1, 2, 0, -2, with the third interval mistyped
+    assert engine.autocomplete([0, 1, 3, 0, -2]) == []
+    assert 'Ode to Joy' in names(engine.autocomplete_approximate(
+        [0, 1, 3, 0, -2], tolerance=1))
+    # Danny Boy starts 64, 65, 67, 69, 67: leave out its third note
+    assert 'Danny Boy' not in names(engine.autocomplete_approximate(
+        [1, 4, -2], tolerance=0))
+    assert 'Danny Boy' in names(engine.autocomplete_approximate(
+        [1, 4, -2], tolerance=0, skips=1))
+    assert engine.autocomplete_approximate([0, 1, 2], tolerance=0) == \
+        engine.autocomplete([0, 1, 2])
+
+    # Fur Elise has -5, 3, -2 in the middle
+    for query in [[-5, 3, -2], [-5, 3, -2, -3], [1]]:
+        found = names(engine.autocomplete_infix(query))
+        assert 'Fur Elise' in found
+        assert found == [name for name in names(engine.autocomplete([]))
+                         if name in found]
+    assert engine.autocomplete_infix([-5, 3, -2, 3]) == []
+    assert len(engine.autocomplete_infix([])) == len(engine.autocompleter)
+    scale = Melody('Scale', [(60, 100), (62, 100), (64, 100), (65, 100),
+                             (67, 100)])
+    engine.insert(scale, 100.0)
+    assert names(engine.autocomplete_infix([2, 1, 2], 1)) == ['Scale']
+    engine.insert(scale, 1.0)
+    assert engine.autocomplete_infix([2, 1, 2], 1) == [(scale, 101.0)]
+    engine.remove([2, 2, 1])
+    assert 'Scale' not in names(engine.autocomplete_infix([2, 1, 2]))
+    engine.remove_many([[-5], [5]])
+    for query in [[], [1], [-5, 3, -2]]:
+        found = engine.autocomplete_infix(query)
+        assert sorted(names(found)) == sorted(
+            melody.name for melody, _ in engine.autocomplete([])
+            if any(melody.intervals()[i:i + len(query)] == query
+                   for i in range(len(melody.intervals()) + 1)))
+        assert [w for _, w in found] == \
+            sorted((w for _, w in found), reverse=True)
+    assert len(engine.autocomplete_infix([])) == len(engine.autocompleter)
+
+
+def test_melody_midi_bytes() -> None:
+    """Test that a melody's MIDI bytes are rendered once, match
+    create_midi_file, and are dropped from the cache to fit its size.
+    """
+    set_midi_cache_size(1 << 22)
+    notes = [(60, 100), (64, 100), (67, 200)]
+    first = Melody('Chord', notes)
+    data = first.to_midi_bytes()
+    assert data == create_midi_file(notes).getvalue()
+    hits = midi_cache_info().hits
+    assert first.to_midi_bytes() is data
+    assert Melody('Same notes', list(notes)).to_midi_bytes() is data
+    assert midi_cache_info().hits == hits + 2
+
+    first.notes = notes + [(72, 400)]
+    assert first.to_midi_bytes() == create_midi_file(first.notes).getvalue()
+
+    set_midi_cache_size(len(data))
+    info = midi_cache_info()
+    assert info.size <= len(data) and info.maxsize == len(data)
+    set_midi_cache_size(0)
+    assert midi_cache_info().size == 0
+    assert Melody('Chord', notes).to_midi_bytes() == data
+    assert midi_cache_info().size == 0
+    set_midi_cache_size(1 << 22)
+
+
+def test_melody_packed_notes() -> None:
+    """Test that a melody's packed notes read and write as a list of
+    (pitch, duration) tuples, that durations too long for 16 bits survive,
+    and that its intervals come from the notes.
+    """
+    notes = [(64, 400), (65, 400), (67, 1200)]
+    melody = Melody('Start', notes)
+    assert melody.notes == notes
+    assert melody.intervals() == [1, 2]
+    melody.notes = [(60, 100), (72, 100000)]
+    assert melody.notes == [(60, 100), (72, 100000)]
+    assert melody.intervals() == [12]
+    assert Melody.from_numbers('Long', [60, 100000, 61, 400]).notes \
+        == [(60, 100000), (61, 400)]
+    assert Melody.from_numbers('Start', [64, 400, 65, 400, 67, 1200]).notes \
+        == notes
+    assert Melody('Empty', []).intervals() == []
+
+    engine = MelodyAutocompleteEngine({
+        'file': 'data/songbook.csv',
+        'autocompleter': 'simple',
+        'weight_type': 'sum'
+    })
+    (danny, _), = engine.autocomplete([1, 2, 2, -2, 2, 5])
+    assert danny.name == 'Danny Boy'
+    assert danny.notes[:3] == [(64, 400), (65, 400), (67, 400)]
+    assert len(danny.notes) == 12
+
+
+def test_engine_token_interning() -> None:
+    """Test that engines store prefixes as token ids, and that prefixes with
+    elements that were never inserted match nothing.
+    """
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum'
+    })
+    for subtree in engine.autocompleter.subtrees:
+        assert all(isinstance(token, int) for token in subtree.value)
+    assert engine.autocomplete('what a') == [('what a wonderful world', 1.0)]
+    assert engine.autocomplete('x') == []
+    engine.remove('x')
+    engine.remove('what')
+    assert engine.autocomplete('what') == []
+    assert len(engine.autocomplete('')) == 2
+
+    melodies = MelodyAutocompleteEngine({
+        'file': 'data/songbook.csv',
+        'autocompleter': 'simple',
+        'weight_type': 'sum'
+    })
+    assert melodies.autocomplete([1000]) == []
+    assert len(melodies.autocomplete([])) == len(melodies.autocompleter)
+
+
+def test_engine_cache() -> None:
+    """Test that cached results are reused, and dropped when an insert or
+    remove changes them.
+    """
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'simple',
+        'weight_type': 'sum',
+        'cache_size': 2
+    })
+    assert engine.autocomplete('a s') == [('a star is born', 21.5)]
+    assert engine.autocomplete('a s') == [('a star is born', 21.5)]
+    assert engine.autocomplete('nu', 1) == [('numbers are 0k4y', 3.0)]
+    assert engine.cache_info() == (1, 2, 2, 2)
+
+    engine.insert('A star is born!', 1.5)
+    assert engine.autocomplete('a s') == [('a star is born', 23.0)]
+    engine.insert('a sea', 30.0)
+    assert engine.autocomplete('a') == [('a sea', 30.0),
+                                        ('a star is born', 23.0)]
+    engine.remove('a st')
+    assert engine.autocomplete('a') == [('a sea', 30.0)]
+    # unrelated results stay cached
+    engine.remove('what')
+    assert engine.autocomplete('a') == [('a sea', 30.0)]
+    assert engine.cache_info().hits == 2
+
+
 def test_compressed_prefix_tree_structure() -> None:
     """This is a test for the correct structure of a compressed prefix tree.
 
@@ -169,6 +427,545 @@ def test_compressed_prefix_tree_structure() -> None:
     assert right.weight == 4.0
 
 
+def test_compressed_prefix_tree_remove() -> None:
+    """Test that removing a value merges a compressible parent back into
+    a single subtree, and that later inserts still split it correctly.
+    """
+    t = CompressedPrefixTree('sum')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    t.insert('car', 3.0, ['c', 'a', 'r'])
+    t.insert('cart', 1.0, ['c', 'a', 'r', 't'])
+
+    assert len(t.subtrees) == 1
+    assert t.subtrees[0].value == ['c', 'a']
+
+    t.remove(['c', 'a', 't'])
+    assert len(t) == 2
+    assert t.weight == 4.0
+    assert len(t.subtrees) == 1
+    assert t.subtrees[0].value == ['c', 'a', 'r']
+
+    t.insert('cab', 5.0, ['c', 'a', 'b'])
+    assert t.subtrees[0].value == ['c', 'a']
+    assert [s.value for s in t.subtrees[0].subtrees] == \
+        [['c', 'a', 'b'], ['c', 'a', 'r']]
+    assert t.autocomplete(['c', 'a', 'r']) == [('car', 3.0), ('cart', 1.0)]
+
+
+def test_remove_many() -> None:
+    """Test that remove_many leaves the same tree as removing each prefix in
+    turn, including overlapping, repeated and missing prefixes.
+    """
+    words = ['cat', 'car', 'cart', 'care', 'dog', 'dot', 'do', 'egg', 'eggs']
+    prefixes = [['c', 'a', 'r'], ['d', 'o', 'g'], ['c', 'a', 'r', 't'],
+                ['x'], ['e', 'g'], ['d', 'o', 'g'], ['d', 'o', 't']]
+    for cls in [SimplePrefixTree, CompressedPrefixTree]:
+        for weight_type in ['sum', 'average']:
+            trees = [cls(weight_type), cls(weight_type)]
+            for t in trees:
+                for i, word in enumerate(words):
+                    t.insert(word, i + 1.0, list(word))
+            trees[0].remove_many(prefixes)
+            for prefix in prefixes:
+                trees[1].remove(prefix)
+            assert str(trees[0]) == str(trees[1])
+            assert trees[0].leaf == trees[1].leaf == 2
+            assert trees[0].max_leaf_weight == trees[1].max_leaf_weight
+
+            trees[0].remove_many([['c'], ['d']])
+            assert trees[0].is_empty()
+            assert trees[0].autocomplete([]) == []
+
+
+def test_max_leaf_weight_pruned_search() -> None:
+    """Test that max_leaf_weight survives removals, and that both search
+    modes find the heaviest values of an 'average' tree.
+    """
+    t = SimplePrefixTree('average')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    t.insert('car', 3.0, ['c', 'a', 'r'])
+    t.insert('cab', 6.0, ['c', 'a', 'b'])
+    t.insert('dog', 4.0, ['d', 'o', 'g'])
+    t.insert('doe', 4.5, ['d', 'o', 'e'])
+
+    # ['c'] has the lower average weight, but the heaviest leaf.
+    assert t.subtrees[1].value == ['c']
+    assert t.subtrees[1].max_leaf_weight == 6.0
+    assert t.max_leaf_weight == 6.0
+    for search in ['best-first', 'depth-first']:
+        assert t.autocomplete([], 2, search) == [('cab', 6.0), ('doe', 4.5)]
+
+    t.remove(['c', 'a', 'b'])
+    assert t.max_leaf_weight == 4.5
+    assert t.subtrees[1].max_leaf_weight == 3.0
+    assert t.autocomplete([], 3, 'depth-first') == \
+        [('doe', 4.5), ('dog', 4.0), ('car', 3.0)]
+
+
+def test_materialize_top() -> None:
+    """Test that stored top lists answer short prefixes, and are kept up to
+    date by insert and remove.
+    """
+    for t in [SimplePrefixTree('sum'), CompressedPrefixTree('sum')]:
+        t.insert('cat', 2.0, ['c', 'a', 't'])
+        t.insert('car', 3.0, ['c', 'a', 'r'])
+        t.insert('dog', 4.0, ['d', 'o', 'g'])
+        t.materialize_top(2, 1)
+        assert t.autocomplete([], 2) == [('dog', 4.0), ('car', 3.0)]
+        assert t.autocomplete(['c'], 1) == [('car', 3.0)]
+
+        t.insert('cat', 3.0, ['c', 'a', 't'])
+        t.insert('cow', 1.0, ['c', 'o', 'w'])
+        assert t.autocomplete([], 2) == [('cat', 5.0), ('dog', 4.0)]
+        assert t.autocomplete(['c'], 2) == [('cat', 5.0), ('car', 3.0)]
+        assert t.autocomplete(['c'], 3) == [('cat', 5.0), ('car', 3.0),
+                                            ('cow', 1.0)]
+
+        t.remove(['c', 'a'])
+        assert t.autocomplete(['c'], 2) == [('cow', 1.0)]
+        assert t.autocomplete([], 2) == [('dog', 4.0), ('cow', 1.0)]
+        t.remove([])
+        assert t.autocomplete([], 1) == []
+        t.insert('dog', 1.0, ['d', 'o', 'g'])
+        assert t.autocomplete([], 1) == [('dog', 1.0)]
+
+
+def test_top_k_needs_a_tree_that_stores_it() -> None:
+    """Test that asking for top-k lists on a tree that cannot store them is
+    a ValueError, not a crash part way through building the engine.
+    """
+    for autocompleter in ['compact', 'array']:
+        with pytest.raises(ValueError):
+            MelodyAutocompleteEngine({
+                'file': 'data/songbook.csv',
+                'autocompleter': autocompleter,
+                'weight_type': 'sum',
+                'top_k': 3
+            })
+
+
+def test_autocomplete_many() -> None:
+    """Test that autocomplete_many gives the same results as autocomplete for
+    each prefix, in the given order, including repeated and missing prefixes.
+    """
+    prefixes = [['c', 'a'], [], ['d'], ['c', 'a', 'r', 's'], ['c'],
+                ['c', 'a'], ['x'], ['c', 'o', 'w']]
+    for cls in [SimplePrefixTree, CompressedPrefixTree, CompactPrefixTree,
+                ArrayPrefixTree]:
+        t = cls('sum')
+        t.insert('cat', 2.0, ['c', 'a', 't'])
+        t.insert('car', 3.0, ['c', 'a', 'r'])
+        t.insert('cars', 1.0, ['c', 'a', 'r', 's'])
+        t.insert('dog', 4.0, ['d', 'o', 'g'])
+        for limit in [None, 1]:
+            assert t.autocomplete_many(prefixes, limit) == \
+                [t.autocomplete(prefix, limit) for prefix in prefixes]
+        assert t.autocomplete_many([]) == []
+
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum',
+        'cache_size': 10
+    })
+    prefixes = ['how', 'zzzq', 'how', 'what', '']
+    results = engine.autocomplete_many(prefixes)
+    expected = [engine.autocomplete(prefix) for prefix in prefixes]
+    assert results == expected
+    assert engine.autocomplete_many(prefixes[::-1]) == expected[::-1]
+
+
+def test_prefix_cursor() -> None:
+    """Test that a cursor's matches after each push and pop are those of
+    autocomplete on its prefix, including prefixes that match nothing.
+    """
+    keys = ['c', 'a', 'r', 's', 'x']
+    for cls in [SimplePrefixTree, CompressedPrefixTree, CompactPrefixTree,
+                ArrayPrefixTree]:
+        t = cls('sum')
+        t.insert('cat', 2.0, ['c', 'a', 't'])
+        t.insert('cars', 3.0, ['c', 'a', 'r', 's'])
+        t.insert('dog', 4.0, ['d', 'o', 'g'])
+        cursor = t.cursor()
+        assert cursor.autocomplete() == t.autocomplete([])
+        for key in keys:
+            cursor.push(key)
+            assert cursor.autocomplete(1) == t.autocomplete(cursor.prefix, 1)
+        for _ in keys:
+            assert cursor.autocomplete() == t.autocomplete(cursor.prefix)
+            cursor.pop()
+        cursor.push('d')
+        assert cursor.autocomplete() == [('dog', 4.0)]
+
+
+def test_engine_session() -> None:
+    """Test that an engine session gives the engine's matches as a prefix is
+    typed and erased, and notices values inserted into the engine.
+    """
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum',
+        'cache_size': 10
+    })
+    session = engine.session()
+    for key in 'a sx':
+        session.push(key)
+        assert session.autocomplete(1) == \
+            engine.autocomplete(''.join(session.prefix), 1)
+    assert session.autocomplete() == []
+    assert session.pop() == 'x'
+    assert session.autocomplete() == [('a star is born', 21.5)]
+
+    # 'z' is in no sentence, so it has no token id until it is inserted
+    session.push('z')
+    assert session.autocomplete() == []
+    engine.insert('a sz', 30.0)
+    assert session.autocomplete() == [('a sz', 30.0)]
+    session.pop()
+    assert session.autocomplete(1) == [('a sz', 30.0)]
+
+
+def test_concurrent_autocompleter() -> None:
+    """Test that readers of a concurrent autocompleter always see a
+    consistent tree while another thread changes it, and that a snapshot
+    never changes.
+    """
+    words = ['cat', 'car', 'cart', 'dog', 'dot', 'do']
+    for cls in [SimplePrefixTree, CompressedPrefixTree]:
+        t = ConcurrentAutocompleter(cls('sum'))
+        for word in words:
+            t.insert(word, 1.0, list(word))
+        before = t.snapshot()
+        expected = before.autocomplete([])
+        done = threading.Event()
+        errors = []
+
+        def write() -> None:
+            """Add weight to every word, removing and restoring 'do'."""
+            for i in range(200):
+                for word in words:
+                    t.insert(word, 1.0, list(word))
+                if i % 10 == 0:
+                    t.remove(['d', 'o', 't'])
+                    t.insert('dot', float(i + 2), list('dot'))
+            done.set()
+
+        def read() -> None:
+            """Check the matches of every tree published along the way."""
+            last = 0.0
+            while not done.is_set():
+                snapshot = t.snapshot()
+                results = snapshot.autocomplete([])
+                weights = [weight for _, weight in results]
+                cat = dict(results).get('cat', 0.0)
+                if len(results) != len(snapshot) \
+                        or sum(weights) != snapshot.weight \
+                        or weights != sorted(weights, reverse=True) \
+                        or cat < last:
+                    errors.append(results)
+                last = cat
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        writer = threading.Thread(target=write)
+        for thread in readers + [writer]:
+            thread.start()
+        for thread in readers + [writer]:
+            thread.join()
+        assert errors == []
+        assert before.autocomplete([]) == expected
+        assert t.autocomplete(['c', 'a', 't']) == [('cat', 201.0)]
+        assert len(t) == 6
+
+
+def test_autocomplete_server() -> None:
+    """Test that the server answers pipelined requests in order, including
+    invalid ones, and that the load generator gets every response.
+    """
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum'
+    })
+    requests = [{'engine': 'sentence', 'prefix': 'a', 'limit': 1},
+                {'engine': 'sentence', 'prefix': 'x'},
+                {'engine': 'melody', 'prefix': [2]},
+                {'engine': 'sentence', 'prefix': 'a', 'limit': 0},
+                {'engine': 'sentence', 'prefix': ''},
+                {'engine': 'sentence', 'prefix': 'a', 'limit': True}]
+
+    async def run() -> None:
+        """Send the requests on one connection without waiting."""
+        server = await AutocompleteServer({'sentence': engine},
+                                          window=0.01).start()
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b''.join(json.dumps(r).encode() + b'\n'
+                              for r in requests) + b'not json\n')
+        responses = [json.loads(await reader.readline())
+                     for _ in range(len(requests) + 1)]
+        writer.close()
+        assert responses[0] == [['a star is born', 21.5]]
+        assert responses[1] == []
+        assert 'error' in responses[2] and 'error' in responses[3]
+        assert responses[4] == [list(m) for m in engine.autocomplete('')]
+        assert 'error' in responses[5] and 'error' in responses[6]
+
+        report = await load_test('127.0.0.1', port, requests * 20,
+                                 connections=2, pipeline=4)
+        assert report.requests == 120 and report.errors == 60
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_autocomplete_server_engine_error() -> None:
+    """Test that a request whose engine fails gets an error response, and
+    that the connection stays open for the next request.
+    """
+    class Broken:
+        """An engine that always fails."""
+
+        def autocomplete_many(self, prefixes: list, limit: int) -> list:
+            """Fail."""
+            raise RuntimeError('broken')
+
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum'
+    })
+
+    async def run() -> None:
+        """Send a request to the broken engine, then to the working one."""
+        server = await AutocompleteServer({'broken': Broken(),
+                                           'sentence': engine}).start()
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'{"engine": "broken", "prefix": "a"}\n')
+        assert json.loads(await reader.readline()) == \
+            {'error': 'RuntimeError: broken'}
+        writer.write(b'{"engine": "sentence", "prefix": "a", "limit": 1}\n')
+        assert json.loads(await reader.readline()) == \
+            [['a star is born', 21.5]]
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_autocomplete_server_long_line() -> None:
+    """Test that a request line longer than the server accepts gets an error
+    response and ends the connection, after the requests before it are
+    answered.
+    """
+    engine = SentenceAutocompleteEngine({
+        'file': 'data/sample_sentences.csv',
+        'autocompleter': 'compressed',
+        'weight_type': 'sum'
+    })
+
+    async def run() -> None:
+        """Send a request, then a line with no end in sight."""
+        server = await AutocompleteServer({'sentence': engine},
+                                          max_line=100).start()
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'{"engine": "sentence", "prefix": "a", "limit": 1}\n'
+                     + b'{"engine": "sentence", "prefix": "' + b'a' * 1000)
+        assert json.loads(await reader.readline()) == \
+            [['a star is born', 21.5]]
+        assert 'error' in json.loads(await reader.readline())
+        assert await reader.read() == b''
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_from_items() -> None:
+    """Test that bulk-building a tree gives the same tree as inserting the
+    values one at a time, including a value that appears twice.
+    """
+    items = [('dog', 4.0, ['d', 'o', 'g']),
+             ('cat', 2.0, ['c', 'a', 't']),
+             ('car', 1.0, ['c', 'a', 'r']),
+             ('car', 2.0, ['c', 'a', 'r'])]
+    t = CompressedPrefixTree.from_items('sum', items)
+    assert len(t) == 3
+    assert t.weight == 9.0
+    assert [s.value for s in t.subtrees] == [['c', 'a'], ['d', 'o', 'g']]
+    assert t.subtrees[0].weight == 5.0
+
+    t = SimplePrefixTree.from_items('average', items)
+    assert len(t) == 3
+    assert t.weight == 3.0
+    assert [s.value for s in t.subtrees] == [['d'], ['c']]
+    assert t.autocomplete(['c']) == [('car', 3.0), ('cat', 2.0)]
+
+
+def test_from_items_workers() -> None:
+    """Test that building a tree in several processes gives the same tree
+    as building it in one.
+    """
+    items = [('dog', 4.0, ['d', 'o', 'g']),
+             ('do', 2.0, ['d', 'o']),
+             ('cat', 2.0, ['c', 'a', 't']),
+             ('car', 3.0, ['c', 'a', 'r']),
+             ('', 0.5, [])]
+    for tree_type in [SimplePrefixTree, CompressedPrefixTree]:
+        t = tree_type.from_items('average', items, workers=2)
+        expected = tree_type.from_items('average', items)
+        assert str(t) == str(expected)
+        assert t.max_leaf_weight == 4.0
+        assert t.autocomplete(['d', 'o']) == [('dog', 4.0), ('do', 2.0)]
+
+
+def test_save_load(tmp_path) -> None:
+    """Test that a saved tree loads back with the same structure, and that
+    it can only be loaded as the class it was saved from.
+    """
+    t = CompressedPrefixTree('average')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    t.insert('car', 3.0, ['c', 'a', 'r'])
+    t.insert('dog', 4.0, ['d', 'o', 'g'])
+    path = str(tmp_path / 'tree.pfxt')
+    t.save(path)
+
+    loaded = CompressedPrefixTree.load(path)
+    assert str(loaded) == str(t)
+    assert loaded.weight_type == 'average'
+    assert loaded.subtrees[1].value == ['c', 'a']
+    loaded.insert('cab', 1.0, ['c', 'a', 'b'])
+    assert loaded.autocomplete(['c']) == \
+        [('car', 3.0), ('cat', 2.0), ('cab', 1.0)]
+
+    try:
+        SimplePrefixTree.load(path)
+    except ValueError:
+        pass
+    else:
+        assert False, 'loaded a CompressedPrefixTree as a SimplePrefixTree'
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    for offset in [6, 7]:
+        with open(path, 'wb') as file:
+            file.write(data[:offset] + bytes([200]) + data[offset + 1:])
+        with pytest.raises(ValueError):
+            CompressedPrefixTree.load(path)
+
+
+def test_frozen_prefix_tree(tmp_path) -> None:
+    """Test that a frozen prefix tree answers queries like the compressed
+    prefix tree it was written from.
+    """
+    t = CompressedPrefixTree('sum')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    t.insert('car', 3.0, ['c', 'a', 'r'])
+    t.insert('dog', 4.0, ['d', 'o', 'g'])
+    path = str(tmp_path / 'tree.pfxf')
+    FrozenPrefixTree.write(t, path)
+
+    frozen = FrozenPrefixTree(path)
+    assert len(frozen) == 3
+    assert frozen.autocomplete([]) == [('dog', 4.0), ('car', 3.0), ('cat', 2.0)]
+    assert frozen.autocomplete(['c'], 1) == [('car', 3.0)]
+    assert frozen.autocomplete(['d', 'o']) == [('dog', 4.0)]
+    assert frozen.autocomplete(['d', 'a']) == []
+    assert frozen.autocomplete(['x']) == []
+    with pytest.raises(TypeError):
+        frozen.insert('cow', 1.0, ['c', 'o', 'w'])
+    with pytest.raises(TypeError):
+        frozen.remove(['c'])
+    frozen.close()
+
+
+def test_frozen_prefix_tree_bad_file(tmp_path) -> None:
+    """Test that opening a file that is not a whole frozen prefix tree is a
+    ValueError.
+    """
+    t = SimplePrefixTree('sum')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    path = tmp_path / 'tree.pfxf'
+    FrozenPrefixTree.write(t, str(path))
+    data = path.read_bytes()
+    bad_weight_type = data[:6] + bytes([200]) + data[7:]
+    for contents in [b'', data[:10], bad_weight_type, data[:-1]]:
+        path.write_bytes(contents)
+        with pytest.raises(ValueError):
+            FrozenPrefixTree(str(path))
+
+
+def test_compact_prefix_tree() -> None:
+    """Test that a compact prefix tree has the same values, weights and
+    matches as a compressed prefix tree, through splits and merges.
+    """
+    compressed = CompressedPrefixTree('sum')
+    compact = CompactPrefixTree('sum')
+    for t in [compressed, compact]:
+        t.insert('cat', 2.0, ['c', 'a', 't'])
+        t.insert('car', 3.0, ['c', 'a', 'r'])
+        t.insert('dog', 4.0, ['d', 'o', 'g'])
+    assert not hasattr(compact, '__dict__')
+    assert [s.value for s in compact.subtrees] == [['c', 'a'], ['d', 'o', 'g']]
+    assert compact.subtrees[0].subtrees[0].value == ['c', 'a', 'r']
+    assert compact.autocomplete(['c']) == compressed.autocomplete(['c'])
+
+    for t in [compressed, compact]:
+        t.remove(['c', 'a', 'r'])
+    assert [s.value for s in compact.subtrees] == [['d', 'o', 'g'],
+                                                   ['c', 'a', 't']]
+    assert compact.subtrees[1].subtrees[0].value == ['cat']
+    assert compact.autocomplete([]) == compressed.autocomplete([])
+    assert len(compact) == 2
+
+
+def test_array_prefix_tree() -> None:
+    """Test that an array prefix tree inserts, matches and removes values
+    like a simple prefix tree.
+    """
+    t = ArrayPrefixTree('average')
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    t.insert('car', 3.0, ['c', 'a', 'r'])
+    t.insert('dog', 5.0, ['d', 'o', 'g'])
+    t.insert('cat', 2.0, ['c', 'a', 't'])
+    assert len(t) == 3
+    assert t.autocomplete([]) == [('dog', 5.0), ('cat', 4.0), ('car', 3.0)]
+    assert t.autocomplete(['c', 'a'], 1) == [('cat', 4.0)]
+    assert t.autocomplete(['c', 'x']) == []
+
+    t.remove(['c', 'a', 't'])
+    assert len(t) == 2
+    assert t.autocomplete(['c']) == [('car', 3.0)]
+    t.remove([])
+    assert len(t) == 0
+    assert t.autocomplete([]) == []
+
+
+def test_array_prefix_tree_remove_maxima() -> None:
+    """Test that removing values keeps the largest leaf weight of every
+    tree right, so that matches stay in non-increasing weight order.
+    """
+    t = ArrayPrefixTree('sum')
+    t.insert('aa#1', 5.0, ['a', 'a'])
+    t.insert('cb#1', 6.0, ['c', 'b'])
+    t.remove(['a', 'b', 'b'])
+    t.insert('c#1', 9.0, ['c'])
+    t.insert('cb#1', 2.0, ['c', 'b'])
+    t.remove(['a', 'b'])
+    t.remove(['b', 'c', 'a'])
+    t.insert('cb#1', 5.0, ['c', 'b'])
+    t.insert('bac#0', 6.0, ['b', 'a', 'c'])
+    t.insert('babc#1', 3.0, ['b', 'a', 'b', 'c'])
+    t.remove(['c'])
+    t.remove(['b', 'a', 'c'])
+    assert t.autocomplete([]) == [('aa#1', 5.0), ('babc#1', 3.0)]
+    assert t.autocomplete([], 1) == [('aa#1', 5.0)]
+
+
 if __name__ == '__main__':
-    import pytest
     pytest.main(['a2_sample_test.py'])
@@ -15,10 +15,17 @@ top-level functions to this file.
 """
 from __future__ import annotations
 import csv
-from typing import Any, Dict, List, Optional, Tuple
+import heapq
+import re
+import sys
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, \
+    NamedTuple, Optional, Tuple
 
 from melody import Melody
-from prefix_tree import SimplePrefixTree, CompressedPrefixTree, Autocompleter
+from prefix_tree import SimplePrefixTree, CompressedPrefixTree, \
+    CompactPrefixTree, ArrayPrefixTree, Autocompleter, PrefixCursor
 
 
 ################################################################################
@@ -39,15 +46,38 @@ class LetterAutocompleteEngine:
     """
     autocompleter: Autocompleter
 
+    # === Private Attributes ===
+    # _tokens:
+    #     The token ids of the prefix elements in autocompleter. Prefixes are
+    #     stored in autocompleter as lists of token ids.
+    # _cache:
+    #     Recent results of autocomplete.
+    # _version:
+    #     The number of changes made to autocompleter through this engine, so
+    #     that sessions can tell when their positions in it are out of date.
+    _tokens: _TokenTable
+    _cache: _QueryCache
+    _version: int
+
     def __init__(self, config: Dict[str, Any]) -> None:
         """Initialize this engine with the given configuration.
 
         <config> is a dictionary consisting of the following keys:
             - 'file': the path to a text file
-            - 'autocompleter': either the string 'simple' or 'compressed',
-              specifying which subclass of Autocompleter to use.
+            - 'autocompleter': the string 'simple', 'compressed', 'compact'
+              or 'array', specifying which subclass of Autocompleter to use.
             - 'weight_type': either 'sum' or 'average', which specifies the
               weight type for the prefix tree.
+            - 'workers' (optional): the number of processes used to build
+              the prefix tree (see from_items in prefix_tree.py). Defaults
+              to 1.
+            - 'cache_size' (optional): the number of autocomplete results
+              to keep, for the most recently used (prefix, limit) pairs.
+              Defaults to 0, which turns the cache off.
+            - 'top_k' (optional): for 'simple' and 'compressed' trees, the
+              number of matches stored for every prefix of at most
+              'top_k_depth' (optional, default 3) elements (see
+              materialize_top in prefix_tree.py). Defaults to 0 (none).
 
         Each line of the specified file counts as one input string.
         Note that the line may or may not contain spaces.
@@ -62,22 +92,12 @@ class LetterAutocompleteEngine:
         one line of the input file; this would result in that string getting
         a larger weight (because of how Autocompleter.insert works).
         """
-        # We've opened the file for you here. You should iterate over the
-        # lines of the file and process them according to the description in
-        # this method's docstring.
-        self.autocompleter = SimplePrefixTree(config['weight_type']) \
-            if config['autocompleter'] == 'simple' \
-            else CompressedPrefixTree(config['weight_type'])
-        with open(config['file'], encoding='utf8') as f:
-            line = f.readline()
-            while line:
-                line = line.strip()
-                line = list(filter(lambda c: c.isalnum() or c == ' ', line))
-                line = ''.join(line)
-                line = line.lower()
-                if line:
-                    self.autocompleter.insert(line, 1, list(line))
-                line = f.readline()
+        lines = _sanitized(_read_lines(config['file']))
+        self._tokens = _TokenTable()
+        self._cache = _QueryCache(config.get('cache_size', 0))
+        self._version = 0
+        self.autocompleter = _build_tree(
+            config, _interned(_letter_items(lines), self._tokens))
 
     def autocomplete(self, prefix: str,
                      limit: Optional[int] = None) -> List[Tuple[str, float]]:
@@ -95,7 +115,40 @@ class LetterAutocompleteEngine:
             limit is None or limit > 0
             <prefix> contains only lowercase alphanumeric characters and spaces
         """
-        return self.autocompleter.autocomplete(list(prefix), limit)
+        return _autocomplete(self, list(prefix), limit)
+
+    def autocomplete_many(self, prefixes: List[str],
+                          limit: Optional[int] = None) \
+            -> List[List[Tuple[str, float]]]:
+        """Return the matches for each prefix string in <prefixes>, in the
+        same order: the i-th list is autocomplete(prefixes[i], limit).
+
+        Preconditions:
+            limit is None or limit > 0
+            each prefix contains only lowercase alphanumeric characters and
+            spaces
+        """
+        return _autocomplete_many(self, [list(prefix) for prefix in prefixes],
+                                  limit)
+
+    def autocomplete_fuzzy(self, prefix: str, k: int = 1,
+                           limit: Optional[int] = None) \
+            -> List[Tuple[str, float]]:
+        """Return up to <limit> matches for the given prefix string, allowing
+        up to <k> mistyped, missing or extra letters.
+
+        The matches are ordered as in autocomplete, with strings closer to
+        <prefix> first among those of equal weight (see autocomplete_fuzzy
+        in prefix_tree.py). Only 'simple' and 'compressed' autocompleters
+        support this.
+
+        Preconditions:
+            limit is None or limit > 0
+            k >= 0
+            <prefix> contains only lowercase alphanumeric characters and spaces
+        """
+        return self.autocompleter.autocomplete_fuzzy(
+            self._tokens.lookup_known(list(prefix)), k, limit)
 
     def remove(self, prefix: str) -> None:
         """Remove all strings that match the given prefix string.
@@ -106,7 +159,35 @@ class LetterAutocompleteEngine:
         Precondition: <prefix> contains only lowercase alphanumeric characters
                       and spaces.
         """
-        self.autocompleter.remove(list(prefix))
+        _remove(self, list(prefix))
+
+    def remove_many(self, prefixes: List[str]) -> None:
+        """Remove all strings that match any prefix string in <prefixes>.
+
+        Precondition: each prefix contains only lowercase alphanumeric
+                      characters and spaces.
+        """
+        _remove_many(self, [list(prefix) for prefix in prefixes])
+
+    def insert(self, string: str, weight: float = 1.0) -> None:
+        """Insert <string> with the given weight, sanitized in the same way
+        as the strings in the input file.
+
+        A string without an alphanumeric character is not inserted.
+
+        Precondition: weight > 0
+        """
+        _insert(self, _letter_items(_sanitized([(string, weight)])))
+
+    def cache_info(self) -> CacheInfo:
+        """Return the statistics of this engine's autocomplete cache."""
+        return self._cache.info()
+
+    def session(self) -> AutocompleteSession:
+        """Return a session for typing a prefix into this engine one
+        element at a time, starting from the empty prefix.
+        """
+        return AutocompleteSession(self)
 
 
 class SentenceAutocompleteEngine:
@@ -125,15 +206,49 @@ class SentenceAutocompleteEngine:
     """
     autocompleter: Autocompleter
 
+    # === Private Attributes ===
+    # _tokens:
+    #     The token ids of the prefix elements in autocompleter. Prefixes are
+    #     stored in autocompleter as lists of token ids.
+    # _cache:
+    #     Recent results of autocomplete.
+    # _version:
+    #     The number of changes made to autocompleter through this engine, so
+    #     that sessions can tell when their positions in it are out of date.
+    # _words:
+    #     Whether prefix sequences are lists of words; otherwise they are
+    #     lists of characters.
+    _tokens: _TokenTable
+    _cache: _QueryCache
+    _version: int
+    _words: bool
+
     def __init__(self, config: Dict[str, Any]) -> None:
         """Initialize this engine with the given configuration.
 
         <config> is a dictionary consisting of the following keys:
             - 'file': the path to a CSV file
-            - 'autocompleter': either the string 'simple' or 'compressed',
-              specifying which subclass of Autocompleter to use.
+            - 'autocompleter': the string 'simple', 'compressed', 'compact'
+              or 'array', specifying which subclass of Autocompleter to use.
             - 'weight_type': either 'sum' or 'average', which specifies the
               weight type for the prefix tree.
+            - 'workers' (optional): the number of processes used to build
+              the prefix tree (see from_items in prefix_tree.py). Defaults
+              to 1.
+            - 'cache_size' (optional): the number of autocomplete results
+              to keep, for the most recently used (prefix, limit) pairs.
+              Defaults to 0, which turns the cache off.
+            - 'top_k' (optional): for 'simple' and 'compressed' trees, the
+              number of matches stored for every prefix of at most
+              'top_k_depth' (optional, default 3) elements (see
+              materialize_top in prefix_tree.py). Defaults to 0 (none).
+            - 'words' (optional): if True, the prefix sequences stored are
+              lists of words, and the last word of a prefix string given to
+              autocomplete or remove may be only part of a word. A prefix
+              string ending in a space matches only strings with more words
+              after it, as with lists of characters, but the number of
+              spaces between words is ignored. Defaults to False, which
+              stores lists of characters.
 
         Precondition:
         The given file is a *CSV file* where each line has two entries:
@@ -153,24 +268,14 @@ class SentenceAutocompleteEngine:
         one line of the input file; this would result in that string getting
         a larger weight.
         """
-        # We haven't given you any starter code here! You should review how
-        # you processed CSV files on Assignment 1.
-        self.autocompleter = SimplePrefixTree(config['weight_type']) \
-            if config['autocompleter'] == 'simple' \
-            else CompressedPrefixTree(config['weight_type'])
-        with open(config['file']) as f:
-            lines = csv.reader(f)
-            for line in lines:
-                if line:
-                    string = line[0]
-                    weight = float(line[1])
-                    string = string.strip()
-                    string = \
-                        list(filter(lambda c: c.isalnum() or c == ' ', string))
-                    string = ''.join(string)
-                    string = string.lower()
-                    if string:
-                        self.autocompleter.insert(string, weight, list(string))
+        lines = _sanitized(_read_weighted_lines(config['file']))
+        self._tokens = _TokenTable()
+        self._cache = _QueryCache(config.get('cache_size', 0))
+        self._version = 0
+        self._words = config.get('words', False)
+        items = _word_items(lines) if self._words else _letter_items(lines)
+        self.autocompleter = _build_tree(config,
+                                         _interned(items, self._tokens))
 
     def autocomplete(self, prefix: str,
                      limit: Optional[int] = None) -> List[Tuple[str, float]]:
@@ -188,7 +293,26 @@ class SentenceAutocompleteEngine:
             limit is None or limit > 0
             <prefix> contains only lowercase alphanumeric characters and spaces
         """
-        return self.autocompleter.autocomplete(list(prefix), limit)
+        if self._words:
+            return _word_autocomplete(self, prefix, limit)
+        return _autocomplete(self, list(prefix), limit)
+
+    def autocomplete_many(self, prefixes: List[str],
+                          limit: Optional[int] = None) \
+            -> List[List[Tuple[str, float]]]:
+        """Return the matches for each prefix string in <prefixes>, in the
+        same order: the i-th list is autocomplete(prefixes[i], limit).
+
+        Preconditions:
+            limit is None or limit > 0
+            each prefix contains only lowercase alphanumeric characters and
+            spaces
+        """
+        if self._words:
+            return [_word_autocomplete(self, prefix, limit)
+                    for prefix in prefixes]
+        return _autocomplete_many(self, [list(prefix) for prefix in prefixes],
+                                  limit)
 
     def remove(self, prefix: str) -> None:
         """Remove all strings that match the given prefix.
@@ -199,7 +323,46 @@ class SentenceAutocompleteEngine:
         Precondition: <prefix> contains only lowercase alphanumeric characters
                       and spaces.
         """
-        self.autocompleter.remove(list(prefix))
+        if self._words:
+            _remove_found(self, _word_prefixes(self, prefix))
+        else:
+            _remove(self, list(prefix))
+
+    def remove_many(self, prefixes: List[str]) -> None:
+        """Remove all strings that match any prefix string in <prefixes>.
+
+        Precondition: each prefix contains only lowercase alphanumeric
+                      characters and spaces.
+        """
+        if self._words:
+            _remove_found(self, [ids for prefix in prefixes
+                                 for ids in _word_prefixes(self, prefix)])
+        else:
+            _remove_many(self, [list(prefix) for prefix in prefixes])
+
+    def insert(self, string: str, weight: float = 1.0) -> None:
+        """Insert <string> with the given weight, sanitized in the same way
+        as the strings in the input file.
+
+        A string without an alphanumeric character is not inserted.
+
+        Precondition: weight > 0
+        """
+        lines = _sanitized([(string, weight)])
+        _insert(self, _word_items(lines) if self._words
+                else _letter_items(lines))
+
+    def cache_info(self) -> CacheInfo:
+        """Return the statistics of this engine's autocomplete cache."""
+        return self._cache.info()
+
+    def session(self) -> AutocompleteSession:
+        """Return a session for typing a prefix into this engine one
+        element at a time, starting from the empty prefix.
+
+        The elements are whole words if this engine stores lists of words.
+        """
+        return AutocompleteSession(self)
 
 
 ################################################################################
@@ -220,15 +383,42 @@ class MelodyAutocompleteEngine:
     """
     autocompleter: Autocompleter
 
+    # === Private Attributes ===
+    # _tokens:
+    #     The token ids of the prefix elements in autocompleter. Prefixes are
+    #     stored in autocompleter as lists of token ids.
+    # _cache:
+    #     Recent results of autocomplete.
+    # _version:
+    #     The number of changes made to autocompleter through this engine, so
+    #     that sessions can tell when their positions in it are out of date.
+    # _index:
+    #     The index used by autocomplete_infix, or None if it has not been
+    #     built yet. Once built, insert and remove keep it up to date.
+    _tokens: _TokenTable
+    _cache: _QueryCache
+    _version: int
+    _index: Optional[_IntervalIndex]
+
     def __init__(self, config: Dict[str, Any]) -> None:
         """Initialize this engine with the given configuration.
 
         <config> is a dictionary consisting of the following keys:
             - 'file': the path to a CSV file
-            - 'autocompleter': either the string 'simple' or 'compressed',
-              specifying which subclass of Autocompleter to use.
+            - 'autocompleter': the string 'simple', 'compressed', 'compact'
+              or 'array', specifying which subclass of Autocompleter to use.
             - 'weight_type': either 'sum' or 'average', which specifies the
               weight type for the prefix tree.
+            - 'workers' (optional): the number of processes used to build
+              the prefix tree (see from_items in prefix_tree.py). Defaults
+              to 1.
+            - 'cache_size' (optional): the number of autocomplete results
+              to keep, for the most recently used (prefix, limit) pairs.
+              Defaults to 0, which turns the cache off.
+            - 'top_k' (optional): for 'simple' and 'compressed' trees, the
+              number of matches stored for every prefix of at most
+              'top_k_depth' (optional, default 3) elements (see
+              materialize_top in prefix_tree.py). Defaults to 0 (none).
 
         Precondition:
         The given file is a *CSV file* where each line has the following format:
@@ -243,23 +433,12 @@ class MelodyAutocompleteEngine:
 
         Each melody is be inserted into the Autocompleter with a weight of 1.
         """
-        # We haven't given you any starter code here! You should review how
-        # you processed CSV files on Assignment 1.
-        self.autocompleter = SimplePrefixTree(config['weight_type']) \
-            if config['autocompleter'] == 'simple' \
-            else CompressedPrefixTree(config['weight_type'])
-        with open(config['file']) as f:
-            lines = csv.reader(f)
-            for line in lines:
-                if line:
-                    pairs = []
-                    for i in range(1, len(line) - 1, 2):
-                        pairs.append((int(line[i]), int(line[i+1])))
-                    interval = []
-                    for i in range(len(pairs) - 1):
-                        interval.append(int(pairs[i+1][0]) - int(pairs[i][0]))
-                    value = Melody(line[0], pairs)
-                    self.autocompleter.insert(value, 1, interval)
+        self._tokens = _TokenTable()
+        self._cache = _QueryCache(config.get('cache_size', 0))
+        self._version = 0
+        self._index = None
+        self.autocompleter = _build_tree(
+            config, _interned(_read_melodies(config['file']), self._tokens))
 
     def autocomplete(self, prefix: List[int],
                      limit: Optional[int] = None) -> List[Tuple[Melody, float]]:
@@ -273,12 +452,820 @@ class MelodyAutocompleteEngine:
         Precondition:
             limit is None or limit > 0
         """
-        return self.autocompleter.autocomplete(prefix, limit)
+        return _autocomplete(self, prefix, limit)
+
+    def autocomplete_many(self, prefixes: List[List[int]],
+                          limit: Optional[int] = None) \
+            -> List[List[Tuple[Melody, float]]]:
+        """Return the matches for each interval sequence in <prefixes>, in
+        the same order: the i-th list is autocomplete(prefixes[i], limit).
+
+        Precondition:
+            limit is None or limit > 0
+        """
+        return _autocomplete_many(self, prefixes, limit)
+
+    def autocomplete_approximate(self, prefix: List[int], tolerance: int = 1,
+                                 skips: int = 0,
+                                 limit: Optional[int] = None) \
+            -> List[Tuple[Melody, float]]:
+        """Return up to <limit> melodies that start roughly like the given
+        interval sequence, ordered as in autocomplete.
+
+        Each interval may be off by up to <tolerance> semitones, and up to
+        <skips> notes in all may be missing from the query or extra in it.
+        A missing note joins two of the melody's intervals into one, and an
+        extra note splits one of them in two. Only 'simple' and 'compressed'
+        autocompleters support this.
+
+        Precondition:
+            limit is None or limit > 0
+            tolerance >= 0 and skips >= 0
+        """
+        matcher = _IntervalMatcher(prefix, tolerance, skips,
+                                   self._tokens.elements())
+        return self.autocompleter.autocomplete_matching(
+            matcher.start(), matcher.step, matcher.accepts, limit)
+
+    def autocomplete_infix(self, intervals: List[int],
+                           limit: Optional[int] = None) \
+            -> List[Tuple[Melody, float]]:
+        """Return up to <limit> melodies whose interval sequence contains
+        <intervals> anywhere, not just at its start, ordered as in
+        autocomplete.
+
+        The melodies are found through an index of the short runs of
+        intervals in every melody, which is built on the first call, and
+        from then on updated by insert and remove.
+
+        Precondition:
+            limit is None or limit > 0
+        """
+        if self._index is None:
+            self._index = _IntervalIndex(self.autocompleter.autocomplete([]))
+        return self._index.find(intervals, limit)
 
     def remove(self, prefix: List[int]) -> None:
         """Remove all melodies that match the given interval sequence.
         """
-        self.autocompleter.remove(prefix)
+        if self._index is not None:
+            self._index.discard(melody for melody, _ in
+                                self.autocompleter.autocomplete(
+                                    self._tokens.lookup_known(prefix)))
+        _remove(self, prefix)
+
+    def remove_many(self, prefixes: List[List[int]]) -> None:
+        """Remove all melodies that match any interval sequence in
+        <prefixes>.
+        """
+        if self._index is not None:
+            for matches in self.autocompleter.autocomplete_many(
+                    [self._tokens.lookup_known(prefix)
+                     for prefix in prefixes]):
+                self._index.discard(melody for melody, _ in matches)
+        _remove_many(self, prefixes)
+
+    def insert(self, melody: Melody, weight: float = 1.0) -> None:
+        """Insert <melody> with the given weight.
+
+        Precondition: weight > 0
+        """
+        _insert(self, [(melody, weight, melody.intervals())])
+        if self._index is not None:
+            self._index.add(melody, weight)
+
+    def cache_info(self) -> CacheInfo:
+        """Return the statistics of this engine's autocomplete cache."""
+        return self._cache.info()
+
+    def session(self) -> AutocompleteSession:
+        """Return a session for typing a prefix into this engine one
+        element at a time, starting from the empty prefix.
+        """
+        return AutocompleteSession(self)
+
+
+################################################################################
+# Query cache
+################################################################################
+class CacheInfo(NamedTuple):
+    """The statistics of an engine's autocomplete cache.
+
+    === Attributes ===
+    hits:
+        The number of autocomplete calls answered from the cache.
+    misses:
+        The number of autocomplete calls that searched the prefix tree.
+    maxsize:
+        The most results the cache keeps.
+    currsize:
+        The number of results in the cache now.
+    """
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _QueryCache:
+    """A cache of the most recently used autocomplete results.
+
+    Results are keyed by (tuple of prefix token ids, limit), or, for a
+    sentence engine storing lists of words, (tuple of whole word ids, limit,
+    last part of a word). Only the ids are used to decide which results a
+    change makes stale.
+
+    === Private Attributes ===
+    _maxsize:
+        The most results kept; 0 turns the cache off.
+    _hits, _misses:
+        The number of lookups that found, and did not find, a result.
+    _results:
+        The cached results, from least to most recently used.
+    """
+    _maxsize: int
+    _hits: int
+    _misses: int
+    _results: OrderedDict
+
+    def __init__(self, maxsize: int) -> None:
+        """Initialize an empty cache of at most <maxsize> results."""
+        self._maxsize = maxsize
+        self._hits = 0
+        self._misses = 0
+        self._results = OrderedDict()
+
+    def get(self, key: Tuple) \
+            -> Optional[List[Tuple[Any, float]]]:
+        """Return the results cached for <key>, or None if there are none.
+        """
+        results = self._results.get(key)
+        if results is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+            self._results.move_to_end(key)
+        return results
+
+    def put(self, key: Tuple,
+            results: List[Tuple[Any, float]]) -> None:
+        """Cache <results> for <key>, dropping the least recently used
+        results if the cache is full.
+        """
+        if self._maxsize:
+            self._results[key] = results
+            if len(self._results) > self._maxsize:
+                self._results.popitem(last=False)
+
+    def discard(self, prefix: List[int], removed: bool) -> None:
+        """Drop the results that may have changed after a value with
+        <prefix> was inserted, or, if <removed> is True, after every value
+        matching <prefix> was removed.
+
+        An insert only changes the matches of prefixes of <prefix>; a removal
+        also empties the matches of every prefix that <prefix> is a prefix of.
+        """
+        prefix = tuple(prefix)
+        stale = [key for key in self._results
+                 if prefix[:len(key[0])] == key[0]
+                 or (removed and key[0][:len(prefix)] == prefix)]
+        for key in stale:
+            del self._results[key]
+
+    def info(self) -> CacheInfo:
+        """Return the statistics of this cache."""
+        return CacheInfo(self._hits, self._misses, self._maxsize,
+                         len(self._results))
+
+
+def _autocomplete(engine: Any, prefix: List,
+                  limit: Optional[int]) -> List[Tuple[Any, float]]:
+    """Return up to <limit> matches for <prefix> in <engine>, from its cache
+    if they are there.
+    """
+    ids = engine._tokens.lookup(prefix)
+    if ids is None:
+        return []
+    key = (tuple(ids), limit)
+    results = engine._cache.get(key)
+    if results is None:
+        results = engine.autocompleter.autocomplete(ids, limit)
+        engine._cache.put(key, results)
+    # a copy, so that callers cannot change the cached list
+    return list(results)
+
+
+def _autocomplete_many(engine: Any, prefixes: List[List],
+                       limit: Optional[int]) -> List[List[Tuple[Any, float]]]:
+    """Return up to <limit> matches for each prefix in <prefixes> in
+    <engine>, taking the cached ones from its cache and finding the rest in a
+    single call to its autocompleter.
+    """
+    results = [[] for _ in prefixes]
+    missing = []
+    for i, prefix in enumerate(prefixes):
+        ids = engine._tokens.lookup(prefix)
+        if ids is not None:
+            cached = engine._cache.get((tuple(ids), limit))
+            if cached is None:
+                missing.append((i, ids))
+            else:
+                results[i] = list(cached)
+    found = engine.autocompleter.autocomplete_many(
+        [ids for _, ids in missing], limit)
+    for (i, ids), matches in zip(missing, found):
+        engine._cache.put((tuple(ids), limit), matches)
+        results[i] = list(matches)
+    return results
+
+
+def _remove(engine: Any, prefix: List) -> None:
+    """Remove every value matching <prefix> from <engine>."""
+    ids = engine._tokens.lookup(prefix)
+    if ids is not None:
+        engine.autocompleter.remove(ids)
+        engine._cache.discard(ids, True)
+        engine._version += 1
+
+
+def _remove_many(engine: Any, prefixes: List[List]) -> None:
+    """Remove every value matching any prefix in <prefixes> from <engine>,
+    with a single call to its autocompleter.
+    """
+    _remove_found(engine, [ids for ids in map(engine._tokens.lookup, prefixes)
+                           if ids is not None])
+
+
+def _remove_found(engine: Any, found: List[List[int]]) -> None:
+    """Remove every value matching any list of token ids in <found> from
+    <engine>, with a single call to its autocompleter.
+    """
+    engine.autocompleter.remove_many(found)
+    for ids in found:
+        engine._cache.discard(ids, True)
+    engine._version += 1
+
+
+def _split_words(prefix: str) -> Tuple[List[str], str]:
+    """Return the whole words of the prefix string <prefix>, and its last
+    word if that may be only part of a word ('' if <prefix> ends in a space).
+    """
+    words = prefix.split(' ')
+    return [word for word in words[:-1] if word], words[-1]
+
+
+def _word_prefixes(engine: Any, prefix: str) -> List[List[int]]:
+    """Return the token id lists of the word prefixes that the prefix string
+    <prefix> stands for in <engine>: one for each word its last word could
+    be the start of, or, if <prefix> ends in a space after a word, one for
+    each word that follows its words in a stored string.
+    """
+    words, partial = _split_words(prefix)
+    ids = engine._tokens.lookup(words)
+    if ids is None:
+        return []
+    if partial:
+        return [ids + [token]
+                for token in engine._tokens.starting_with(partial)]
+    if words and prefix.endswith(' '):
+        following = {value.split()[len(words)] for value, _ in
+                     _longer_matches(engine, ids, None)}
+        return [ids + engine._tokens.lookup([word]) for word in following]
+    return [ids]
+
+
+def _longer_matches(engine: Any, ids: List[int],
+                    limit: Optional[int]) -> List[Tuple[str, float]]:
+    """Return up to <limit> matches for the word token ids <ids> in <engine>
+    that have more words than <ids>, in non-increasing weight order.
+
+    The strings with exactly those words are found with the others and left
+    out, asking for more matches until there are <limit> without them.
+    """
+    wanted = limit
+    while True:
+        matches = engine.autocompleter.autocomplete(ids, wanted)
+        longer = [match for match in matches
+                  if len(match[0].split()) > len(ids)]
+        if limit is None or len(longer) >= limit or len(matches) < wanted:
+            return longer[:limit]
+        wanted += limit - len(longer)
+
+
+def _word_autocomplete(engine: Any, prefix: str,
+                       limit: Optional[int]) -> List[Tuple[Any, float]]:
+    """Return up to <limit> matches for the prefix string <prefix> in
+    <engine>, which stores lists of words, from its cache if they are there.
+
+    The matches for every word that the last word could be the start of are
+    found together, with autocomplete_any. If <prefix> ends in a space after
+    a word, only the strings with more words are matches.
+    """
+    words, partial = _split_words(prefix)
+    if not partial and not (words and prefix.endswith(' ')):
+        return _autocomplete(engine, words, limit)
+    ids = engine._tokens.lookup(words)
+    if ids is None:
+        return []
+    # a partial word is never ' ', so a key ending in ' ' is for the strings
+    # with more words than <words>
+    key = (tuple(ids), limit, partial or ' ')
+    results = engine._cache.get(key)
+    if results is None:
+        if partial:
+            results = engine.autocompleter.autocomplete_any(
+                _word_prefixes(engine, prefix), limit)
+        else:
+            results = _longer_matches(engine, ids, limit)
+        engine._cache.put(key, results)
+    # a copy, so that callers cannot change the cached list
+    return list(results)
+
+
+def _insert(engine: Any, items: Iterable[Tuple[Any, float, List]]) -> None:
+    """Insert each (value, weight, prefix) triple in <items> into <engine>.
+    """
+    for value, weight, prefix in _interned(items, engine._tokens):
+        engine.autocompleter.insert(value, weight, prefix)
+        engine._cache.discard(prefix, False)
+        engine._version += 1
+
+
+################################################################################
+# Keystroke sessions
+################################################################################
+class AutocompleteSession:
+    """A prefix typed into an autocomplete engine one element at a time.
+
+    Each push follows one more element down the engine's autocompleter from
+    where the last one ended, and each pop goes back one, so a keystroke
+    costs one step down the tree plus the search for its matches. The
+    elements are characters for the text engines (words for a sentence
+    engine that stores lists of words) and intervals for the melody engine.
+
+    === Attributes ===
+    prefix:
+        The elements pushed so far, first to last.
+
+    === Private Attributes ===
+    _engine:
+        The engine this session is typing into.
+    _cursor:
+        A cursor in _engine.autocompleter at the token ids of prefix, up to
+        its first element that has no token id.
+    _version:
+        The _version of _engine when _cursor was made. The cursor is made
+        again from prefix when the engine has changed since.
+    """
+    prefix: List
+    _engine: Any
+    _cursor: PrefixCursor
+    _version: int
+
+    def __init__(self, engine: Any) -> None:
+        """Initialize a session at the empty prefix of <engine>."""
+        self.prefix = []
+        self._engine = engine
+        self._cursor = engine.autocompleter.cursor()
+        self._version = engine._version
+
+    def push(self, element: Any) -> None:
+        """Add <element> to the end of this session's prefix."""
+        self._check_version()
+        self.prefix.append(element)
+        self._follow(element)
+
+    def pop(self) -> Any:
+        """Remove and return the last element of this session's prefix.
+
+        Precondition: self.prefix != []
+        """
+        self._check_version()
+        if len(self._cursor.prefix) == len(self.prefix):
+            self._cursor.pop()
+        return self.prefix.pop()
+
+    def autocomplete(self, limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for this session's prefix, as the
+        engine's autocomplete does.
+
+        Precondition: limit is None or limit > 0
+        """
+        self._check_version()
+        if len(self._cursor.prefix) < len(self.prefix):
+            # some element was never interned, so nothing matches
+            return []
+        key = (tuple(self._cursor.prefix), limit)
+        results = self._engine._cache.get(key)
+        if results is None:
+            results = self._cursor.autocomplete(limit)
+            self._engine._cache.put(key, results)
+        # a copy, so that callers cannot change the cached list
+        return list(results)
+
+    def _follow(self, element: Any) -> None:
+        """Move the cursor down by <element>, the last element of prefix,
+        if it has a token id and every element before it was followed.
+        """
+        if len(self._cursor.prefix) == len(self.prefix) - 1:
+            ids = self._engine._tokens.lookup([element])
+            if ids is not None:
+                self._cursor.push(ids[0])
+
+    def _check_version(self) -> None:
+        """Make the cursor again if the engine has changed since it was
+        made.
+        """
+        if self._version != self._engine._version:
+            self._cursor = self._engine.autocompleter.cursor()
+            self._version = self._engine._version
+            prefix = self.prefix
+            self.prefix = []
+            for element in prefix:
+                self.prefix.append(element)
+                self._follow(element)
+
+
+################################################################################
+# Melody search
+################################################################################
+class _IntervalMatcher:
+    """An automaton for MelodyAutocompleteEngine.autocomplete_approximate,
+    reading the token ids of a melody's intervals (see autocomplete_matching
+    in prefix_tree.py).
+
+    A state is the set of ways the melody's intervals read so far can line
+    up with the query: (i, used, carry) means they line up with the first i
+    intervals of the query using <used> skipped or extra notes, followed by
+    <carry> semitones of melody intervals joined across missing notes that
+    have yet to line up with anything.
+
+    === Private Attributes ===
+    _query:
+        The query's intervals.
+    _sums:
+        _sums[i] is the sum of the first i intervals of _query.
+    _tolerance:
+        The most semitones an interval may be off by.
+    _skips:
+        The most skipped or extra notes.
+    _intervals:
+        The interval of each token id.
+    """
+    _query: List[int]
+    _sums: List[int]
+    _tolerance: int
+    _skips: int
+    _intervals: List[int]
+
+    def __init__(self, query: List[int], tolerance: int, skips: int,
+                 intervals: List[int]) -> None:
+        """Initialize an automaton for <query>, whose elements are token ids
+        standing for the intervals in <intervals>.
+        """
+        self._query = query
+        self._sums = [0]
+        for interval in query:
+            self._sums.append(self._sums[-1] + interval)
+        self._tolerance = tolerance
+        self._skips = skips
+        self._intervals = intervals
+
+    def start(self) -> FrozenSet[Tuple[int, int, int]]:
+        """Return the state before any interval is read: up to _skips of
+        the query's first notes may be extra.
+        """
+        return frozenset((i, i, 0)
+                         for i in range(min(self._skips, len(self._query))
+                                        + 1))
+
+    def step(self, state: FrozenSet[Tuple[int, int, int]],
+             token: int) -> Optional[FrozenSet[Tuple[int, int, int]]]:
+        """Return the state after reading the interval of <token> in
+        <state>, or None if nothing lines up.
+        """
+        sums = self._sums
+        interval = self._intervals[token]
+        following = set()
+        for i, used, carry in state:
+            total = carry + interval
+            if used < self._skips:
+                # the note after this interval is missing from the query
+                following.add((i, used + 1, total))
+            # line up with query intervals i to j, split by j - i extra notes
+            last = min(len(self._query), i + self._skips - used + 1)
+            for j in range(i, last):
+                if abs(total - sums[j + 1] + sums[i]) <= self._tolerance:
+                    following.add((j + 1, used + j - i, 0))
+        return frozenset(following) if following else None
+
+    def accepts(self, state: FrozenSet[Tuple[int, int, int]]) -> bool:
+        """Return whether the whole query lines up in <state>, counting any
+        of its last notes left over as extra.
+        """
+        return any(len(self._query) - i <= self._skips - used
+                   for i, used, _ in state)
+
+
+class _IntervalIndex:
+    """An inverted index of the runs of intervals in melodies, for finding
+    the melodies that contain an interval sequence anywhere.
+
+    Every run of 1 to _GRAM_LENGTH consecutive intervals (an n-gram) is
+    indexed. A shorter query is looked up directly, and a longer one through
+    its rarest n-gram, checking each melody found against the whole query.
+
+    The index is kept up to date by its engine as melodies are inserted and
+    removed: a removed melody keeps its n-grams, but is skipped by find.
+
+    === Private Attributes ===
+    _matches:
+        _matches[m] is the m-th melody indexed, and its weight, or None if it
+        was removed. Ties in weight are broken by m.
+    _numbers:
+        Maps each melody indexed to its m.
+    _grams:
+        Maps each n-gram, as a tuple, to the (m, position) pairs where it
+        starts in the interval sequence of the m-th melody indexed.
+    """
+    _matches: List[Optional[Tuple[Melody, float]]]
+    _numbers: Dict[Melody, int]
+    _grams: Dict[Tuple[int, ...], List[Tuple[int, int]]]
+
+    def __init__(self, matches: List[Tuple[Melody, float]]) -> None:
+        """Initialize an index of the melodies in <matches>, in
+        non-increasing weight order.
+        """
+        self._matches = []
+        self._numbers = {}
+        self._grams = {}
+        for melody, weight in matches:
+            self.add(melody, weight)
+
+    def add(self, melody: Melody, weight: float) -> None:
+        """Add <weight> to the weight of <melody>, indexing it if it is not
+        indexed yet.
+        """
+        m = self._numbers.get(melody)
+        if m is not None:
+            if self._matches[m] is not None:
+                weight += self._matches[m][1]
+            self._matches[m] = (melody, weight)
+            return
+        m = len(self._matches)
+        self._numbers[melody] = m
+        self._matches.append((melody, weight))
+        intervals = melody.intervals()
+        for position in range(len(intervals)):
+            end = min(len(intervals), position + _GRAM_LENGTH)
+            for stop in range(position + 1, end + 1):
+                self._grams.setdefault(tuple(intervals[position:stop]),
+                                       []).append((m, position))
+
+    def discard(self, melodies: Iterable[Melody]) -> None:
+        """Leave each of <melodies> out of the results of find."""
+        for melody in melodies:
+            self._matches[self._numbers[melody]] = None
+
+    def find(self, query: List[int],
+             limit: Optional[int]) -> List[Tuple[Melody, float]]:
+        """Return up to <limit> of the (melody, weight) pairs whose interval
+        sequence contains <query>, in non-increasing weight order.
+        """
+        if not query:
+            found = range(len(self._matches))
+        elif len(query) <= _GRAM_LENGTH:
+            found = {m for m, _ in self._grams.get(tuple(query), [])}
+        else:
+            offset = min(range(len(query) - _GRAM_LENGTH + 1),
+                         key=lambda i: len(self._grams.get(
+                             tuple(query[i:i + _GRAM_LENGTH]), [])))
+            found = set()
+            for m, position in self._grams.get(
+                    tuple(query[offset:offset + _GRAM_LENGTH]), []):
+                start = position - offset
+                if start < 0 or m in found or self._matches[m] is None:
+                    continue
+                # the intervals are worked out again rather than kept here,
+                # so that melodies stay the only copy of their notes
+                intervals = self._matches[m][0].intervals()
+                if intervals[start:start + len(query)] == query:
+                    found.add(m)
+        matches = self._matches
+        found = [m for m in found if matches[m] is not None]
+        if limit is None or limit >= len(found):
+            found.sort(key=lambda m: (-matches[m][1], m))
+        else:
+            found = heapq.nsmallest(limit, found,
+                                    key=lambda m: (-matches[m][1], m))
+        return [matches[m] for m in found]
+
+
+# The longest runs of intervals indexed by _IntervalIndex.
+_GRAM_LENGTH = 3
+
+
+################################################################################
+# Input pipeline
+################################################################################
+# The engines stream their input files through these generators, from reading
+# (_read_*), through sanitization (_sanitized), to (value, weight, prefix)
+# items. Their prefix elements are then replaced by token ids (_interned), and
+# the prefix tree's from_items adds up duplicate values and builds the tree,
+# so the engines never hold a list of every input line.
+
+# Every character that is not alphanumeric or a space. (\w matches exactly the
+# characters for which str.isalnum() is true, plus '_'.)
+_UNSANITARY = re.compile(r'[^\w ]|_')
+
+
+class _TokenTable:
+    """A table of token ids for prefix elements.
+
+    Each distinct element gets the next unused id, starting from 0, the first
+    time it is interned. Trees built from ids compare small ints at every
+    tree instead of strings or large ints, and every prefix holding an
+    element shares its one id object.
+
+    === Private Attributes ===
+    _ids:
+        Maps each interned element to its id.
+    _sorted:
+        The interned elements in sorted order, with their ids, for
+        starting_with. It is sorted by the first starting_with, and from then
+        on intern adds each new element in its place.
+    _elements:
+        The interned elements in id order, for elements. It is listed
+        again once elements have been added.
+    """
+    _ids: Dict[Any, int]
+    _sorted: List[Tuple[Any, int]]
+    _elements: List
+
+    def __init__(self) -> None:
+        """Initialize an empty token table."""
+        self._ids = {}
+        self._sorted = []
+        self._elements = []
+
+    def intern(self, prefix: List) -> List[int]:
+        """Return the ids of the elements of <prefix>, giving new ids to
+        elements that have none yet.
+        """
+        ids = self._ids
+        if not self._sorted:
+            return [ids.setdefault(element, len(ids)) for element in prefix]
+        result = []
+        for element in prefix:
+            token = ids.get(element)
+            if token is None:
+                token = ids[element] = len(ids)
+                insort(self._sorted, (element, token))
+            result.append(token)
+        return result
+
+    def lookup(self, prefix: List) -> Optional[List[int]]:
+        """Return the ids of the elements of <prefix>, or None if one of them
+        was never interned (so no stored prefix can start with <prefix>).
+        """
+        ids = self._ids
+        try:
+            return [ids[element] for element in prefix]
+        except KeyError:
+            return None
+
+    def lookup_known(self, prefix: List) -> List[int]:
+        """Return the ids of the elements of <prefix>, with -1, which equals
+        no element of a stored prefix, for each one that was never interned.
+        """
+        ids = self._ids
+        return [ids.get(element, -1) for element in prefix]
+
+    def starting_with(self, text: str) -> List[int]:
+        """Return the ids of the interned strings that start with <text>.
+
+        Precondition: every interned element is a string.
+        """
+        if len(self._sorted) != len(self._ids):
+            self._sorted = sorted(self._ids.items())
+        start = bisect_left(self._sorted, (text,))
+        end = bisect_left(self._sorted, (text + _LAST_CHARACTER,))
+        return [token for _, token in self._sorted[start:end]]
+
+    def elements(self) -> List:
+        """Return the interned elements, indexed by their ids."""
+        if len(self._elements) != len(self._ids):
+            self._elements = list(self._ids)
+        return self._elements
+
+
+# Greater than every character in a sanitized string, so every string that
+# starts with some text sorts before that text followed by this.
+_LAST_CHARACTER = chr(sys.maxunicode)
+
+
+def _interned(items: Iterable[Tuple[Any, float, List]],
+              tokens: _TokenTable) -> Iterator[Tuple[Any, float, List[int]]]:
+    """Yield each item in <items> with its prefix interned in <tokens>."""
+    for value, weight, prefix in items:
+        yield value, weight, tokens.intern(prefix)
+
+
+def _build_tree(config: Dict[str, Any],
+                items: Iterable[Tuple[Any, float, List]]) -> Autocompleter:
+    """Return the prefix tree described by the engine <config>, holding
+    <items>.
+
+    Raise ValueError if <config> asks for top-k lists ('top_k') on a tree
+    that cannot store them.
+    """
+    if config.get('top_k') \
+            and config['autocompleter'] not in ('simple', 'compressed'):
+        raise ValueError(f"'top_k' needs a 'simple' or 'compressed' "
+                         f"autocompleter, not {config['autocompleter']!r}")
+    if config['autocompleter'] == 'simple':
+        tree_type = SimplePrefixTree
+    elif config['autocompleter'] == 'compact':
+        tree_type = CompactPrefixTree
+    elif config['autocompleter'] == 'array':
+        tree_type = ArrayPrefixTree
+    else:
+        tree_type = CompressedPrefixTree
+    tree = tree_type.from_items(config['weight_type'], items,
+                                config.get('workers', 1))
+    if config.get('top_k'):
+        tree.materialize_top(config['top_k'], config.get('top_k_depth', 3))
+    return tree
+
+
+def _sanitize(string: str) -> str:
+    """Return <string> sanitized: stripped of surrounding whitespace and of
+    every character that is not alphanumeric or a space, then lowercased.
+    """
+    return _UNSANITARY.sub('', string.strip()).lower()
+
+
+def _read_lines(path: str) -> Iterator[Tuple[str, float]]:
+    """Yield (line, 1) for each line of the text file at <path>."""
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            yield line, 1
+
+
+def _read_weighted_lines(path: str) -> Iterator[Tuple[str, float]]:
+    """Yield (string, weight) for each line of the CSV file at <path>."""
+    with open(path) as f:
+        for line in csv.reader(f):
+            if line:
+                yield line[0], float(line[1])
+
+
+def _sanitized(lines: Iterable[Tuple[str, float]]) \
+        -> Iterator[Tuple[str, float]]:
+    """Yield each (string, weight) in <lines> with the string sanitized,
+    skipping strings without any alphanumeric characters.
+    """
+    for string, weight in lines:
+        string = _sanitize(string)
+        if string.strip():
+            yield string, weight
+
+
+def _word_items(lines: Iterable[Tuple[str, float]]) \
+        -> Iterator[Tuple[str, float, List[str]]]:
+    """Yield an item for each (string, weight) in <lines>, whose prefix is the
+    list of words in the string.
+    """
+    for string, weight in lines:
+        yield string, weight, string.split()
+
+
+def _letter_items(lines: Iterable[Tuple[str, float]]) \
+        -> Iterator[Tuple[str, float, List[str]]]:
+    """Yield an item for each (string, weight) in <lines>, whose prefix is the
+    list of characters in the string.
+    """
+    for string, weight in lines:
+        yield string, weight, list(string)
+
+
+def _read_melodies(path: str) -> Iterator[Tuple[Melody, float, List[int]]]:
+    """Yield an item for each melody in the CSV file at <path>, whose prefix
+    is the melody's interval sequence.
+
+    Each melody's notes are packed straight from the numbers on its line.
+    """
+    with open(path) as f:
+        for line in csv.reader(f):
+            if line:
+                numbers = line[1:]
+                if '' in numbers:
+                    numbers = numbers[:numbers.index('')]
+                # a pitch without a duration is left out
+                del numbers[len(numbers) - len(numbers) % 2:]
+                melody = Melody.from_numbers(line[0], map(int, numbers))
+                yield melody, 1, melody.intervals()
 
 
 ###############################################################################
@@ -321,7 +1308,7 @@ if __name__ == '__main__':
     import python_ta
     python_ta.check_all(config={
         'allowed-io': ['__init__'],
-        'extra-imports': ['csv', 'prefix_tree', 'melody']
+        'extra-imports': ['csv', 're', 'prefix_tree', 'melody']
     })
 
     # This is used to increase the recursion limit so that your sample runs
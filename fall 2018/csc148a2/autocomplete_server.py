@@ -0,0 +1,363 @@
+"""CSC148 Assignment 2: Autocomplete server
+
+=== CSC148 Fall 2018 ===
+Department of Computer Science,
+University of Toronto
+
+=== Module description ===
+This file serves the autocomplete engines over TCP with a line protocol, and
+contains a load generator for trying the server out on this machine.
+
+Each request is one line holding a JSON object, for example
+
+    {"engine": "letter", "prefix": "frodo d", "limit": 10}
+
+where "engine" names one of the server's engines, "prefix" is a string for a
+text engine or a list of intervals for the melody engine, and "limit" may be
+left out (or null) for every match. Each response is one line holding either
+a JSON list of [value, weight] pairs, with melodies given by their names, or
+a JSON object {"error": message}.
+
+A client may send many requests without waiting for their responses
+(pipelining). Responses come back in the order of the requests. Requests on
+one connection that arrive within a short window of each other are answered
+together, with one autocomplete_many call for each engine and limit.
+
+Run it from the csc148a2 directory to load the engines, start a server on
+localhost and run the load generator against it:
+
+    python autocomplete_server.py
+
+Note: this file is for support purposes only, and is not part of your
+submission.
+"""
+from __future__ import annotations
+import asyncio
+import gc
+import json
+import random
+import time
+from collections import deque
+from itertools import takewhile
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from autocomplete_engines import LetterAutocompleteEngine, \
+    SentenceAutocompleteEngine, MelodyAutocompleteEngine
+from melody import Melody
+
+
+def load_engines(autocompleter: str = 'compressed') -> Dict[str, Any]:
+    """Return the three engines, built from the sample data with the given
+    kind of autocompleter, keyed by the names used in requests.
+    """
+    config = {'autocompleter': autocompleter, 'weight_type': 'sum',
+              'cache_size': 1024}
+    return {
+        'letter': LetterAutocompleteEngine(
+            dict(config, file='data/lotr.txt')),
+        'sentence': SentenceAutocompleteEngine(
+            dict(config, file='data/google_searches.csv')),
+        'melody': MelodyAutocompleteEngine(
+            dict(config, file='data/songbook.csv'))
+    }
+
+
+class AutocompleteServer:
+    """A line protocol server for autocomplete engines.
+
+    === Attributes ===
+    engines:
+        The engines served, keyed by the names used in requests.
+    window:
+        The number of seconds to wait for more requests after one arrives,
+        so that they can be answered together. With 0, the requests that
+        have arrived are answered as soon as they are read.
+    max_batch:
+        The most requests answered together.
+    max_line:
+        The longest request line accepted, in bytes. A client that sends a
+        longer one gets an error response and is disconnected.
+    """
+    engines: Dict[str, Any]
+    window: float
+    max_batch: int
+    max_line: int
+
+    def __init__(self, engines: Dict[str, Any], window: float = 0.0,
+                 max_batch: int = 256, max_line: int = 1 << 16) -> None:
+        """Initialize a server for <engines>."""
+        self.engines = engines
+        self.window = window
+        self.max_batch = max_batch
+        self.max_line = max_line
+
+    async def start(self, host: str = '127.0.0.1',
+                    port: int = 0) -> asyncio.AbstractServer:
+        """Start serving on <host> and <port>, and return the running
+        asyncio server. Port 0 picks any free port.
+        """
+        return await asyncio.start_server(self._serve, host, port)
+
+    def answer(self, lines: List[bytes]) -> List[bytes]:
+        """Return the response line for each request line in <lines>.
+
+        A request that cannot be answered, because it is invalid or because
+        its engine failed, gets an error response; the others are answered
+        as usual.
+        """
+        responses = [b''] * len(lines)
+        # (engine name, limit) -> [(index of the request, prefix)]
+        groups = {}
+        for i, line in enumerate(lines):
+            try:
+                name, prefix, limit = self._parse(line)
+            except (ValueError, KeyError, TypeError) as error:
+                responses[i] = _encode({'error': str(error)})
+            else:
+                groups.setdefault((name, limit), []).append((i, prefix))
+        for (name, limit), requests in groups.items():
+            try:
+                found = self.engines[name].autocomplete_many(
+                    [prefix for _, prefix in requests], limit)
+                answers = [_encode([[_name(value), weight]
+                                    for value, weight in matches])
+                           for matches in found]
+            except Exception as error:
+                # one failing engine must not take the connection down
+                answers = [_encode({'error': f'{type(error).__name__}: '
+                                             f'{error}'})] * len(requests)
+            for (i, _), response in zip(requests, answers):
+                responses[i] = response
+        return responses
+
+    def _parse(self, line: bytes) -> Tuple[str, Any, Optional[int]]:
+        """Return the engine name, prefix and limit of the request <line>.
+
+        Raise ValueError, KeyError or TypeError if it is not a valid request.
+        """
+        request = json.loads(line)
+        name = request['engine']
+        if name not in self.engines:
+            raise KeyError(f'no engine named {name!r}')
+        prefix = request['prefix']
+        if isinstance(self.engines[name], MelodyAutocompleteEngine):
+            if not isinstance(prefix, list) \
+                    or not all(_is_int(x) for x in prefix):
+                raise TypeError('a melody prefix is a list of intervals')
+        elif not isinstance(prefix, str):
+            raise TypeError('a text prefix is a string')
+        limit = request.get('limit')
+        if limit is not None and (not _is_int(limit) or limit <= 0):
+            raise ValueError('limit must be a positive integer or null')
+        return name, prefix, limit
+
+    async def _serve(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Answer the requests on one connection until it is closed.
+
+        Everything the client has sent so far is read at once, so a batch
+        holds every complete request line in it, plus those that arrive
+        within self.window seconds. The connection is closed after an error
+        response once a request line grows past self.max_line bytes.
+        """
+        # the start of a request line whose end has not arrived yet
+        partial = b''
+        try:
+            while True:
+                data = await reader.read(_READ_SIZE)
+                if not data:
+                    break
+                data = partial + data + await self._gather(reader)
+                lines = data.split(b'\n')
+                partial = lines.pop()
+                too_long = len(partial) > self.max_line \
+                    or any(len(line) > self.max_line for line in lines)
+                if too_long:
+                    # answer the lines before the first long one, then stop
+                    lines = list(takewhile(
+                        lambda line: len(line) <= self.max_line, lines))
+                for start in range(0, len(lines), self.max_batch):
+                    writer.write(b''.join(
+                        self.answer(lines[start:start + self.max_batch])))
+                if too_long:
+                    writer.write(_encode({'error': f'request line longer '
+                                                   f'than {self.max_line} '
+                                                   f'bytes'}))
+                    await writer.drain()
+                    break
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _gather(self, reader: asyncio.StreamReader) -> bytes:
+        """Return what arrives on <reader> within self.window seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        chunks = []
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(reader.read(_READ_SIZE),
+                                              timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+        return b''.join(chunks)
+
+
+# The most bytes read from a connection at once.
+_READ_SIZE = 1 << 16
+
+
+def _is_int(x: Any) -> bool:
+    """Return whether the JSON value <x> is an integer (and not a boolean,
+    which is an int to Python).
+    """
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def _name(value: Any) -> Any:
+    """Return <value> as it is sent in a response: a melody by its name."""
+    return value.name if isinstance(value, Melody) else value
+
+
+def _encode(response: Any) -> bytes:
+    """Return the response line holding <response> as JSON."""
+    return json.dumps(response).encode() + b'\n'
+
+
+################################################################################
+# Load generator
+################################################################################
+class LoadReport(NamedTuple):
+    """The results of a load test.
+
+    Latencies are in milliseconds, from sending a request to reading its
+    response.
+    """
+    requests: int
+    errors: int
+    seconds: float
+    qps: float
+    p50: float
+    p99: float
+
+
+async def load_test(host: str, port: int, requests: List[Dict[str, Any]],
+                    connections: int = 8, pipeline: int = 32) -> LoadReport:
+    """Send <requests> to the server at <host> and <port>, spread over
+    <connections> connections with up to <pipeline> requests waiting for
+    their responses on each, and return how it went.
+    """
+    latencies = []
+    errors = []
+
+    async def client(share: List[Dict[str, Any]]) -> None:
+        """Send the requests in <share> on one connection."""
+        reader, writer = await asyncio.open_connection(host, port)
+        sent = deque()
+        slots = asyncio.Semaphore(pipeline)
+
+        async def send() -> None:
+            """Send each request once fewer than <pipeline> are waiting."""
+            for request in share:
+                await slots.acquire()
+                sent.append(time.perf_counter())
+                writer.write(_encode(request))
+                await writer.drain()
+
+        sender = asyncio.create_task(send())
+        for _ in share:
+            line = await reader.readline()
+            latencies.append(time.perf_counter() - sent.popleft())
+            if line.startswith(b'{'):
+                errors.append(line)
+            slots.release()
+        await sender
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(requests[i::connections])
+                           for i in range(connections)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return LoadReport(len(requests), len(errors), seconds,
+                      len(requests) / seconds,
+                      _percentile(latencies, 0.5) * 1e3,
+                      _percentile(latencies, 0.99) * 1e3)
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    """Return the value at <fraction> of the way through <ordered>."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def sample_requests(engines: Dict[str, Any], count: int,
+                    seed: int = 148) -> List[Dict[str, Any]]:
+    """Return <count> requests for short prefixes of values stored in
+    <engines>, the heaviest values being the most likely.
+
+    The k-th heaviest value of each engine is picked with weight 1 / k (a
+    Zipf distribution), and then one of its prefixes of 1 to 8 elements.
+    """
+    rng = random.Random(seed)
+    prefixes = []
+    weights = []
+    for name, engine in engines.items():
+        for k, (value, _) in enumerate(engine.autocomplete(
+                '' if name != 'melody' else [], 500)):
+            if isinstance(value, Melody):
+                sequence = value.intervals()
+            else:
+                sequence = value
+            lengths = range(1, min(len(sequence), 8) + 1)
+            for n in lengths:
+                prefixes.append((name, sequence[:n]))
+                weights.append(1 / ((k + 1) * len(lengths)))
+    return [{'engine': name, 'prefix': prefix, 'limit': 10}
+            for name, prefix in rng.choices(prefixes, weights, k=count)]
+
+
+async def _main() -> None:
+    """Serve the sample engines on localhost, and load test them one
+    request at a time, in batches of what has arrived, and with a batching
+    window.
+    """
+    requests = None
+    for window, max_batch in [(0.0, 1), (0.0, 256), (0.001, 256)]:
+        # fresh engines, so that every run starts with empty caches
+        engines = load_engines()
+        # the engines' trees live until the end of the run, so keep the
+        # collector from walking them again and again while serving
+        gc.collect()
+        gc.freeze()
+        if requests is None:
+            requests = sample_requests(engines, 20000)
+        server = await AutocompleteServer(engines, window, max_batch).start()
+        port = server.sockets[0].getsockname()[1]
+        report = await load_test('127.0.0.1', port, requests)
+        server.close()
+        await server.wait_closed()
+        # let this run's engines be collected before the next are loaded
+        del engines, server
+        gc.unfreeze()
+        gc.collect()
+        print(f'window {window * 1e3:3.1f} ms, batches of {max_batch:3}: '
+              f'{report.qps:8.0f} queries/s, '
+              f'p50 {report.p50:6.2f} ms, p99 {report.p99:6.2f} ms, '
+              f'{report.errors} errors')
+
+
+if __name__ == '__main__':
+    import sys
+    sys.setrecursionlimit(10000)
+    asyncio.run(_main())
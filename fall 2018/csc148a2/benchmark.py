@@ -0,0 +1,824 @@
+"""CSC148 Assignment 2: Benchmarks
+
+=== CSC148 Fall 2018 ===
+Department of Computer Science,
+University of Toronto
+
+=== Module description ===
+This file contains some timing benchmarks for the prefix trees and the
+autocomplete engines. Run it from the csc148a2 directory so that the paths
+under data/ resolve, e.g.
+
+    python benchmark.py
+
+Note: this file is for support purposes only, and is not part of your
+submission.
+"""
+from __future__ import annotations
+import csv
+import gc
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+from autocomplete_engines import LetterAutocompleteEngine, \
+    SentenceAutocompleteEngine, MelodyAutocompleteEngine, _sanitize, \
+    _sanitized, _read_lines, _interned, _TokenTable, _read_melodies
+from melody import create_midi_file, midi_cache_info
+from prefix_tree import SimplePrefixTree, CompressedPrefixTree, Autocompleter, \
+    FrozenPrefixTree, CompactPrefixTree, ConcurrentAutocompleter, _fuzzy_search
+
+TREES = {
+    'simple': SimplePrefixTree,
+    'compressed': CompressedPrefixTree
+}
+
+
+def read_lines(path: str) -> List[str]:
+    """Return the sanitized, non-empty lines of the text file at <path>."""
+    lines = []
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            line = ''.join(c for c in line.strip() if c.isalnum() or c == ' ')
+            line = line.lower()
+            if line:
+                lines.append(line)
+    return lines
+
+
+def timed(func: Callable[[], object]) -> float:
+    """Return the number of seconds it takes to call <func>."""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def build(tree_type: str, weight_type: str,
+          lines: List[str]) -> Tuple[Autocompleter, float]:
+    """Return a tree of <tree_type> holding <lines>, and its build time."""
+    tree = TREES[tree_type](weight_type)
+
+    def load() -> None:
+        """Insert every line into the tree."""
+        for line in lines:
+            tree.insert(line, 1, list(line))
+    return tree, timed(load)
+
+
+def bench_insert_query(path: str = 'data/google_no_swears.txt') -> None:
+    """Print insert and query throughput for both prefix trees on <path>.
+
+    Queries are every distinct two-letter prefix of the inserted lines,
+    with a limit of 10.
+    """
+    lines = read_lines(path)
+    queries = sorted({line[:2] for line in lines})
+    for tree_type in TREES:
+        for weight_type in ['sum', 'average']:
+            tree, seconds = build(tree_type, weight_type, lines)
+            query_seconds = timed(
+                lambda: [tree.autocomplete(list(q), 10) for q in queries])
+            print(f'{tree_type:>10} {weight_type:>7}: '
+                  f'{len(lines) / seconds:10.0f} inserts/s '
+                  f'{len(queries) / query_seconds:10.0f} queries/s')
+
+
+def bench_letter_query(prefix: str = 'frodo d', limit: int = 20,
+                       repeat: int = 1000) -> None:
+    """Print the mean latency of one letter engine query on data/lotr.txt."""
+    for tree_type in TREES:
+        for weight_type in ['sum', 'average']:
+            engine = LetterAutocompleteEngine({
+                'file': 'data/lotr.txt',
+                'autocompleter': tree_type,
+                'weight_type': weight_type
+            })
+            seconds = timed(
+                lambda: [engine.autocomplete(prefix, limit)
+                         for _ in range(repeat)])
+            print(f'{tree_type:>10} {weight_type:>7}: '
+                  f'{seconds / repeat * 1e6:8.1f} us per '
+                  f'autocomplete({prefix!r}, {limit})')
+
+
+def bench_search(path: str = 'data/google_no_swears.txt',
+                 limit: int = 10) -> None:
+    """Print the latency of both autocomplete search modes on <path>.
+
+    Every single-letter prefix is queried; these have the most matches.
+    """
+    lines = read_lines(path)
+    queries = sorted({line[0] for line in lines})
+    for tree_type in TREES:
+        for weight_type in ['sum', 'average']:
+            tree, _ = build(tree_type, weight_type, lines)
+            for search in ['best-first', 'depth-first']:
+                seconds = timed(
+                    lambda: [tree.autocomplete([q], limit, search)
+                             for q in queries])
+                print(f'{tree_type:>10} {weight_type:>7} {search:>11}: '
+                      f'{seconds / len(queries) * 1e6:8.1f} us per query')
+
+
+def bench_load(paths: Tuple[str, ...] = ('data/lotr.txt',
+                                         'data/google_no_swears.txt')) -> None:
+    """Print the time it takes the letter engine to load each of <paths>."""
+    for path in paths:
+        for tree_type in TREES:
+            for weight_type in ['sum', 'average']:
+                seconds = timed(lambda: LetterAutocompleteEngine({
+                    'file': path,
+                    'autocompleter': tree_type,
+                    'weight_type': weight_type
+                }))
+                print(f'{path:>26} {tree_type:>10} {weight_type:>7}: '
+                      f'{seconds:6.2f} s to load')
+
+
+def bench_bulk_build(paths: Tuple[str, ...] = (
+        'data/lotr.txt', 'data/google_no_swears.txt')) -> None:
+    """Print the time to build each tree from <paths> by inserting one line at
+    a time, and with from_items.
+    """
+    for path in paths:
+        lines = read_lines(path)
+        items = [(line, 1, list(line)) for line in lines]
+        for tree_type, tree_class in TREES.items():
+            _, insert_seconds = build(tree_type, 'sum', lines)
+            bulk_seconds = timed(lambda: tree_class.from_items('sum', items))
+            print(f'{path:>26} {tree_type:>10}: {insert_seconds:6.2f} s '
+                  f'inserting, {bulk_seconds:6.2f} s from_items')
+
+
+def bench_ingest() -> None:
+    """Print the lines per second each engine loads from the bundled data,
+    and of the old and new sanitizers on their own.
+    """
+    runs = [(LetterAutocompleteEngine, 'data/lotr.txt'),
+            (LetterAutocompleteEngine, 'data/google_no_swears.txt'),
+            (SentenceAutocompleteEngine, 'data/google_searches.csv'),
+            (MelodyAutocompleteEngine, 'data/songbook.csv'),
+            (MelodyAutocompleteEngine, 'data/random_melodies_c_scale.csv')]
+    for engine, path in runs:
+        with open(path, encoding='utf8') as f:
+            count = sum(1 for _ in f)
+        seconds = timed(lambda: engine({
+            'file': path,
+            'autocompleter': 'compressed',
+            'weight_type': 'sum'
+        }))
+        print(f'{engine.__name__:>26} {path:>34}: '
+              f'{count / seconds:10.0f} lines/s')
+
+    with open('data/lotr.txt', encoding='utf8') as f:
+        lines = f.readlines()
+
+    def old_sanitize() -> None:
+        """Sanitize every line with a filter and a lambda."""
+        for line in lines:
+            line = line.strip()
+            line = list(filter(lambda c: c.isalnum() or c == ' ', line))
+            ''.join(line).lower()
+
+    def new_sanitize() -> None:
+        """Sanitize every line with the engines' sanitizer."""
+        for line in lines:
+            _sanitize(line)
+    for name, func in [('filter', old_sanitize), ('regex', new_sanitize)]:
+        print(f'sanitize with {name:>6}: '
+              f'{len(lines) / timed(func):10.0f} lines/s')
+
+
+def bench_parallel_build(path: str = 'data/lotr.txt',
+                         workers: Tuple[int, ...] = (1, 2, 4)) -> None:
+    """Print the letter engine load time for <path> with each number of
+    worker processes.
+    """
+    for tree_type in TREES:
+        for count in workers:
+            seconds = timed(lambda: LetterAutocompleteEngine({
+                'file': path,
+                'autocompleter': tree_type,
+                'weight_type': 'sum',
+                'workers': count
+            }))
+            print(f'{tree_type:>10} {count:2} workers: {seconds:6.2f} s')
+
+
+def bench_snapshot() -> None:
+    """Print the time to build each engine's tree from its data file, and to
+    load the same tree from a snapshot instead.
+    """
+    runs = [(LetterAutocompleteEngine, 'data/lotr.txt'),
+            (SentenceAutocompleteEngine, 'data/google_searches.csv')]
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, 'tree.pfxt')
+        for engine_type, path in runs:
+            for tree_type, tree_class in TREES.items():
+                config = {
+                    'file': path,
+                    'autocompleter': tree_type,
+                    'weight_type': 'sum'
+                }
+                # keep what is built alive, so that freeing it is not timed
+                built = []
+                build_seconds = timed(
+                    lambda: built.append(engine_type(config)))
+                built.pop().autocompleter.save(snapshot)
+                load_seconds = timed(
+                    lambda: built.append(tree_class.load(snapshot)))
+                built.clear()
+                print(f'{path:>26} {tree_type:>10}: {build_seconds:6.2f} s '
+                      f'cold build, {load_seconds:6.2f} s snapshot load '
+                      f'({os.path.getsize(snapshot) / 1e6:.1f} MB)')
+
+
+def bench_frozen(path: str = 'data/lotr.txt', limit: int = 10) -> None:
+    """Compare a CompressedPrefixTree built from <path> with a frozen copy
+    of it: Python heap bytes held, and latency of single-letter queries.
+    """
+    lines = read_lines(path)
+    queries = sorted({line[0] for line in lines})
+    items = [(line, 1, list(line)) for line in lines]
+    with tempfile.TemporaryDirectory() as directory:
+        frozen_path = os.path.join(directory, 'tree.pfxf')
+        tracemalloc.start()
+        tree = CompressedPrefixTree.from_items('sum', items)
+        tree_bytes = tracemalloc.get_traced_memory()[0]
+        FrozenPrefixTree.write(tree, frozen_path)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        frozen = FrozenPrefixTree(frozen_path)
+        frozen_bytes = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f'compressed tree: {tree_bytes / 1e6:8.1f} MB of Python heap')
+        print(f'frozen tree:     {frozen_bytes / 1e6:8.1f} MB of Python heap, '
+              f'{os.path.getsize(frozen_path) / 1e6:.1f} MB shared file')
+        gc.collect()
+        for name, autocompleter in [('compressed', tree), ('frozen', frozen)]:
+            # one untimed pass first, so that both are timed with warm caches
+            for query in queries:
+                autocompleter.autocomplete([query], limit)
+            seconds = timed(lambda: [autocompleter.autocomplete([q], limit)
+                                     for q in queries])
+            print(f'{name:>10}: {seconds / len(queries) * 1e6:8.1f} us per '
+                  f'query')
+        frozen.close()
+
+
+def bench_memory(path: str = 'data/google_no_swears.txt') -> None:
+    """Print the Python heap bytes per stored value of each prefix tree
+    built from <path>, and the peak while building it.
+    """
+    lines = read_lines(path)
+    items = [(line, 1, list(line)) for line in lines]
+    trees = dict(TREES, compact=CompactPrefixTree)
+    for tree_type, tree_class in trees.items():
+        gc.collect()
+        tracemalloc.start()
+        tree = tree_class.from_items('sum', items)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{tree_type:>10}: {current / len(tree):8.0f} bytes per value, '
+              f'{peak / 1e6:6.1f} MB peak')
+        del tree
+
+
+def bench_engines(limit: int = 10) -> None:
+    """Print each engine's load time and mean query latency with the simple,
+    compressed and array prefix trees.
+
+    The queries are every prefix of length 1 or 2 that has a match.
+    """
+    runs = [(LetterAutocompleteEngine, 'data/lotr.txt'),
+            (SentenceAutocompleteEngine, 'data/google_searches.csv'),
+            (MelodyAutocompleteEngine, 'data/songbook.csv')]
+    for engine_type, path in runs:
+        queries = None
+        for tree_type in ['simple', 'compressed', 'array']:
+            built = []
+            load_seconds = timed(lambda: built.append(engine_type({
+                'file': path,
+                'autocompleter': tree_type,
+                'weight_type': 'sum'
+            })))
+            tree = built.pop().autocompleter
+            if queries is None:
+                # the simple tree lists every prefix as a subtree value
+                queries = [s.value for s in tree.subtrees if s.subtrees]
+                queries += [s.value for q in list(tree.subtrees)
+                            for s in q.subtrees if s.subtrees]
+            query_seconds = timed(
+                lambda: [tree.autocomplete(q, limit) for q in queries])
+            print(f'{engine_type.__name__:>26} {tree_type:>10}: '
+                  f'{load_seconds:6.2f} s to load, '
+                  f'{query_seconds / len(queries) * 1e6:8.1f} us per query')
+
+
+def bench_interning(path: str = 'data/lotr.txt', limit: int = 10) -> None:
+    """Print the heap bytes per value, including the prefix elements, and the
+    query latency of compressed trees built from <path> with raw and with
+    interned prefixes, where prefixes are lists of characters or of words.
+    """
+    lines = list(_sanitized(_read_lines(path)))
+    for split in ['characters', 'words']:
+        for interned in [False, True]:
+            gc.collect()
+            tracemalloc.start()
+            tokens = _TokenTable()
+            if split == 'characters':
+                items = ((line, weight, list(line)) for line, weight in lines)
+            else:
+                items = ((line, weight, line.split()) for line, weight in lines)
+            if interned:
+                items = _interned(items, tokens)
+            tree = CompressedPrefixTree.from_items('sum', items)
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            queries = [s.value for s in tree.subtrees if s.subtrees]
+            # one untimed pass first, so that the tree is in the caches
+            for query in queries:
+                tree.autocomplete(query, limit)
+            seconds = timed(
+                lambda: [tree.autocomplete(q, limit) for q in queries])
+            name = 'interned' if interned else 'raw'
+            print(f'{split:>10} {name:>8}: {current / len(tree):6.0f} bytes '
+                  f'per value, {seconds / len(queries) * 1e6:8.1f} us per '
+                  f'query')
+            del tree, tokens
+
+
+def bench_cache(path: str = 'data/google_searches.csv', queries: int = 20000,
+                cache_size: int = 256, limit: int = 10) -> None:
+    """Print the sentence engine's query throughput on <path> with and
+    without a cache of <cache_size> results.
+
+    The queries are prefixes of the stored sentences, drawn so that the k-th
+    most popular one is asked about 1/k times as often as the first.
+    """
+    config = {'file': path, 'autocompleter': 'compressed',
+              'weight_type': 'sum'}
+    engine = SentenceAutocompleteEngine(config)
+    sentences = [value for value, _ in engine.autocomplete('')]
+    popular = sorted({s[:n] for s in sentences for n in range(2, 9)})
+    rng = random.Random(0)
+    rng.shuffle(popular)
+    stream = rng.choices(popular, weights=[1 / (k + 1) for k in
+                                           range(len(popular))], k=queries)
+    for size in [0, cache_size]:
+        engine = SentenceAutocompleteEngine(dict(config, cache_size=size))
+        seconds = timed(lambda: [engine.autocomplete(q, limit)
+                                 for q in stream])
+        info = engine.cache_info()
+        print(f'cache_size {size:5}: {queries / seconds:10.0f} queries/s, '
+              f'{info.hits / queries:6.1%} hits')
+
+
+def bench_materialized_top(path: str = 'data/lotr.txt', k: int = 10,
+                           depth: int = 3) -> None:
+    """Print the latency of autocomplete on every prefix of 1 to <depth>
+    letters of the lines in <path>, with and without materialize_top(k,
+    depth), and the time to insert every line once more in each case.
+    """
+    lines = read_lines(path)
+    items = [(line, 1, list(line)) for line in lines]
+    queries = sorted({tuple(line[:n]) for line in lines
+                      for n in range(1, depth + 1)})
+    queries = [list(q) for q in queries]
+    for tree_type, tree_class in TREES.items():
+        for materialized in [False, True]:
+            tree = tree_class.from_items('sum', items)
+            if materialized:
+                tree.materialize_top(k, depth)
+            for query in queries:
+                tree.autocomplete(query, k)
+            seconds = timed(lambda: [tree.autocomplete(q, k)
+                                     for q in queries])
+            insert_seconds = timed(
+                lambda: [tree.insert(*item) for item in items])
+            name = 'top lists' if materialized else 'search'
+            print(f'{tree_type:>10} {name:>9}: '
+                  f'{seconds / len(queries) * 1e6:8.1f} us per query, '
+                  f'{insert_seconds / len(items) * 1e6:8.1f} us per insert')
+            del tree
+
+
+def bench_autocomplete_many(path: str = 'data/lotr.txt', batch: int = 500,
+                            k: int = 10) -> None:
+    """Print the latency per prefix of answering batches of <batch>
+    keystroke prefixes of the lines in <path>, with autocomplete in a loop and
+    with one autocomplete_many call per batch.
+    """
+    lines = read_lines(path)
+    items = [(line, 1, list(line)) for line in lines]
+    rng = random.Random(148)
+    queries = [list(line[:n]) for line in rng.sample(lines, batch)
+               for n in range(1, min(len(line), 10) + 1)]
+    rng.shuffle(queries)
+    batches = [queries[i:i + batch] for i in range(0, len(queries), batch)]
+    for tree_type, tree_class in TREES.items():
+        tree = tree_class.from_items('sum', items)
+
+        def loop() -> None:
+            """Answer every batch one prefix at a time."""
+            for prefixes in batches:
+                for prefix in prefixes:
+                    tree.autocomplete(prefix, k)
+
+        def many() -> None:
+            """Answer every batch with one call."""
+            for prefixes in batches:
+                tree.autocomplete_many(prefixes, k)
+
+        many()
+        gc.collect()
+        loop_seconds = timed(loop)
+        gc.collect()
+        many_seconds = timed(many)
+        print(f'{tree_type:>10}: loop '
+              f'{loop_seconds / len(queries) * 1e6:8.1f} us, batched '
+              f'{many_seconds / len(queries) * 1e6:8.1f} us per prefix')
+        del tree
+
+
+def bench_session(path: str = 'data/google_searches.csv', lines: int = 300,
+                  limit: int = 10) -> None:
+    """Print the sentence engine's latency per keystroke when typing
+    <lines> of its sentences in full, with autocomplete on each prefix and
+    with a session.
+    """
+    for tree_type in ['simple', 'compressed', 'array']:
+        engine = SentenceAutocompleteEngine({
+            'file': path, 'autocompleter': tree_type, 'weight_type': 'sum'})
+        sentences = [value for value, _ in engine.autocomplete('', lines)]
+        keystrokes = sum(len(sentence) for sentence in sentences)
+
+        def retype() -> None:
+            """Type each sentence, asking autocomplete for each prefix."""
+            for sentence in sentences:
+                for n in range(1, len(sentence) + 1):
+                    engine.autocomplete(sentence[:n], limit)
+
+        def session() -> None:
+            """Type each sentence into a session."""
+            for sentence in sentences:
+                typing = engine.session()
+                for key in sentence:
+                    typing.push(key)
+                    typing.autocomplete(limit)
+
+        # the search for matches dominates, so take the best of three runs
+        gc.collect()
+        retype_seconds = min(timed(retype) for _ in range(3))
+        session_seconds = min(timed(session) for _ in range(3))
+        print(f'{tree_type:>10}: autocomplete '
+              f'{retype_seconds / keystrokes * 1e6:8.1f} us, session '
+              f'{session_seconds / keystrokes * 1e6:8.1f} us per keystroke')
+
+
+def bench_remove_many(path: str = 'data/lotr.txt',
+                      prefixes: int = 1000) -> None:
+    """Print the time to remove a blocklist of <prefixes> first words from
+    trees of the lines in <path> split into words, one at a time and with
+    remove_many.
+
+    The removed trees are kept alive, so freeing them is not timed.
+    """
+    lines = read_lines(path)
+    items = [(line, 1, line.split()) for line in lines]
+    first_words = sorted({line.split()[0] for line in lines})
+    blocklist = [[word] for word in
+                 random.Random(148).sample(first_words, prefixes)]
+    for tree_type, tree_class in TREES.items():
+        times = []
+        for batched in [False, True]:
+            tree = tree_class.from_items('sum', items)
+            # the removed trees are subtrees of the root
+            removed = list(tree.subtrees)
+            gc.collect()
+            if batched:
+                times.append(timed(lambda: tree.remove_many(blocklist)))
+            else:
+                times.append(timed(lambda: [tree.remove(prefix)
+                                            for prefix in blocklist]))
+            del tree, removed
+        print(f'{tree_type:>10}: remove {times[0] * 1e3:8.1f} ms, '
+              f'remove_many {times[1] * 1e3:8.1f} ms')
+
+
+def bench_concurrent(path: str = 'data/lotr.txt', updates: int = 5000,
+                     limit: int = 10) -> None:
+    """Print the cost of <updates> weight updates applied in place and
+    through a ConcurrentAutocompleter, and the query rate of four reader
+    threads while a writer thread applies them through it.
+    """
+    lines = read_lines(path)
+    items = [(line, 1, list(line)) for line in lines]
+    rng = random.Random(148)
+    stream = rng.choices(lines, k=updates)
+    queries = [list(line[:3]) for line in rng.choices(lines, k=1000)]
+    for tree_type, tree_class in TREES.items():
+        tree = tree_class.from_items('sum', items)
+        # the first full collection after a build walks every tree, and
+        # would otherwise land on whichever run allocates more
+        gc.collect()
+        in_place = timed(lambda: [tree.insert(line, 1, list(line))
+                                  for line in stream])
+        concurrent = ConcurrentAutocompleter(tree)
+        copied = timed(lambda: [concurrent.insert(line, 1, list(line))
+                                for line in stream])
+        done = threading.Event()
+        counts = []
+
+        def read() -> None:
+            """Query the published tree until the writer is done."""
+            count = 0
+            while not done.is_set():
+                concurrent.autocomplete(queries[count % len(queries)], limit)
+                count += 1
+            counts.append(count)
+
+        def write() -> None:
+            """Apply every update, then stop the readers."""
+            for line in stream:
+                concurrent.insert(line, 1, list(line))
+            done.set()
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        threads.append(threading.Thread(target=write))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        print(f'{tree_type:>10}: {in_place / updates * 1e6:6.1f} us per '
+              f'update in place, {copied / updates * 1e6:6.1f} us copied; '
+              f'{sum(counts) / seconds:8.0f} queries/s while writing')
+        del tree, concurrent
+
+
+def bench_sentence_words(path: str = 'data/google_searches.csv',
+                         queries: int = 2000, limit: int = 10) -> None:
+    """Print the number of trees, the build time and the query latency of
+    sentence engines on <path> storing lists of characters and lists of
+    words.
+
+    The queries are prefixes of the stored sentences, cut at random points,
+    so most end part way through a word.
+    """
+    config = {'file': path, 'weight_type': 'sum'}
+    rng = random.Random(148)
+    stream = None
+    for tree_type in ['simple', 'compressed']:
+        for words in [False, True]:
+            built = []
+            build_seconds = timed(lambda: built.append(
+                SentenceAutocompleteEngine(dict(
+                    config, autocompleter=tree_type, words=words))))
+            engine = built.pop()
+            if stream is None:
+                sentences = [value for value, _ in engine.autocomplete('')]
+                stream = [s[:rng.randint(1, len(s))]
+                          for s in rng.choices(sentences, k=queries)]
+            trees = 0
+            stack = [engine.autocompleter]
+            while stack:
+                tree = stack.pop()
+                trees += 1
+                stack.extend(tree.subtrees)
+            gc.collect()
+            seconds = timed(lambda: [engine.autocomplete(q, limit)
+                                     for q in stream])
+            name = 'words' if words else 'characters'
+            print(f'{tree_type:>10} {name:>10}: {trees:8} trees, '
+                  f'{build_seconds:5.2f} s to build, '
+                  f'{seconds / queries * 1e6:8.1f} us per query')
+            del engine
+
+
+def bench_fuzzy(path: str = 'data/google_no_swears.txt',
+                queries: int = 1000, limit: int = 10) -> None:
+    """Print the trees visited and the latency of fuzzy autocomplete on
+    letter engines for <path>, for up to 0, 1 and 2 edits.
+
+    The queries are prefixes of 3 to 8 letters of the stored strings, with
+    one letter replaced by a random one, as a mistyped query would be.
+    """
+    rng = random.Random(148)
+    stream = None
+    for tree_type in ['simple', 'compressed']:
+        engine = LetterAutocompleteEngine({
+            'file': path, 'autocompleter': tree_type, 'weight_type': 'sum'})
+        tree = engine.autocompleter
+        if stream is None:
+            strings = [value for value, _ in engine.autocomplete('')]
+            stream = []
+            for string in rng.choices(strings, k=queries):
+                query = list(string[:rng.randint(3, 8)])
+                query[rng.randrange(len(query))] = \
+                    rng.choice('abcdefghijklmnopqrstuvwxyz')
+                stream.append(''.join(query))
+        trees = 0
+        stack = [tree]
+        while stack:
+            trees += 1
+            stack.extend(stack.pop().subtrees)
+        gc.collect()
+        for k in [0, 1, 2]:
+            visits = sum(_fuzzy_search(tree, engine._tokens.lookup_known(
+                list(query)), k, limit)[1] for query in stream)
+            found = sum(len(engine.autocomplete_fuzzy(query, k, limit))
+                        for query in stream)
+            seconds = min(timed(lambda: [engine.autocomplete_fuzzy(
+                query, k, limit) for query in stream]) for _ in range(3))
+            print(f'{tree_type:>10} k={k}: {trees:7} trees, '
+                  f'{visits / queries:8.1f} visited, '
+                  f'{found / queries:5.1f} matches, '
+                  f'{seconds / queries * 1e6:8.1f} us per query')
+        del engine, tree
+
+
+def bench_melody_search(path: str = 'data/random_melodies_c_scale.csv',
+                        queries: int = 1000) -> None:
+    """Print the recall, number of matches and latency of exact, approximate
+    and infix melody searches on <path>, for synthetic noisy queries.
+
+    A prefix query is the first 5 intervals of a random melody, either as
+    is, with one interval off by a semitone, or with one note left out. The
+    recall is the share of queries whose melody is among the matches. An
+    infix query is 3 to 5 intervals from inside a random melody, and is
+    also answered by scanning every melody.
+    """
+    rng = random.Random(148)
+    engine = MelodyAutocompleteEngine({
+        'file': path, 'autocompleter': 'compressed', 'weight_type': 'sum'})
+    melodies = [melody for melody, _ in engine.autocomplete([])]
+    noisy = {'clean': [], 'off by one': [], 'missing note': []}
+    for melody in rng.choices(melodies, k=queries):
+        intervals = melody.intervals()
+        noisy['clean'].append((melody, intervals[:5]))
+        query = intervals[:5]
+        query[rng.randrange(5)] += rng.choice([-1, 1])
+        noisy['off by one'].append((melody, query))
+        i = rng.randrange(5)
+        noisy['missing note'].append(
+            (melody, intervals[:i] + [intervals[i] + intervals[i + 1]]
+             + intervals[i + 2:6]))
+    searches = {
+        'exact': engine.autocomplete,
+        'tolerance 1': lambda q: engine.autocomplete_approximate(q, 1),
+        'tolerance 1, 1 skip': lambda q: engine.autocomplete_approximate(
+            q, 1, 1)
+    }
+    gc.collect()
+    for kind, stream in noisy.items():
+        for name, search in searches.items():
+            results = [search(query) for _, query in stream]
+            recall = sum(any(found is melody for found, _ in matches)
+                         for (melody, _), matches in zip(stream, results))
+            matched = sum(len(matches) for matches in results)
+            seconds = min(timed(lambda: [search(query)
+                                         for _, query in stream])
+                          for _ in range(3))
+            print(f'{kind:>12}, {name:>19}: recall {recall / queries:5.3f}, '
+                  f'{matched / queries:7.1f} matches, '
+                  f'{seconds / queries * 1e6:8.1f} us per query')
+
+    windows = []
+    for melody in rng.choices(melodies, k=queries):
+        intervals = melody.intervals()
+        length = rng.randint(3, 5)
+        start = rng.randint(1, len(intervals) - length)
+        windows.append((melody, intervals[start:start + length]))
+    every = [(melody, melody.intervals()) for melody in melodies]
+
+    def scan(query: List[int]) -> List[object]:
+        """Return the melodies containing <query>, by checking each one."""
+        return [melody for melody, intervals in every
+                if any(intervals[i:i + len(query)] == query
+                       for i in range(len(intervals) - len(query) + 1))]
+
+    engine.autocomplete_infix([1])
+    results = [engine.autocomplete_infix(query) for _, query in windows]
+    recall = sum(any(found is melody for found, _ in matches)
+                 for (melody, _), matches in zip(windows, results))
+    matched = sum(len(matches) for matches in results)
+    for name, search in [('infix index', engine.autocomplete_infix),
+                         ('infix scan', scan)]:
+        seconds = min(timed(lambda: [search(query) for _, query in windows])
+                      for _ in range(3))
+        print(f'{name:>33}: recall {recall / queries:5.3f}, '
+              f'{matched / queries:7.1f} matches, '
+              f'{seconds / queries * 1e6:8.1f} us per query')
+
+
+def bench_midi(paths: Tuple[str, ...] = (
+        'data/songbook.csv', 'data/random_melodies_c_scale.csv'),
+        previews: int = 5000) -> None:
+    """Print the time to get the MIDI bytes of the top 10 melodies for
+    random interval prefixes, by rendering them with create_midi_file and
+    through Melody.to_midi_bytes, as a preview of each result would. The
+    cached run is timed twice: first with an empty cache, then again.
+    """
+    rng = random.Random(148)
+    for path in paths:
+        engine = MelodyAutocompleteEngine({
+            'file': path, 'autocompleter': 'compressed', 'weight_type': 'sum'})
+        melodies = [melody for melody, _ in engine.autocomplete([])]
+        stream = [melody.intervals()[:2]
+                  for melody in rng.choices(melodies, k=previews // 10)]
+        results = [[melody for melody, _ in engine.autocomplete(prefix, 10)]
+                   for prefix in stream]
+        render_seconds = timed(lambda: [
+            create_midi_file(melody.notes).getvalue()
+            for matches in results for melody in matches])
+        before = midi_cache_info()
+        first_seconds = timed(lambda: [
+            melody.to_midi_bytes() for matches in results
+            for melody in matches])
+        after = midi_cache_info()
+        warm_seconds = timed(lambda: [
+            melody.to_midi_bytes() for matches in results
+            for melody in matches])
+        count = sum(len(matches) for matches in results)
+        print(f'{path:>34}: {count} previews, '
+              f'render {render_seconds / count * 1e6:6.1f} us, '
+              f'cached {first_seconds / count * 1e6:6.1f} us first, '
+              f'{warm_seconds / count * 1e6:4.1f} us again per preview '
+              f'({after.misses - before.misses} rendered, '
+              f'{after.size} bytes held)')
+
+
+def bench_melody_memory(path: str = 'data/random_melodies_c_scale.csv',
+                        copies: int = 50) -> None:
+    """Print the memory and time taken to read the melodies in <path>,
+    <copies> times, with their notes packed as Melody stores them, and as
+    lists of (pitch, duration) tuples with a list of intervals each, as
+    they were stored before.
+    """
+    def packed() -> List[object]:
+        """Return the melodies in <path> as the engine reads them."""
+        return [melody for _ in range(copies)
+                for melody, _, _ in _read_melodies(path)]
+
+    def tuples() -> List[object]:
+        """Return the name, notes and intervals of each melody in <path>."""
+        kept = []
+        for _ in range(copies):
+            with open(path) as f:
+                for line in csv.reader(f):
+                    pairs = []
+                    for i in range(1, len(line) - 1, 2):
+                        if line[i] == '' or line[i + 1] == '':
+                            break
+                        pairs.append((int(line[i]), int(line[i + 1])))
+                    kept.append((line[0], pairs,
+                                 [pairs[i + 1][0] - pairs[i][0]
+                                  for i in range(len(pairs) - 1)]))
+        return kept
+
+    for name, read in [('packed', packed), ('tuples', tuples)]:
+        gc.collect()
+        seconds = min(timed(read) for _ in range(3))
+        tracemalloc.start()
+        kept = read()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'{name:>7}: {len(kept)} melodies, '
+              f'{used / len(kept):6.1f} bytes per melody, '
+              f'{seconds:5.2f} s to read')
+        del kept
+
+
+if __name__ == '__main__':
+    import sys
+    sys.setrecursionlimit(10000)
+
+    bench_insert_query()
+    bench_letter_query()
+    bench_search()
+    bench_load()
+    bench_bulk_build()
+    bench_ingest()
+    bench_parallel_build()
+    bench_snapshot()
+    bench_frozen()
+    bench_memory()
+    bench_engines()
+    bench_interning()
+    bench_cache()
+    bench_materialized_top()
+    bench_autocomplete_many()
+    bench_session()
+    bench_remove_many()
+    bench_concurrent()
+    bench_sentence_words()
+    bench_fuzzy()
+    bench_melody_search()
+    bench_midi()
+    bench_melody_memory()
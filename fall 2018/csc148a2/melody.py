@@ -8,10 +8,17 @@ University of Toronto
 This file contains some helpers used to convert between our integer-based
 representation of melodies and different music file formats.
 
-You should not change anything in this file.
+The MIDI bytes of a melody are rendered the first time they are needed, and
+kept in a cache shared by every melody, bounded by the total number of bytes
+it holds (see set_midi_cache_size), so playing or serving a melody again is a
+lookup.
 """
+from __future__ import annotations
 import io
-from typing import List, Tuple
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Iterable, List, NamedTuple, Tuple
 
 import mido as mido
 import pygame as pg
@@ -30,18 +37,83 @@ class Melody:
 
     Note: you can find a chart showing the conversion between integers and
     standard note names at http://newt.phys.unsw.edu.au/jw/notes.html.
+
+    The notes are stored packed, as one array of numbers, so reading notes
+    returns a new list of them, and changing that list does not change the
+    melody; assign to notes to change them.
+
+    === Private Attributes ===
+    _packed:
+        The pitch and duration of each note, one after the other, in an
+        array of 16-bit integers, or of 32-bit integers if one does not fit.
     """
+    __slots__ = ('name', '_packed')
     name: str
-    notes: List[Tuple[int, int]]
+    _packed: array
 
     def __init__(self, name: str, notes: List[Tuple[int, int]]) -> None:
         """Initialize a new melody with the given name and notes."""
         self.name = name
         self.notes = notes
 
+    @classmethod
+    def from_numbers(cls, name: str, numbers: Iterable[int]) -> Melody:
+        """Return a new melody with the given name, whose notes' pitches and
+        durations are <numbers>, one after the other.
+
+        Precondition: <numbers> has an even number of numbers.
+        """
+        melody = cls.__new__(cls)
+        melody.name = name
+        melody._packed = _pack(numbers)
+        return melody
+
+    @property
+    def notes(self) -> List[Tuple[int, int]]:
+        """The notes of this melody, as a list of (pitch, duration)
+        tuples.
+        """
+        packed = self._packed
+        return list(zip(packed[::2], packed[1::2]))
+
+    @notes.setter
+    def notes(self, notes: List[Tuple[int, int]]) -> None:
+        """Replace the notes of this melody with <notes>."""
+        self._packed = _pack(number for note in notes for number in note)
+
+    def intervals(self) -> List[int]:
+        """Return the interval sequence of this melody: the differences
+        between the pitches of consecutive notes.
+
+        It is worked out from the notes each time, and is not stored.
+        """
+        pitches = self._packed[::2]
+        return [after - before for before, after in zip(pitches, pitches[1:])]
+
     def play(self) -> None:
         """Play this melody (make sure your computer's speakers are on!)."""
-        play_midi_sequence(self.notes)
+        play_midi_file(io.BytesIO(self.to_midi_bytes()))
+
+    def to_midi_bytes(self) -> bytes:
+        """Return the contents of a MIDI file playing this melody, as
+        create_midi_file makes it.
+
+        The bytes are rendered once and then taken from the MIDI cache, for
+        as long as they stay in it and the notes are not changed.
+        """
+        packed = self._packed
+        return _MIDI_CACHE.get((packed.typecode, packed.tobytes()), self)
+
+
+def _pack(numbers: Iterable[int]) -> array:
+    """Return an array of <numbers>, of 16-bit integers if they all fit and
+    of 32-bit integers otherwise.
+    """
+    numbers = list(numbers)
+    try:
+        return array('h', numbers)
+    except OverflowError:
+        return array('i', numbers)
 
 
 def play_midi_sequence(notes: List[Tuple[int, int]]) -> None:
@@ -67,6 +139,12 @@ def create_midi_file(notes: List[Tuple[int, int]]) -> io.BytesIO:
 
     Notes are played with piano instrument.
     """
+    return io.BytesIO(_render_midi(notes))
+
+
+def _render_midi(notes: List[Tuple[int, int]]) -> bytes:
+    """Return the contents of a MIDI file playing the given list of notes.
+    """
     byte_stream = io.BytesIO()
 
     mid = mido.MidiFile()
@@ -79,4 +157,116 @@ def create_midi_file(notes: List[Tuple[int, int]]) -> io.BytesIO:
 
     mid.save(file=byte_stream)
 
-    return io.BytesIO(byte_stream.getvalue())
+    return byte_stream.getvalue()
+
+
+################################################################################
+# MIDI cache
+################################################################################
+class MidiCacheInfo(NamedTuple):
+    """The statistics of the MIDI cache.
+
+    hits and misses count the calls to Melody.to_midi_bytes that found
+    their bytes in the cache and that rendered them. size is the number of
+    bytes held, and maxsize the most it may hold.
+    """
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+
+
+class _MidiCache:
+    """A least recently used cache of rendered MIDI bytes, keyed by the
+    packed notes they play, and bounded by the total number of bytes held.
+
+    Melodies with the same notes share one entry, and a melody whose notes
+    have changed looks up its new notes.
+
+    === Private Attributes ===
+    _maxsize:
+        The most bytes held. 0 turns the cache off.
+    _size:
+        The number of bytes held.
+    _entries:
+        Maps the typecode and bytes of the packed notes of each entry to its
+        MIDI bytes, from least to most recently used.
+    _hits, _misses:
+        The number of lookups that found and did not find their bytes.
+    _lock:
+        Held while the entries are read or changed, so melodies can be
+        rendered from several threads.
+    """
+    _maxsize: int
+    _size: int
+    _entries: OrderedDict
+    _hits: int
+    _misses: int
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int) -> None:
+        """Initialize an empty cache holding up to <maxsize> bytes."""
+        self._maxsize = maxsize
+        self._size = 0
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, bytes], melody: Melody) -> bytes:
+        """Return the MIDI bytes for the notes of <melody>, whose packed
+        notes are <key>, rendering and keeping them if they are not held.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return data
+            self._misses += 1
+        # rendered without the lock, so other lookups are not held up
+        data = _render_midi(melody.notes)
+        with self._lock:
+            if key not in self._entries and len(data) <= self._maxsize:
+                self._entries[key] = data
+                self._size += len(data)
+                self._evict()
+        return data
+
+    def resize(self, maxsize: int) -> None:
+        """Hold up to <maxsize> bytes, dropping the least recently used
+        entries until they fit.
+        """
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def info(self) -> MidiCacheInfo:
+        """Return the statistics of this cache."""
+        with self._lock:
+            return MidiCacheInfo(self._hits, self._misses, self._size,
+                                 self._maxsize)
+
+    def _evict(self) -> None:
+        """Drop the least recently used entries until the rest fit."""
+        while self._size > self._maxsize:
+            _, data = self._entries.popitem(last=False)
+            self._size -= len(data)
+
+
+# The MIDI cache shared by every melody, holding up to 4 MiB by default.
+_MIDI_CACHE = _MidiCache(1 << 22)
+
+
+def set_midi_cache_size(maxsize: int) -> None:
+    """Let the MIDI cache hold up to <maxsize> bytes of rendered melodies.
+    0 turns it off.
+
+    Precondition: maxsize >= 0
+    """
+    _MIDI_CACHE.resize(maxsize)
+
+
+def midi_cache_info() -> MidiCacheInfo:
+    """Return the statistics of the MIDI cache."""
+    return _MIDI_CACHE.info()
@@ -15,7 +15,20 @@ testing directly! You may, however, add new private attributes, methods, and
 top-level functions to this file.
 """
 from __future__ import annotations
-from typing import Any, List, Optional, Tuple
+import gc
+import heapq
+import mmap
+import pickle
+import struct
+import sys
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, \
+    Optional, Set, Tuple
 
 
 ################################################################################
@@ -24,6 +37,8 @@ from typing import Any, List, Optional, Tuple
 class Autocompleter:
     """An abstract class representing the Autocompleter Abstract Data Type.
     """
+    __slots__ = ()
+
     def __len__(self) -> int:
         """Return the number of values stored in this Autocompleter."""
         raise NotImplementedError
@@ -47,7 +62,8 @@ class Autocompleter:
         raise NotImplementedError
 
     def autocomplete(self, prefix: List,
-                     limit: Optional[int] = None) -> List[Tuple[Any, float]]:
+                     limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
         """Return up to <limit> matches for the given prefix.
 
         The return value is a list of tuples (value, weight), and must be
@@ -55,6 +71,79 @@ class Autocompleter:
 
         If limit is None, return *every* match for the given prefix.
 
+        <search> picks how the matches are found. Both return the <limit>
+        heaviest matches:
+            - 'best-first' expands subtrees heaviest max_leaf_weight first,
+              and stops as soon as <limit> matches are found.
+            - 'depth-first' walks subtrees in stored order, keeping the best
+              <limit> matches so far, and skips any subtree whose
+              max_leaf_weight cannot beat the current <limit>-th best. It
+              holds fewer pending subtrees than 'best-first'.
+
+        Precondition: limit is None or limit > 0.
+                      search == 'best-first' or search == 'depth-first'.
+        """
+        raise NotImplementedError
+
+    def autocomplete_many(self, prefixes: List[List],
+                          limit: Optional[int] = None,
+                          search: str = 'best-first') \
+            -> List[List[Tuple[Any, float]]]:
+        """Return the matches for each prefix in <prefixes>, in the same
+        order: the i-th list is autocomplete(prefixes[i], limit, search).
+
+        Subclasses may find the trees for all the prefixes together, so that
+        prefixes sharing leading elements share the work of following them.
+        """
+        return [self.autocomplete(prefix, limit, search)
+                for prefix in prefixes]
+
+    def autocomplete_any(self, prefixes: List[List],
+                         limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for any of the given prefixes, in
+        non-increasing weight order as autocomplete does.
+
+        Precondition: limit is None or limit > 0.
+                      No prefix in <prefixes> is a prefix of another one.
+        """
+        found = self.autocomplete_many(prefixes, limit)
+        return list(islice(heapq.merge(*found, key=lambda match: -match[1]),
+                           limit))
+
+    def autocomplete_fuzzy(self, prefix: List, k: int = 1,
+                           limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix, allowing up to
+        <k> edits.
+
+        A value matches if some prefix of its prefix sequence is at most <k>
+        insertions, deletions or substitutions of single elements away from
+        <prefix>; its distance is the fewest edits over all such prefixes.
+        The return value is a list of tuples (value, weight), ordered in
+        non-increasing weight, and by increasing distance among equal
+        weights.
+
+        Precondition: limit is None or limit > 0.
+                      k >= 0
+        """
+        raise NotImplementedError
+
+    def autocomplete_matching(self, start: Any,
+                              step: Callable[[Any, Any], Optional[Any]],
+                              accepts: Callable[[Any], bool],
+                              limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches of an automaton, in non-increasing
+        weight order as autocomplete does.
+
+        The automaton starts in state <start>, and step(state, element)
+        returns its state after reading <element>, or None if no sequence
+        starting with the elements read so far can be accepted. A value
+        matches if accepts(state) is true after some prefix of its prefix
+        sequence. States must be hashable, and step must always return the
+        same state for the same state and element.
+
         Precondition: limit is None or limit > 0.
         """
         raise NotImplementedError
@@ -64,6 +153,97 @@ class Autocompleter:
         """
         raise NotImplementedError
 
+    def remove_many(self, prefixes: List[List]) -> None:
+        """Remove all values that match any prefix in <prefixes>.
+
+        Subclasses may remove them together, so that a tree above many of
+        the removed values is updated only once.
+        """
+        for prefix in prefixes:
+            self.remove(prefix)
+
+    def cursor(self) -> PrefixCursor:
+        """Return a cursor at the empty prefix of this Autocompleter."""
+        return PrefixCursor(self)
+
+    # The three methods below are how a PrefixCursor moves in this
+    # Autocompleter. A position stands for a prefix; these defaults use the
+    # prefix itself, and subclasses use the tree it leads to.
+
+    def _start(self) -> Any:
+        """Return the position of the empty prefix."""
+        return ()
+
+    def _advance(self, position: Any, element: Any) -> Optional[Any]:
+        """Return the position of the prefix at <position> followed by
+        <element>, or None if no value matches that prefix.
+        """
+        return position + (element,)
+
+    def _matches(self, position: Any, limit: Optional[int],
+                 search: str) -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the prefix at <position>, as
+        autocomplete does.
+        """
+        return self.autocomplete(list(position), limit, search)
+
+
+class PrefixCursor:
+    """A prefix typed into an Autocompleter one element at a time.
+
+    The cursor remembers the position reached by each leading part of its
+    prefix, so push follows one more element from where the last one ended,
+    and pop goes back to where the one before it ended. The Autocompleter
+    must not change while the cursor is in use.
+
+    === Attributes ===
+    prefix:
+        The elements pushed onto this cursor, first to last.
+
+    === Private Attributes ===
+    _tree:
+        The Autocompleter this cursor is in.
+    _positions:
+        _positions[i] is the position of prefix[:i] in _tree, or None if no
+        value matches prefix[:i].
+    """
+    __slots__ = ('prefix', '_tree', '_positions')
+    prefix: List
+    _tree: Autocompleter
+    _positions: List[Optional[Any]]
+
+    def __init__(self, tree: Autocompleter) -> None:
+        """Initialize a cursor at the empty prefix of <tree>."""
+        self.prefix = []
+        self._tree = tree
+        self._positions = [tree._start()]
+
+    def push(self, element: Any) -> None:
+        """Add <element> to the end of this cursor's prefix."""
+        position = self._positions[-1]
+        if position is not None:
+            position = self._tree._advance(position, element)
+        self.prefix.append(element)
+        self._positions.append(position)
+
+    def pop(self) -> Any:
+        """Remove and return the last element of this cursor's prefix.
+
+        Precondition: self.prefix != []
+        """
+        self._positions.pop()
+        return self.prefix.pop()
+
+    def autocomplete(self, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for this cursor's prefix, as
+        Autocompleter.autocomplete does.
+        """
+        position = self._positions[-1]
+        if position is None:
+            return []
+        return self._tree._matches(position, limit, search)
+
 
 ################################################################################
 # SimplePrefixTree (Tasks 1-3)
@@ -86,9 +266,14 @@ class SimplePrefixTree(Autocompleter):
         of the leaf weights in this tree.
     subtrees:
         A list of subtrees of this prefix tree.
+    max_leaf_weight:
+        The largest weight of a leaf in this prefix tree (the weight itself
+        if this tree is a leaf, and 0.0 if this tree is empty).
 
     === Representation invariants ===
     - self.weight >= 0
+    - self.max_leaf_weight == max(s.max_leaf_weight for s in self.subtrees)
+      if this tree is not empty and not a leaf.
 
     - (EMPTY TREE):
         If self.weight == 0, then self.value == [] and self.subtrees == [].
@@ -114,11 +299,36 @@ class SimplePrefixTree(Autocompleter):
       attribute.
     """
 
+    # trees are made in the millions, so they have no __dict__
+    __slots__ = ('value', 'weight', 'subtrees', 'weight_type', 'leaf',
+                 'max_leaf_weight', '_children', '_total', '_top',
+                 '_top_settings')
     value: Any
     weight: float
     subtrees: List[SimplePrefixTree]
     weight_type: str
     leaf: int
+    max_leaf_weight: float
+
+    # === Private Attributes ===
+    # _children:
+    #     The non-leaf subtrees of this tree, keyed by the prefix element
+    #     that extends self.value to the subtree's value. This is kept in
+    #     sync with self.subtrees, and lets us find the next subtree along
+    #     a prefix without scanning self.subtrees.
+    # _total:
+    #     The sum of the leaf weights in this tree, so that an 'average'
+    #     weight is just self._total / self.leaf.
+    # _top:
+    #     If materialize_top is on, the heaviest matches (value, weight) of
+    #     this tree, in non-increasing weight order; otherwise None.
+    # _top_settings:
+    #     For the root, (k, depth) as given to materialize_top, or None if it
+    #     is off. Unused by other trees.
+    _children: Dict[Any, SimplePrefixTree]
+    _total: float
+    _top: Optional[List[Tuple[Any, float]]]
+    _top_settings: Optional[Tuple[int, int]]
 
     def __init__(self, weight_type: str) -> None:
         """Initialize an empty simple prefix tree.
@@ -134,6 +344,59 @@ class SimplePrefixTree(Autocompleter):
         self.subtrees = []
         self.weight_type = weight_type
         self.leaf = 0
+        self.max_leaf_weight = 0.0
+        self._children = {}
+        self._total = 0.0
+        self._top = None
+        self._top_settings = None
+
+    @classmethod
+    def from_items(cls, weight_type: str,
+                   items: Iterable[Tuple[Any, float, List]],
+                   workers: int = 1) -> SimplePrefixTree:
+        """Return a new SimplePrefixTree holding every (value, weight, prefix)
+        triple in <items>.
+
+        The result is the same as inserting each triple in turn into an empty
+        tree, but the tree is built bottom-up in one pass: duplicate values
+        are added together first, and each subtree is sorted once, when it is
+        complete.
+
+        If <workers> is more than 1, the items are split up by the first
+        element of their prefix, and the subtree for each first element is
+        built in one of <workers> separate processes.
+
+        Precondition: the triples satisfy the preconditions of insert.
+                      workers >= 1
+        """
+        return _from_items(cls(weight_type), items, False, workers)
+
+    def save(self, path: str) -> None:
+        """Save this tree to the file at <path>, in the snapshot format
+        described above _save.
+        """
+        _save(self, path)
+
+    @classmethod
+    def load(cls, path: str) -> SimplePrefixTree:
+        """Return the SimplePrefixTree saved to the file at <path> by save.
+
+        Raise a ValueError if the file is not a snapshot of a SimplePrefixTree.
+        Snapshots hold pickled values, so only load files you trust.
+        """
+        return _load(cls, path)
+
+    def materialize_top(self, k: int, depth: int) -> None:
+        """Store the <k> heaviest matches of every prefix of at most <depth>
+        elements, so that autocomplete answers these prefixes with a slice
+        of a stored list whenever limit <= k.
+
+        The lists are kept up to date by insert and remove. If <k> is 0, the
+        stored lists are dropped.
+
+        Precondition: k >= 0 and depth >= 0
+        """
+        _materialize(self, k, depth)
 
     def is_empty(self) -> bool:
         """Return whether this simple prefix tree is empty."""
@@ -163,121 +426,160 @@ class SimplePrefixTree(Autocompleter):
                 s += subtree._str_indented(depth + 1)
             return s
 
-    def _find_average(self) -> float:
-        """ helper to calculate average weight."""
-        sum_weight = 0
-        for s in self.subtrees:
-            if s.is_leaf():
-                sum_weight += s.weight
-            else:
-                sum_weight += s.weight * s.leaf
-        return sum_weight / self.leaf
-
     def insert(self, value: Any, weight: float, prefix: List) -> None:
         """ Insert the given value into this SimplePrefixTree.
         """
-        if prefix:
-            for t in self.subtrees:
-                if self.value + [prefix[0]] == t.value:
-                    old_weight = t.weight
-                    old_leaf = t.leaf
-                    t.insert(value, weight, prefix[1:])
-                    self.leaf += t.leaf - old_leaf
-                    if self.weight_type == 'sum':
-                        self.weight += t.weight - old_weight
-                    else:
-                        self.weight = self._find_average()
-
-                    self.subtrees = \
-                        sorted(self.subtrees, key=lambda x: x.weight,
-                               reverse=True)
-                    return
-        # new node.
-        tree = SimplePrefixTree(self.weight_type)
-        if prefix:
-            tree.value = self.value + [prefix[0]]
-            tree.insert(value, weight, prefix[1:])
-            self.leaf += 1
-            self.subtrees.append(tree)
-        else:
-            # leaf
-            duplicate = False
-            for t in self.subtrees:
-                if t.value == [value]:
-                    duplicate = True
-                    t.weight += weight
-            if not duplicate:
-                tree.value = [value]
-                tree.weight = weight
-                self.leaf += 1
-                self.subtrees.append(tree)
-        self.subtrees = \
-            sorted(self.subtrees, key=lambda x: x.weight, reverse=True)
-        if self.weight_type == 'sum':
-            self.weight += weight
-        else:
-            self.weight = self._find_average()
+        # walk down the prefix, creating any missing subtrees on the way.
+        path = [self]
+        for element in prefix:
+            tree = path[-1]
+            subtree = tree._children.get(element)
+            if subtree is None:
+                subtree = SimplePrefixTree(self.weight_type)
+                subtree.value = tree.value + [element]
+                tree._children[element] = subtree
+                tree.subtrees.append(subtree)
+            path.append(subtree)
+        leaf, new_leaf = _add_leaf(path[-1], value, weight)
+        _update_path(path, leaf, weight, new_leaf)
+        if self._top_settings is not None:
+            _update_tops(path, leaf, self._top_settings)
 
     def __len__(self) -> int:
         """ Return the number of values stored in this SimplePrefixTree.
         """
         return self.leaf
 
-    def autocomplete(self, prefix: List, limit: Optional[int] = None)\
-            -> List[Tuple[Any, float]]:
+    def autocomplete(self, prefix: List, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
         """Return up to <limit> matches for the given prefix."""
         # find target root first.
         root = self
-        while prefix:
-            found = False
-            for s in root.subtrees:
-                if root.value + [prefix[0]] == s.value:
-                    root = s
-                    prefix = prefix[1:]
-                    found = True
-                    break
-            if not found:
+        for element in prefix:
+            root = root._children.get(element)
+            if root is None:
                 return []
-        result = []
+        return _search(self, root, limit, search)
+
+    def _start(self) -> SimplePrefixTree:
+        """Return the position of the empty prefix: this tree."""
+        return self
+
+    def _advance(self, position: SimplePrefixTree,
+                 element: Any) -> Optional[SimplePrefixTree]:
+        """Return the subtree of <position> for <element>, or None."""
+        return position._children.get(element)
+
+    def _matches(self, position: SimplePrefixTree, limit: Optional[int],
+                 search: str) -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches in the tree <position>."""
+        return _search(self, position, limit, search)
+
+    def autocomplete_many(self, prefixes: List[List],
+                          limit: Optional[int] = None,
+                          search: str = 'best-first') \
+            -> List[List[Tuple[Any, float]]]:
+        """Return the matches for each prefix in <prefixes>, in the same
+        order.
+
+        The trees for the prefixes are found together by _find_many.
+        """
+        return _search_many(self, self._find_many(prefixes), limit, search)
 
-        def helper(r: SimplePrefixTree) -> None:
-            """small helper to find leaf."""
-            nonlocal limit
-            if r.is_leaf():
-                if limit:
-                    limit -= 1
-                result.append((r.value[0], r.weight))
-            else:
-                for t in r.subtrees:
-                    if limit == 0:
-                        return
-                    helper(t)
-        helper(root)
-        return sorted(result, key=lambda x: x[1], reverse=True)
+    def autocomplete_any(self, prefixes: List[List],
+                         limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for any of the given prefixes, found
+        by one best-first search over the trees for all of them.
+        """
+        return _top_k_any([tree for tree in self._find_many(prefixes)
+                           if tree is not None], limit)
+
+    def autocomplete_fuzzy(self, prefix: List, k: int = 1,
+                           limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix, allowing up to
+        <k> edits, as Autocompleter.autocomplete_fuzzy does.
+        """
+        return _fuzzy_search(self, prefix, k, limit)[0]
+
+    def autocomplete_matching(self, start: Any,
+                              step: Callable[[Any, Any], Optional[Any]],
+                              accepts: Callable[[Any], bool],
+                              limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches of an automaton, as
+        Autocompleter.autocomplete_matching does.
+        """
+        return _top_k_any(_matching_roots(self, start, step, accepts), limit)
+
+    def _find_many(self, prefixes: List[List]) \
+            -> List[Optional[SimplePrefixTree]]:
+        """Return the tree for each prefix in <prefixes>, or None where no
+        value matches it.
+
+        The prefixes are visited in sorted order, and each one starts from
+        the deepest tree it shares with the one before it.
+        """
+        found = [None] * len(prefixes)
+        # path[j] is the tree for previous[:j], as far as it was found
+        path = [self]
+        previous = None
+        for i in _sorted_order(prefixes):
+            prefix = prefixes[i]
+            del path[_common_length(previous, prefix) + 1:]
+            while len(path) <= len(prefix):
+                subtree = path[-1]._children.get(prefix[len(path) - 1])
+                if subtree is None:
+                    break
+                path.append(subtree)
+            if len(path) > len(prefix):
+                found[i] = path[-1]
+            previous = prefix
+        return found
 
     def remove(self, prefix: List) -> None:
         """Remove all values that match the given prefix.
         """
-        if not prefix:
-            self.weight = 0
-            self.subtrees = []
-            self.value = []
-            self.leaf = 0
-        target = None
-        for s in self.subtrees:
-            if s.value == self.value + [prefix[0]]:
-                old_leaf = s.leaf
-                old_weight = s.weight
-                s.remove(prefix[1:])
-                target = s
-                self.leaf += old_leaf - s.leaf
-                if self.weight_type == 'sum':
-                    self.weight -= old_weight - s.weight
-                else:
-                    self.weight = self._find_average()
-                break
-        if target and target.is_empty():
-            self.subtrees.remove(target)
+        path = self._find(prefix)
+        if not path:
+            return
+        settings = self._top_settings
+        _remove_path(path)
+        _refresh_tops(self, path, settings)
+
+    def remove_many(self, prefixes: List[List]) -> None:
+        """Remove all values that match any prefix in <prefixes>.
+
+        Each tree above the removed ones is updated once, however many of
+        them it held.
+        """
+        paths = [path for path in map(self._find, prefixes) if path]
+        if paths:
+            settings = self._top_settings
+            _refresh_tops(self, _remove_paths(self, paths), settings)
+
+    def _find(self, prefix: List) -> List[SimplePrefixTree]:
+        """Return the trees from this one down to the tree for <prefix>, or
+        [] if no value matches <prefix>.
+        """
+        path = [self]
+        for element in prefix:
+            subtree = path[-1]._children.get(element)
+            if subtree is None:
+                return []
+            path.append(subtree)
+        return path
+
+    def _unlink(self, subtree: SimplePrefixTree) -> None:
+        """Remove the non-leaf <subtree> from the subtrees of this tree."""
+        self.subtrees.remove(subtree)
+        del self._children[subtree.value[len(self.value)]]
+
+    def _compress(self) -> None:
+        """Do nothing: a simple prefix tree keeps a tree for every prefix,
+        even one with a single subtree.
+        """
 
 
 ################################################################################
@@ -302,9 +604,14 @@ class CompressedPrefixTree(Autocompleter):
         of the leaf weights in this tree.
     subtrees:
         A list of subtrees of this prefix tree.
+    max_leaf_weight:
+        The largest weight of a leaf in this prefix tree (the weight itself
+        if this tree is a leaf, and 0.0 if this tree is empty).
 
     === Representation invariants ===
     - self.weight >= 0
+    - self.max_leaf_weight == max(s.max_leaf_weight for s in self.subtrees)
+      if this tree is not empty and not a leaf.
 
     - (EMPTY TREE):
         If self.weight == 0, then self.value == [] and self.subtrees == [].
@@ -327,11 +634,35 @@ class CompressedPrefixTree(Autocompleter):
       both can appear in the same self.subtrees list, and both have a `weight`
       attribute.
     """
+    # trees are made in the millions, so they have no __dict__
+    __slots__ = ('value', 'weight', 'subtrees', 'weight_type', 'leaf',
+                 'max_leaf_weight', '_children', '_total', '_top',
+                 '_top_settings')
     value: Any
     weight: float
     subtrees: List[CompressedPrefixTree]
     weight_type: str
     leaf: int
+    max_leaf_weight: float
+
+    # === Private Attributes ===
+    # _children:
+    #     The non-leaf subtrees of this tree, keyed by the first prefix
+    #     element after self.value in the subtree's value. Because the tree
+    #     is compressed, no two of them share that element.
+    # _total:
+    #     The sum of the leaf weights in this tree, so that an 'average'
+    #     weight is just self._total / self.leaf.
+    # _top:
+    #     If materialize_top is on, the heaviest matches (value, weight) of
+    #     this tree, in non-increasing weight order; otherwise None.
+    # _top_settings:
+    #     For the root, (k, depth) as given to materialize_top, or None if it
+    #     is off. Unused by other trees.
+    _children: Dict[Any, CompressedPrefixTree]
+    _total: float
+    _top: Optional[List[Tuple[Any, float]]]
+    _top_settings: Optional[Tuple[int, int]]
 
     def __init__(self, weight_type: str) -> None:
         """Initialize an empty simple prefix tree.
@@ -347,160 +678,263 @@ class CompressedPrefixTree(Autocompleter):
         self.subtrees = []
         self.weight_type = weight_type
         self.leaf = 0
+        self.max_leaf_weight = 0.0
+        self._children = {}
+        self._total = 0.0
+        self._top = None
+        self._top_settings = None
+
+    @classmethod
+    def from_items(cls, weight_type: str,
+                   items: Iterable[Tuple[Any, float, List]],
+                   workers: int = 1) -> CompressedPrefixTree:
+        """Return a new CompressedPrefixTree holding every (value, weight,
+        prefix) triple in <items>.
+
+        The result is the same as inserting each triple in turn into an empty
+        tree, but the tree is built bottom-up in one pass: duplicate values
+        are added together first, and each subtree is sorted once, when it is
+        complete.
+
+        If <workers> is more than 1, the items are split up by the first
+        element of their prefix, and the subtree for each first element is
+        built in one of <workers> separate processes.
+
+        Precondition: the triples satisfy the preconditions of insert.
+                      workers >= 1
+        """
+        return _from_items(cls(weight_type), items, True, workers)
+
+    def save(self, path: str) -> None:
+        """Save this tree to the file at <path>, in the snapshot format
+        described above _save.
+        """
+        _save(self, path)
+
+    @classmethod
+    def load(cls, path: str) -> CompressedPrefixTree:
+        """Return the CompressedPrefixTree saved to the file at <path> by save.
+
+        Raise a ValueError if the file is not a snapshot of a
+        CompressedPrefixTree. Snapshots hold pickled values, so only load files
+        you trust.
+        """
+        return _load(cls, path)
+
+    def materialize_top(self, k: int, depth: int) -> None:
+        """Store the <k> heaviest matches of every prefix of at most <depth>
+        elements, so that autocomplete answers these prefixes with a slice
+        of a stored list whenever limit <= k.
+
+        The lists are kept up to date by insert and remove. If <k> is 0, the
+        stored lists are dropped.
+
+        Precondition: k >= 0 and depth >= 0
+        """
+        _materialize(self, k, depth)
 
     def __len__(self) -> int:
         return self.leaf
 
-    def _find_average(self) -> float:
-        """ helper to calculate average weight."""
-        sum_weight = 0
-        for s in self.subtrees:
-            if s.is_leaf():
-                sum_weight += s.weight
-            else:
-                sum_weight += s.weight * s.leaf
-        return sum_weight / self.leaf
-
     def insert(self, value: Any, weight: float, prefix: List) -> None:
         """ Insert the given value into this CompressedPrefixTree.
         """
-
-        for t in self.subtrees:
-            if not prefix:
+        path = [self]
+        i = 0
+        while i < len(prefix):
+            tree = path[-1]
+            subtree = tree._children.get(prefix[i])
+            if subtree is None:
+                # no value shares the rest of prefix: one new node for it.
+                subtree = CompressedPrefixTree(self.weight_type)
+                subtree.value = list(prefix)
+                tree._children[prefix[i]] = subtree
+                tree.subtrees.append(subtree)
+                path.append(subtree)
                 break
-            compare = min(len(t.value), len(prefix))
-            if t.value[:compare] == prefix[:compare]\
-                    and t.value != prefix:
-                old_weight, old_leaf = t.weight, t.leaf
-                t.insert(value, weight, prefix)
-                self.leaf += t.leaf - old_leaf
-                if self.weight_type == 'sum':
-                    self.weight += t.weight - old_weight
-                else:
-                    self.weight = self._find_average()
-                self.subtrees = \
-                    sorted(self.subtrees, key=lambda x: x.weight,
-                           reverse=True)
-                return
-            same_index = 0
-            for i in range(compare):
-                if t.value[i] != prefix[i]:
-                    break
-                same_index += 1
-            if same_index:
-                if t.value == prefix:
-                    t.insert(value, weight, [])
-                else:
-                    tree = CompressedPrefixTree(self.weight_type)
-                    tree.value = t.value[:same_index]
-                    tree.subtrees.append(t)
-                    tree.insert(value, weight, prefix[same_index:])
-                    tree.weight = weight + t.weight \
-                        if self.weight_type == 'sum' \
-                        else tree._find_average()
-                    self.subtrees.remove(t)
-                    self.subtrees.append(tree)
-                    self.leaf += 1
-                if self.weight_type == 'sum':
-                    self.weight += weight
-                else:
-                    self.weight = self._find_average()
-                self.subtrees = \
-                    sorted(self.subtrees, key=lambda x: x.weight,
-                           reverse=True)
-                return
-        # new node.
-        tree = CompressedPrefixTree(self.weight_type)
-        if prefix:
-            tree.value = list(value)
-            tree.insert(value, weight, [])
-            self.leaf += 1
-            self.subtrees.append(tree)
-        else:
-            # leaf
-            duplicate = False
-            for t in self.subtrees:
-                if t.value == [value]:
-                    duplicate = True
-                    t.weight += weight
-            if not duplicate:
-                tree.value = [value]
-                tree.weight = weight
-                self.leaf += 1
-                self.subtrees.append(tree)
-        self.subtrees = \
-            sorted(self.subtrees, key=lambda x: x.weight, reverse=True)
-        if self.weight_type == 'sum':
-            self.weight += weight
-        else:
-            self.weight = self._find_average()
-
-    def autocomplete(self, prefix: List, limit: Optional[int] = None)\
-            -> List[Tuple[Any, float]]:
+            j = i + 1
+            end = min(len(subtree.value), len(prefix))
+            while j < end and subtree.value[j] == prefix[j]:
+                j += 1
+            if j < len(subtree.value):
+                # prefix leaves subtree's value part way: split it.
+                subtree = _split(tree, subtree, j)
+                if self._top_settings is not None \
+                        and j >= self._top_settings[1]:
+                    # the old subtree is now too deep to keep a top list.
+                    subtree.subtrees[0]._top = None
+            path.append(subtree)
+            i = j
+        leaf, new_leaf = _add_leaf(path[-1], value, weight)
+        _update_path(path, leaf, weight, new_leaf)
+        if self._top_settings is not None:
+            _update_tops(path, leaf, self._top_settings)
+
+    def autocomplete(self, prefix: List, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
         """Return up to <limit> matches for the given prefix."""
         # find target root first.
         root = self
-        while prefix:
-            found = False
-            for s in root.subtrees:
-                compare = min(len(s.value), len(prefix))
-                if s.value[:compare] == prefix[:compare]:
-                    root = s
-                    if compare == len(prefix):
-                        prefix = []
-                    found = True
-                    break
-            if not found:
+        i = 0
+        while i < len(prefix):
+            root = root._children.get(prefix[i])
+            if root is None:
                 return []
-        result = []
+            end = min(len(root.value), len(prefix))
+            if root.value[i:end] != prefix[i:end]:
+                return []
+            i = end
+        return _search(self, root, limit, search)
 
-        def helper(r: CompressedPrefixTree) -> None:
-            """small helper to find leaf."""
-            nonlocal limit
-            if r.is_leaf():
-                if limit:
-                    limit -= 1
-                result.append((r.value[0], r.weight))
-            else:
-                for t in r.subtrees:
-                    if limit == 0:
-                        return
-                    helper(t)
+    def _start(self) -> Tuple[CompressedPrefixTree, int]:
+        """Return the position of the empty prefix.
+
+        A position is (tree, n): the prefix is the first n elements of
+        tree.value, and tree is the shallowest tree whose value has them.
+        """
+        return self, 0
 
-        helper(root)
-        return sorted(result, key=lambda x: x[1], reverse=True)
+    def _advance(self, position: Tuple[CompressedPrefixTree, int],
+                 element: Any) -> Optional[Tuple[CompressedPrefixTree, int]]:
+        """Return the position one <element> further than <position>, or
+        None.
+        """
+        tree, n = position
+        if n < len(tree.value):
+            return (tree, n + 1) if tree.value[n] == element else None
+        tree = tree._children.get(element)
+        return None if tree is None else (tree, n + 1)
+
+    def _matches(self, position: Tuple[CompressedPrefixTree, int],
+                 limit: Optional[int],
+                 search: str) -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the prefix at <position>."""
+        return _search(self, position[0], limit, search)
+
+    def autocomplete_many(self, prefixes: List[List],
+                          limit: Optional[int] = None,
+                          search: str = 'best-first') \
+            -> List[List[Tuple[Any, float]]]:
+        """Return the matches for each prefix in <prefixes>, in the same
+        order.
+
+        The trees for the prefixes are found together by _find_many.
+        """
+        return _search_many(self, self._find_many(prefixes), limit, search)
+
+    def autocomplete_any(self, prefixes: List[List],
+                         limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for any of the given prefixes, found
+        by one best-first search over the trees for all of them.
+        """
+        return _top_k_any([tree for tree in self._find_many(prefixes)
+                           if tree is not None], limit)
+
+    def autocomplete_fuzzy(self, prefix: List, k: int = 1,
+                           limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix, allowing up to
+        <k> edits, as Autocompleter.autocomplete_fuzzy does.
+        """
+        return _fuzzy_search(self, prefix, k, limit)[0]
+
+    def autocomplete_matching(self, start: Any,
+                              step: Callable[[Any, Any], Optional[Any]],
+                              accepts: Callable[[Any], bool],
+                              limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches of an automaton, as
+        Autocompleter.autocomplete_matching does.
+        """
+        return _top_k_any(_matching_roots(self, start, step, accepts), limit)
+
+    def _find_many(self, prefixes: List[List]) \
+            -> List[Optional[CompressedPrefixTree]]:
+        """Return the tree holding every value that matches each prefix in
+        <prefixes>, or None where no value matches it.
+
+        The prefixes are visited in sorted order, and each one starts from
+        the deepest tree whose value it shares with the one before it.
+        """
+        found = [None] * len(prefixes)
+        # the trees found for previous, from the root down
+        path = [self]
+        previous = None
+        for i in _sorted_order(prefixes):
+            prefix = prefixes[i]
+            common = _common_length(previous, prefix)
+            while len(path[-1].value) > common:
+                path.pop()
+            root = path[-1]
+            j = len(root.value)
+            while j < len(prefix):
+                root = root._children.get(prefix[j])
+                if root is None:
+                    break
+                end = min(len(root.value), len(prefix))
+                if root.value[j:end] != prefix[j:end]:
+                    root = None
+                    break
+                path.append(root)
+                j = end
+            found[i] = root
+            previous = prefix
+        return found
 
     def remove(self, prefix: List) -> None:
         """Remove all values that match the given prefix.
         """
-        if not prefix:
-            self.weight = 0.0
-            self.subtrees = []
-            self.value = []
-            self.leaf = 0
-        target = None
-        for s in self.subtrees:
-            compare = min(len(s.value), len(prefix))
-            if s.value[:compare] == prefix[:compare]:
-                old_leaf = s.leaf
-                old_weight = s.weight
-                if compare == len(prefix):
-                    s.remove([])
-                else:
-                    s.remove(prefix)
-                target = s
-                self.leaf += old_leaf - s.leaf
-                if self.weight_type == 'sum':
-                    self.weight -= old_weight - s.weight
-                else:
-                    self.weight = self._find_average()
-                break
-        if target is not None:
-            if target.is_empty():
-                self.subtrees.remove(target)
-            elif len(target.subtrees) == 1:
-                target.value = target.subtrees[0].value
-                target.subtrees = target.subtrees[0].subtrees
+        path = self._find(prefix)
+        if not path:
+            return
+        settings = self._top_settings
+        parent = _remove_path(path)
+        if parent is not None and parent is not self:
+            parent._compress()
+        _refresh_tops(self, path, settings)
+
+    def remove_many(self, prefixes: List[List]) -> None:
+        """Remove all values that match any prefix in <prefixes>.
+
+        Each tree above the removed ones is updated once, however many of
+        them it held.
+        """
+        paths = [path for path in map(self._find, prefixes) if path]
+        if paths:
+            settings = self._top_settings
+            _refresh_tops(self, _remove_paths(self, paths), settings)
+
+    def _find(self, prefix: List) -> List[CompressedPrefixTree]:
+        """Return the trees from this one down to the tree holding every value
+        that matches <prefix>, or [] if no value does.
+        """
+        path = [self]
+        i = 0
+        while i < len(prefix):
+            subtree = path[-1]._children.get(prefix[i])
+            if subtree is None:
+                return []
+            end = min(len(subtree.value), len(prefix))
+            if subtree.value[i:end] != prefix[i:end]:
+                return []
+            path.append(subtree)
+            i = end
+        return path
+
+    def _unlink(self, subtree: CompressedPrefixTree) -> None:
+        """Remove the non-leaf <subtree> from the subtrees of this tree."""
+        self.subtrees.remove(subtree)
+        del self._children[subtree.value[len(self.value)]]
+
+    def _compress(self) -> None:
+        """Merge the only subtree of this tree into it, if it has just one
+        and that one is not a leaf.
+
+        Precondition: this tree is not the root of the whole tree.
+        """
+        if len(self.subtrees) == 1 and self.subtrees[0].subtrees:
+            _absorb(self)
 
     def is_leaf(self) -> bool:
         """Return whether this simple prefix tree is a leaf."""
@@ -530,6 +964,1943 @@ class CompressedPrefixTree(Autocompleter):
         """Return whether this simple prefix tree is empty."""
         return self.weight == 0.0
 
+
+################################################################################
+# CompactPrefixTree
+################################################################################
+class CompactPrefixTree(Autocompleter):
+    """A compressed prefix tree that stores less in each tree.
+
+    This has the same shape and public interface as CompressedPrefixTree, but
+    a tree does not keep a copy of its whole prefix. Instead it keeps a
+    *cell* (parent's cell, label), where the label is the part of its prefix
+    after its parent's. Its subtrees all point at this one cell, so prefixes
+    are shared, and value is rebuilt from the chain of cells only when it is
+    read. It also has no dictionary of its subtrees: the few subtrees of a
+    compressed tree are scanned instead.
+
+    === Attributes ===
+    value:
+        The value stored at the root of this prefix tree, or [] if this
+        prefix tree is empty. Reading this is O(depth) for a non-leaf tree.
+    weight:
+        The weight of this prefix tree. If this tree is a leaf, this attribute
+        stores the weight of the value stored in the leaf. If this tree is
+        not a leaf and non-empty, this attribute stores the *aggregate weight*
+        of the leaf weights in this tree.
+    subtrees:
+        A list of subtrees of this prefix tree.
+    max_leaf_weight:
+        The largest weight of a leaf in this prefix tree (the weight itself
+        if this tree is a leaf, and 0.0 if this tree is empty).
+
+    === Representation invariants ===
+    The same as CompressedPrefixTree's, and:
+    - self._prefix is None if this tree is the root of the whole tree.
+    """
+    __slots__ = ('weight', 'subtrees', 'weight_type', 'leaf',
+                 'max_leaf_weight', '_total', '_prefix')
+    weight: float
+    subtrees: List[CompactPrefixTree]
+    weight_type: str
+    leaf: int
+    max_leaf_weight: float
+
+    # === Private Attributes ===
+    # _total:
+    #     The sum of the leaf weights in this tree, so that an 'average'
+    #     weight is just self._total / self.leaf.
+    # _prefix:
+    #     For a leaf, the value stored in it. For the root, None. For any
+    #     other tree, its cell: a tuple (parent's _prefix, label), where the
+    #     label is a non-empty tuple of prefix elements.
+    _total: float
+    _prefix: Any
+
+    def __init__(self, weight_type: str) -> None:
+        """Initialize an empty compact prefix tree.
+
+        Precondition: weight_type == 'sum' or weight_type == 'average'.
+
+        The given <weight_type> value specifies how the aggregate weight
+        of non-leaf trees should be calculated (see the assignment handout
+        for details).
+        """
+        self.weight = 0.0
+        self.subtrees = []
+        self.weight_type = weight_type
+        self.leaf = 0
+        self.max_leaf_weight = 0.0
+        self._total = 0.0
+        self._prefix = None
+
+    @property
+    def value(self) -> List:
+        """The value of this tree: [the stored value] for a leaf, [] for an
+        empty tree, and the common prefix of its values for any other tree.
+
+        Setting value is only meant for the shared helpers: [] empties the
+        tree, and [x] makes a new leaf store x.
+        """
+        if not self.subtrees:
+            return [self._prefix] if self.leaf else []
+        labels = []
+        cell = self._prefix
+        while cell is not None:
+            cell, label = cell
+            labels.append(label)
+        value = []
+        for label in reversed(labels):
+            value.extend(label)
+        return value
+
+    @value.setter
+    def value(self, value: List) -> None:
+        self._prefix = value[0] if value else None
+
+    @classmethod
+    def from_items(cls, weight_type: str,
+                   items: Iterable[Tuple[Any, float, List]],
+                   workers: int = 1) -> CompactPrefixTree:
+        """Return a new CompactPrefixTree holding every (value, weight, prefix)
+        triple in <items>.
+
+        The items are built into a CompressedPrefixTree first (see
+        CompressedPrefixTree.from_items), which is then copied, so for a
+        moment both trees are in memory.
+
+        Precondition: the triples satisfy the preconditions of insert.
+                      workers >= 1
+        """
+        return _compact(CompressedPrefixTree.from_items(weight_type, items,
+                                                        workers))
+
+    def __len__(self) -> int:
+        """ Return the number of values stored in this CompactPrefixTree.
+        """
+        return self.leaf
+
+    def insert(self, value: Any, weight: float, prefix: List) -> None:
+        """ Insert the given value into this CompactPrefixTree.
+        """
+        path = [self]
+        i = 0
+        while i < len(prefix):
+            tree = path[-1]
+            subtree = tree._child(prefix[i])
+            if subtree is None:
+                # no value shares the rest of prefix: one new tree for it.
+                subtree = CompactPrefixTree(self.weight_type)
+                subtree._prefix = (tree._prefix, tuple(prefix[i:]))
+                tree.subtrees.append(subtree)
+                path.append(subtree)
+                break
+            label = subtree._prefix[1]
+            j = 1
+            end = min(len(label), len(prefix) - i)
+            while j < end and label[j] == prefix[i + j]:
+                j += 1
+            if j < len(label):
+                # prefix leaves subtree's label part way: split it.
+                subtree = _split_label(tree, subtree, j)
+            path.append(subtree)
+            i += j
+        leaf, new_leaf = _add_leaf(path[-1], value, weight)
+        _update_path(path, leaf, weight, new_leaf)
+
+    def autocomplete(self, prefix: List, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix."""
+        path = self._find(prefix)
+        if not path:
+            return []
+        if search == 'depth-first':
+            return _top_k_pruned(path[-1], limit)
+        return _top_k(path[-1], limit)
+
+    def _start(self) -> Tuple[CompactPrefixTree, int]:
+        """Return the position of the empty prefix.
+
+        A position is (tree, n): the prefix is the prefix of tree's parent
+        followed by the first n elements of tree's label, and n > 0 unless
+        tree is the root.
+        """
+        return self, 0
+
+    def _advance(self, position: Tuple[CompactPrefixTree, int],
+                 element: Any) -> Optional[Tuple[CompactPrefixTree, int]]:
+        """Return the position one <element> further than <position>, or
+        None.
+        """
+        tree, n = position
+        if tree._prefix is not None and n < len(tree._prefix[1]):
+            return (tree, n + 1) if tree._prefix[1][n] == element else None
+        tree = tree._child(element)
+        return None if tree is None else (tree, 1)
+
+    def _matches(self, position: Tuple[CompactPrefixTree, int],
+                 limit: Optional[int],
+                 search: str) -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the prefix at <position>."""
+        if search == 'depth-first':
+            return _top_k_pruned(position[0], limit)
+        return _top_k(position[0], limit)
+
+    def remove(self, prefix: List) -> None:
+        """Remove all values that match the given prefix.
+        """
+        path = self._find(prefix)
+        if not path:
+            return
+        parent = _remove_path(path)
+        if parent is not None and parent is not self:
+            parent._compress()
+
+    def _child(self, element: Any) -> Optional[CompactPrefixTree]:
+        """Return the non-leaf subtree whose label starts with <element>, or
+        None if there is none.
+        """
+        for subtree in self.subtrees:
+            if subtree.subtrees and subtree._prefix[1][0] == element:
+                return subtree
+        return None
+
+    def _find(self, prefix: List) -> List[CompactPrefixTree]:
+        """Return the trees from this one down to the tree holding every value
+        that matches <prefix>, or [] if no value does.
+        """
+        path = [self]
+        i = 0
+        while i < len(prefix):
+            subtree = path[-1]._child(prefix[i])
+            if subtree is None:
+                return []
+            label = subtree._prefix[1]
+            end = min(len(label), len(prefix) - i)
+            if label[:end] != tuple(prefix[i:i + end]):
+                return []
+            path.append(subtree)
+            i += end
+        return path
+
+    def _unlink(self, subtree: CompactPrefixTree) -> None:
+        """Remove the non-leaf <subtree> from the subtrees of this tree.
+
+        There is no dictionary of subtrees to update: see _child.
+        """
+        self.subtrees.remove(subtree)
+
+    def _compress(self) -> None:
+        """Merge the only subtree of this tree into it, if it has just one
+        and that one is not a leaf.
+
+        Precondition: this tree is not the root of the whole tree.
+        """
+        if len(self.subtrees) == 1 and self.subtrees[0].subtrees:
+            # the child's subtrees still point at the child's cell, which
+            # spells out the same prefix as the merged tree's
+            child = self.subtrees[0]
+            base, label = self._prefix
+            self._prefix = (base, label + child._prefix[1])
+            self.subtrees = child.subtrees
+
+    def is_empty(self) -> bool:
+        """Return whether this compact prefix tree is empty."""
+        return self.weight == 0.0
+
+    def is_leaf(self) -> bool:
+        """Return whether this compact prefix tree is a leaf."""
+        return self.weight > 0 and self.subtrees == []
+
+    def __str__(self) -> str:
+        """Return a string representation of this tree.
+
+        You may find this method helpful for debugging.
+        """
+        return self._str_indented()
+
+    def _str_indented(self, depth: int = 0) -> str:
+        """Return an indented string representation of this tree.
+
+        The indentation level is specified by the <depth> parameter.
+        """
+        if self.is_empty():
+            return ''
+        else:
+            s = '  ' * depth + f'{self.value} ({self.weight})\n'
+            for subtree in self.subtrees:
+                s += subtree._str_indented(depth + 1)
+            return s
+
+
+################################################################################
+# ArrayPrefixTree
+################################################################################
+class ArrayPrefixTree(Autocompleter):
+    """A simple prefix tree stored in parallel arrays instead of tree objects.
+
+    This holds the same trees as a SimplePrefixTree, numbered 0 (the root),
+    1, 2, ...; the attributes of tree i are the i-th items of a few typed
+    arrays. Each tree's subtrees form a linked list through the _first and
+    _next arrays, and prefix elements are stored as integer token ids.
+
+    Matches are found best-first, as in SimplePrefixTree, but subtrees are
+    not kept sorted, so ties may be broken differently.
+
+    === Attributes ===
+    weight_type:
+        Either 'sum' or 'average': how the aggregate weight of non-leaf trees
+        is calculated.
+    """
+    weight_type: str
+
+    # === Private Attributes ===
+    # _first, _next:
+    #     The first subtree of each tree, and the next subtree of its parent
+    #     after it, or -1 if there is none.
+    # _label:
+    #     For a non-leaf tree other than the root, the token id of the last
+    #     element of its prefix. -1 for leaves and the root.
+    # _weight, _total, _max, _leaves:
+    #     The weight, sum of leaf weights, max leaf weight and number of
+    #     leaves of each tree.
+    # _values:
+    #     The value stored in each leaf, and None for other trees.
+    # _edges:
+    #     Maps (parent << 32) | token id to the non-leaf subtree of the parent
+    #     with that label.
+    # _tokens:
+    #     Maps each prefix element to its token id.
+    # _free:
+    #     The numbers of removed trees, to be reused by new ones.
+    _first: array
+    _next: array
+    _label: array
+    _weight: array
+    _total: array
+    _max: array
+    _leaves: array
+    _values: List[Any]
+    _edges: Dict[int, int]
+    _tokens: Dict[Any, int]
+    _free: List[int]
+
+    def __init__(self, weight_type: str) -> None:
+        """Initialize an empty array prefix tree.
+
+        Precondition: weight_type == 'sum' or weight_type == 'average'.
+        """
+        self.weight_type = weight_type
+        self._first = array('i', [-1])
+        self._next = array('i', [-1])
+        self._label = array('i', [-1])
+        self._weight = array('d', [0.0])
+        self._total = array('d', [0.0])
+        self._max = array('d', [0.0])
+        self._leaves = array('q', [0])
+        self._values = [None]
+        self._edges = {}
+        self._tokens = {}
+        self._free = []
+
+    @classmethod
+    def from_items(cls, weight_type: str,
+                   items: Iterable[Tuple[Any, float, List]],
+                   workers: int = 1) -> ArrayPrefixTree:
+        """Return a new ArrayPrefixTree holding every (value, weight, prefix)
+        triple in <items>.
+
+        The triples are inserted one at a time; <workers> is accepted so that
+        this has the same interface as the other prefix trees.
+
+        Precondition: the triples satisfy the preconditions of insert.
+        """
+        tree = cls(weight_type)
+        with _paused_gc():
+            for value, weight, prefix in items:
+                tree.insert(value, weight, prefix)
+        return tree
+
+    def __len__(self) -> int:
+        """ Return the number of values stored in this ArrayPrefixTree.
+        """
+        return self._leaves[0]
+
+    def insert(self, value: Any, weight: float, prefix: List) -> None:
+        """ Insert the given value into this ArrayPrefixTree.
+        """
+        path = [0]
+        node = 0
+        for element in prefix:
+            token = self._tokens.setdefault(element, len(self._tokens))
+            key = node << 32 | token
+            child = self._edges.get(key)
+            if child is None:
+                child = self._new_tree(node, token, None)
+                self._edges[key] = child
+            node = child
+            path.append(node)
+        label, values = self._label, self._values
+        leaf = self._first[node]
+        while leaf >= 0 and (label[leaf] >= 0 or values[leaf] != value):
+            leaf = self._next[leaf]
+        new_leaf = leaf < 0
+        if new_leaf:
+            leaf = self._new_tree(node, -1, value)
+            self._total[leaf] = weight
+        else:
+            self._total[leaf] += weight
+        leaf_weight = self._total[leaf]
+        self._weight[leaf] = self._max[leaf] = leaf_weight
+        self._leaves[leaf] = 1
+        for tree in path:
+            if new_leaf:
+                self._leaves[tree] += 1
+            self._total[tree] += weight
+            if self.weight_type == 'sum':
+                self._weight[tree] = self._total[tree]
+            else:
+                self._weight[tree] = self._total[tree] / self._leaves[tree]
+            if leaf_weight > self._max[tree]:
+                self._max[tree] = leaf_weight
+
+    def autocomplete(self, prefix: List, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix.
+
+        Matches are always found best-first; <search> is accepted so that
+        this has the same interface as the other Autocompleters.
+        """
+        path = self._find(prefix)
+        if not path:
+            return []
+        return self._matches(path[-1], limit, search)
+
+    def _start(self) -> int:
+        """Return the position of the empty prefix: the root."""
+        return 0
+
+    def _advance(self, position: int, element: Any) -> Optional[int]:
+        """Return the subtree of the tree <position> for <element>, or None.
+        """
+        token = self._tokens.get(element)
+        if token is None:
+            return None
+        return self._edges.get(position << 32 | token)
+
+    def _matches(self, position: int, limit: Optional[int],
+                 search: str) -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches in the tree <position>, best-first.
+        """
+        if not self._leaves[position]:
+            return []
+        first, following, weights, maxima, values = \
+            self._first, self._next, self._weight, self._max, self._values
+        result = []
+        # heap items are (-max leaf weight, tie breaker, tree), as in _top_k
+        heap = [(-maxima[position], 0, position)]
+        count = 0
+        while heap and (limit is None or len(result) < limit):
+            tree = heapq.heappop(heap)[2]
+            # an only subtree has the same max leaf weight, and would be
+            # popped next: go straight down to it.
+            while first[tree] >= 0 and following[first[tree]] < 0:
+                tree = first[tree]
+            if first[tree] < 0:
+                result.append((values[tree], weights[tree]))
+            else:
+                child = first[tree]
+                while child >= 0:
+                    count -= 1
+                    heapq.heappush(heap, (-maxima[child], count, child))
+                    child = following[child]
+        return result
+
+    def remove(self, prefix: List) -> None:
+        """Remove all values that match the given prefix.
+        """
+        path = self._find(prefix)
+        if not path:
+            return
+        target = path.pop()
+        removed_leaves = self._leaves[target]
+        removed_total = self._total[target]
+        removed_max = self._max[target]
+        while path:
+            parent = path[-1]
+            self._unlink(parent, target)
+            if self._leaves[parent] > removed_leaves:
+                break
+            target = path.pop()
+        if not path:
+            # <target> is the root, so every tree is gone.
+            self.__init__(self.weight_type)
+            return
+        # bottom-up, so that each tree's maximum comes from up-to-date
+        # subtrees
+        for tree in reversed(path):
+            self._leaves[tree] -= removed_leaves
+            self._total[tree] -= removed_total
+            if self.weight_type == 'sum':
+                self._weight[tree] = self._total[tree]
+            else:
+                self._weight[tree] = self._total[tree] / self._leaves[tree]
+            if self._max[tree] <= removed_max:
+                self._max[tree] = max(self._max[child]
+                                      for child in self._subtrees(tree))
+
+    def _find(self, prefix: List) -> List[int]:
+        """Return the trees from the root down to the tree for <prefix>, or
+        [] if there is no such tree.
+        """
+        path = [0]
+        node = 0
+        for element in prefix:
+            token = self._tokens.get(element)
+            if token is None:
+                return []
+            node = self._edges.get(node << 32 | token)
+            if node is None:
+                return []
+            path.append(node)
+        return path
+
+    def _subtrees(self, tree: int) -> Iterator[int]:
+        """Yield the subtrees of <tree>."""
+        child = self._first[tree]
+        while child >= 0:
+            yield child
+            child = self._next[child]
+
+    def _new_tree(self, parent: int, label: int, value: Any) -> int:
+        """Return a new empty tree added as the first subtree of <parent>."""
+        if self._free:
+            tree = self._free.pop()
+            self._first[tree] = -1
+            self._label[tree] = label
+            self._weight[tree] = self._total[tree] = self._max[tree] = 0.0
+            self._leaves[tree] = 0
+            self._values[tree] = value
+        else:
+            tree = len(self._first)
+            self._first.append(-1)
+            self._next.append(-1)
+            self._label.append(label)
+            self._weight.append(0.0)
+            self._total.append(0.0)
+            self._max.append(0.0)
+            self._leaves.append(0)
+            self._values.append(value)
+        self._next[tree] = self._first[parent]
+        self._first[parent] = tree
+        return tree
+
+    def _unlink(self, parent: int, tree: int) -> None:
+        """Remove <tree> and all of its subtrees from the subtrees of
+        <parent>, and free their numbers.
+        """
+        if self._first[parent] == tree:
+            self._first[parent] = self._next[tree]
+        else:
+            before = self._first[parent]
+            while self._next[before] != tree:
+                before = self._next[before]
+            self._next[before] = self._next[tree]
+        stack = [(parent, tree)]
+        while stack:
+            parent, tree = stack.pop()
+            if self._label[tree] >= 0:
+                del self._edges[parent << 32 | self._label[tree]]
+            self._values[tree] = None
+            self._free.append(tree)
+            stack.extend((tree, child) for child in self._subtrees(tree))
+
+
+################################################################################
+# FrozenPrefixTree
+################################################################################
+class FrozenPrefixTree(Autocompleter):
+    """A read-only prefix tree that answers queries from a memory-mapped file.
+
+    The file is written from an existing prefix tree by FrozenPrefixTree.write.
+    It stores the tree as flat columns (see the layout described above
+    _FROZEN_HEADER), so queries read node data straight out of the mapped
+    file and never build tree objects. Every process that opens the same file
+    shares one copy of it in the operating system's page cache.
+
+    === Attributes ===
+    weight_type:
+        The weight type of the tree this file was written from.
+    """
+    weight_type: str
+
+    # === Private Attributes ===
+    # _file:
+    #     The open snapshot file.
+    # _map:
+    #     The memory map of _file.
+    # _views:
+    #     Typed memoryviews of the columns of _map, in _FROZEN_COLUMNS order.
+    # _tokens:
+    #     Maps each prefix element in the tree to its token id.
+    # _leaves:
+    #     The number of values stored in the tree.
+    _file: BinaryIO
+    _map: mmap.mmap
+    _views: List[memoryview]
+    _tokens: Dict[Any, int]
+    _leaves: int
+
+    def __init__(self, path: str) -> None:
+        """Open the frozen prefix tree written to the file at <path>.
+
+        Raise a ValueError if the file was not written by
+        FrozenPrefixTree.write on a machine with the same byte order, or is
+        truncated. The file is closed again before any error is raised.
+        """
+        self._file = open(path, 'rb')
+        self._views = []
+        try:
+            self._open(path)
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self, path: str) -> None:
+        """Map the open file at <path> and check its header and columns.
+        """
+        self._file.seek(0, 2)
+        size = self._file.tell()
+        if size < _FROZEN_HEADER.size + \
+                _FROZEN_SECTION.size * len(_FROZEN_COLUMNS):
+            raise ValueError(f'{path} is not a frozen prefix tree')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, weight_type, byteorder, self._leaves = \
+            _FROZEN_HEADER.unpack_from(self._map)
+        if magic != _FROZEN_MAGIC or version != _FROZEN_VERSION:
+            raise ValueError(f'{path} is not a frozen prefix tree')
+        if byteorder != (sys.byteorder == 'little'):
+            raise ValueError(f'{path} was written with a different byte '
+                             f'order')
+        if weight_type >= len(_WEIGHT_TYPES):
+            raise ValueError(f'{path} has unknown weight type {weight_type}')
+        self.weight_type = _WEIGHT_TYPES[weight_type]
+        whole = memoryview(self._map)
+        try:
+            position = _FROZEN_HEADER.size
+            for typecode in _FROZEN_COLUMNS:
+                start, end = _FROZEN_SECTION.unpack_from(self._map, position)
+                position += _FROZEN_SECTION.size
+                if not start <= end <= size \
+                        or (end - start) % array(typecode).itemsize:
+                    raise ValueError(f'{path} is truncated')
+                self._views.append(whole[start:end].cast(typecode))
+        finally:
+            whole.release()
+        self._tokens = {token: i for i, token in
+                        enumerate(pickle.loads(self._views[-1]))}
+
+    @staticmethod
+    def write(tree: Autocompleter, path: str) -> None:
+        """Write <tree>, a SimplePrefixTree or CompressedPrefixTree, to a new
+        frozen prefix tree file at <path>.
+        """
+        _write_frozen(tree, path)
+
+    def close(self) -> None:
+        """Release the memory map and close the file."""
+        for view in getattr(self, '_views', []):
+            view.release()
+        self._views = []
+        if hasattr(self, '_map'):
+            self._map.close()
+        self._file.close()
+
+    def __len__(self) -> int:
+        """Return the number of values stored in this FrozenPrefixTree."""
+        return self._leaves
+
+    def insert(self, value: Any, weight: float, prefix: List) -> None:
+        """Raise TypeError: a FrozenPrefixTree is read-only.
+
+        Insert into the tree it was written from and write it again instead.
+        """
+        raise TypeError('a FrozenPrefixTree is read-only')
+
+    def remove(self, prefix: List) -> None:
+        """Raise TypeError: a FrozenPrefixTree is read-only.
+
+        Remove from the tree it was written from and write it again instead.
+        """
+        raise TypeError('a FrozenPrefixTree is read-only')
+
+    def autocomplete(self, prefix: List, limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix.
+
+        Matches are always found best-first; <search> is accepted so that
+        this has the same interface as the other Autocompleters.
+        """
+        if not self._leaves:
+            return []
+        root = self._find(prefix)
+        if root < 0:
+            return []
+        starts, lengths, labels, firsts, counts, values, weights, maxima, \
+            offsets, blob = self._views[:-1]
+        result = []
+        # heap items are (-max leaf weight, tie breaker, node), as in _top_k
+        heap = [(-maxima[root], 0, root)]
+        count = 0
+        while heap and (limit is None or len(result) < limit):
+            node = heapq.heappop(heap)[2]
+            if values[node] >= 0:
+                i = values[node]
+                result.append((pickle.loads(blob[offsets[i]:offsets[i + 1]]),
+                               weights[node]))
+            else:
+                first = firsts[node]
+                for child in range(first + counts[node] - 1, first - 1, -1):
+                    count -= 1
+                    heapq.heappush(heap, (-maxima[child], count, child))
+        return result
+
+    def _find(self, prefix: List) -> int:
+        """Return the node holding every value that matches <prefix>, or -1
+        if no value does.
+        """
+        ids = []
+        for element in prefix:
+            if element not in self._tokens:
+                return -1
+            ids.append(self._tokens[element])
+        starts, lengths, labels, firsts, counts, values = self._views[:6]
+        node = 0
+        i = 0
+        while i < len(ids):
+            first = firsts[node]
+            for child in range(first, first + counts[node]):
+                if values[child] < 0 and labels[starts[child]] == ids[i]:
+                    break
+            else:
+                return -1
+            start = starts[child]
+            end = min(lengths[child], len(ids) - i)
+            for j in range(1, end):
+                if labels[start + j] != ids[i + j]:
+                    return -1
+            node = child
+            i += end
+        return node
+
+
+################################################################################
+# ConcurrentAutocompleter
+################################################################################
+class ConcurrentAutocompleter(Autocompleter):
+    """A simple or compressed prefix tree that many threads can read while
+    other threads change it.
+
+    The tree is never changed in place. A change copies the trees it would
+    touch (the path from the root to its prefix), changes the copies, and
+    then publishes the new root with a single assignment. The trees off that
+    path are shared with the previous root. Readers take whichever root is
+    published when they start, which stays unchanged however long they use
+    it, so they never lock. Writers take turns through a lock.
+
+    === Private Attributes ===
+    _root:
+        The published tree. Nothing reachable from it is changed again.
+    _lock:
+        Held while a change is made and published.
+    """
+    __slots__ = ('_root', '_lock')
+    _root: Autocompleter
+    _lock: threading.Lock
+
+    def __init__(self, tree: Autocompleter) -> None:
+        """Initialize this autocompleter to publish <tree>.
+
+        Precondition: <tree> is a SimplePrefixTree or CompressedPrefixTree,
+                      and is not changed afterwards except through this
+                      autocompleter.
+        """
+        self._root = tree
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> Autocompleter:
+        """Return the published tree, which will never change."""
+        return self._root
+
+    def __len__(self) -> int:
+        """Return the number of values stored in this Autocompleter."""
+        return len(self._root)
+
+    def insert(self, value: Any, weight: float, prefix: List) -> None:
+        """Insert the given value into this Autocompleter, as
+        Autocompleter.insert does, and publish the result.
+        """
+        with self._lock:
+            root = _copy_tree(self._root)
+            _copy_path(root, prefix, {id(root)}, [value])
+            root.insert(value, weight, prefix)
+            self._root = root
+
+    def autocomplete(self, prefix: List,
+                     limit: Optional[int] = None,
+                     search: str = 'best-first') -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix in the published
+        tree.
+        """
+        return self._root.autocomplete(prefix, limit, search)
+
+    def autocomplete_many(self, prefixes: List[List],
+                          limit: Optional[int] = None,
+                          search: str = 'best-first') \
+            -> List[List[Tuple[Any, float]]]:
+        """Return the matches for each prefix in <prefixes>, all from the
+        same published tree.
+        """
+        return self._root.autocomplete_many(prefixes, limit, search)
+
+    def autocomplete_any(self, prefixes: List[List],
+                         limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for any of the given prefixes in the
+        published tree.
+        """
+        return self._root.autocomplete_any(prefixes, limit)
+
+    def autocomplete_fuzzy(self, prefix: List, k: int = 1,
+                           limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches for the given prefix, allowing up to
+        <k> edits, in the published tree.
+        """
+        return self._root.autocomplete_fuzzy(prefix, k, limit)
+
+    def autocomplete_matching(self, start: Any,
+                              step: Callable[[Any, Any], Optional[Any]],
+                              accepts: Callable[[Any], bool],
+                              limit: Optional[int] = None) \
+            -> List[Tuple[Any, float]]:
+        """Return up to <limit> matches of an automaton in the published
+        tree.
+        """
+        return self._root.autocomplete_matching(start, step, accepts, limit)
+
+    def remove(self, prefix: List) -> None:
+        """Remove all values that match the given prefix, and publish the
+        result.
+        """
+        self.remove_many([prefix])
+
+    def remove_many(self, prefixes: List[List]) -> None:
+        """Remove all values that match any prefix in <prefixes>, and
+        publish the result once.
+        """
+        with self._lock:
+            root = _copy_tree(self._root)
+            copied = {id(root)}
+            for prefix in prefixes:
+                _copy_path(root, prefix, copied)
+            root.remove_many(prefixes)
+            self._root = root
+
+    def cursor(self) -> PrefixCursor:
+        """Return a cursor at the empty prefix of the published tree.
+
+        The cursor stays on that tree, and does not see later changes.
+        """
+        return self._root.cursor()
+
+
+################################################################################
+# Helpers shared by both prefix trees
+################################################################################
+def _add_leaf(tree: Any, value: Any, weight: float) -> Tuple[Any, bool]:
+    """Add <weight> to the leaf storing <value> directly under <tree>.
+
+    The leaf is created if <value> is not there yet. Return the leaf, and
+    whether it was created.
+    """
+    for subtree in tree.subtrees:
+        if not subtree.subtrees and subtree.value == [value]:
+            subtree.weight += weight
+            subtree.max_leaf_weight = subtree.weight
+            subtree._total = subtree.weight
+            return subtree, False
+    leaf = _new_leaf(tree, value, weight)
+    tree.subtrees.append(leaf)
+    return leaf, True
+
+
+def _new_leaf(tree: Any, value: Any, weight: float) -> Any:
+    """Return a new leaf of the same type as <tree> storing <value>."""
+    leaf = type(tree)(tree.weight_type)
+    leaf.value = [value]
+    leaf.weight = weight
+    leaf.max_leaf_weight = weight
+    leaf._total = weight
+    leaf.leaf = 1
+    return leaf
+
+
+def _update_path(path: List, leaf: Any, weight: float,
+                 new_leaf: bool) -> None:
+    """Update the trees in <path> after <leaf> under path[-1] gained <weight>.
+
+    <path> lists the trees from the root down to the leaf's parent. If
+    <new_leaf> is True, the leaf was just created.
+    """
+    child = leaf
+    for tree in reversed(path):
+        if new_leaf:
+            tree.leaf += 1
+        tree._total += weight
+        if tree.weight_type == 'sum':
+            tree.weight = tree._total
+        else:
+            tree.weight = tree._total / tree.leaf
+        if leaf.weight > tree.max_leaf_weight:
+            tree.max_leaf_weight = leaf.weight
+        _reposition(tree.subtrees, child)
+        child = tree
+
+
+def _remove_path(path: List) -> Any:
+    """Remove path[-1] and all of its values from the tree rooted at path[0].
+
+    <path> lists the trees from the root down to the tree being removed. Any
+    tree left without values is removed as well. Return the tree that lost a
+    subtree, or None if the whole tree was emptied.
+    """
+    target = path.pop()
+    removed_leaf = target.leaf
+    removed_total = target._total
+    removed_max = target.max_leaf_weight
+    while path:
+        parent = path[-1]
+        parent._unlink(target)
+        if parent.leaf > removed_leaf:
+            break
+        target = path.pop()
+    if not path:
+        # <target> is the root, which is emptied in place.
+        target.__init__(target.weight_type)
+        return None
+    child = None
+    for tree in reversed(path):
+        tree.leaf -= removed_leaf
+        tree._total -= removed_total
+        if tree.weight_type == 'sum':
+            tree.weight = tree._total
+        else:
+            tree.weight = tree._total / tree.leaf
+        if tree.max_leaf_weight <= removed_max:
+            tree.max_leaf_weight = max(s.max_leaf_weight
+                                       for s in tree.subtrees)
+        if child is not None:
+            _reposition(tree.subtrees, child)
+        child = tree
+    return path[-1]
+
+
+def _remove_paths(root: Any, paths: List[List]) -> List:
+    """Remove the last tree of each path in <paths>, and all of its values,
+    from the simple or compressed tree <root>.
+
+    Each path lists the trees from <root> down to a tree being removed. As in
+    _remove_path, the counts and totals above a removed tree are updated as
+    it goes, trees left without values are removed too, and a compressed
+    tree left with one non-leaf subtree absorbs it. Unlinking subtrees,
+    reordering them and finding new max leaf weights wait until every tree
+    is removed, and are then done once for each tree that needs them,
+    deepest first. Return the trees that lost values and are still in
+    <root>, or [] if <root> was emptied.
+    """
+    gone = set()
+    # id(tree) -> [depth, tree, parent, lost a subtree, max may be gone]
+    changed = {}
+    for path in sorted(paths, key=len):
+        if any(id(tree) in gone for tree in path):
+            # already removed, with a tree at or above it
+            continue
+        target = path[-1]
+        gone.add(id(target))
+        parent = None
+        for depth in range(len(path) - 1):
+            tree = path[depth]
+            tree.leaf -= target.leaf
+            tree._total -= target._total
+            entry = changed.get(id(tree))
+            if entry is None:
+                entry = changed[id(tree)] = [depth, tree, parent, False, False]
+            if tree.max_leaf_weight <= target.max_leaf_weight:
+                entry[4] = True
+            parent = tree
+        if parent is None or not root.leaf:
+            root.__init__(root.weight_type)
+            return []
+        changed[id(parent)][3] = True
+    updated = []
+    for _, tree, parent, unlinked, stale_max in \
+            sorted(changed.values(), key=lambda entry: -entry[0]):
+        if not tree.leaf:
+            gone.add(id(tree))
+            changed[id(parent)][3] = True
+            continue
+        if unlinked:
+            subtrees = []
+            for subtree in tree.subtrees:
+                if id(subtree) in gone:
+                    del tree._children[subtree.value[len(tree.value)]]
+                else:
+                    subtrees.append(subtree)
+            tree.subtrees = subtrees
+        if tree.weight_type == 'sum':
+            tree.weight = tree._total
+        else:
+            tree.weight = tree._total / tree.leaf
+        if stale_max:
+            tree.max_leaf_weight = max(subtree.max_leaf_weight
+                                       for subtree in tree.subtrees)
+        tree.subtrees.sort(key=lambda subtree: subtree.weight, reverse=True)
+        if tree is not root:
+            tree._compress()
+        updated.append(tree)
+    return updated
+
+
+def _absorb(tree: CompressedPrefixTree) -> None:
+    """Merge the only subtree of <tree>, which is not a leaf, into <tree>.
+    """
+    child = tree.subtrees[0]
+    tree.value = child.value
+    tree.subtrees = child.subtrees
+    tree._children = child._children
+
+
+def _copy_tree(tree: Any) -> Any:
+    """Return a copy of the simple or compressed <tree> that shares its
+    subtrees, but has its own list of them, _children and top list.
+    """
+    # a copy is made for every tree on the path of every change, so the
+    # attributes are copied one by one rather than through __init__
+    copy = object.__new__(type(tree))
+    copy.value = tree.value
+    copy.weight = tree.weight
+    copy.subtrees = list(tree.subtrees)
+    copy.weight_type = tree.weight_type
+    copy.leaf = tree.leaf
+    copy.max_leaf_weight = tree.max_leaf_weight
+    copy._children = dict(tree._children)
+    copy._total = tree._total
+    copy._top = None if tree._top is None else list(tree._top)
+    copy._top_settings = tree._top_settings
+    return copy
+
+
+def _copy_path(root: Any, prefix: List, copied: Set[int],
+               leaf_value: Optional[List] = None) -> None:
+    """Replace each tree under <root> that an insert or remove of <prefix>
+    could change with a copy, as made by _copy_tree.
+
+    These are the trees that the elements of <prefix> lead to, including one
+    that <prefix> leaves part way through its value, and, if <leaf_value> is
+    given, the leaf with that value under the tree for <prefix>. <copied>
+    holds the ids of the trees that are already copies, which are not copied
+    again, and the new copies are added to it.
+
+    Precondition: id(root) is in <copied>.
+    """
+    tree = root
+    i = len(tree.value)
+    while i < len(prefix):
+        subtree = tree._children.get(prefix[i])
+        if subtree is None:
+            return
+        if id(subtree) not in copied:
+            copy = _copy_tree(subtree)
+            copied.add(id(copy))
+            tree._children[prefix[i]] = copy
+            tree.subtrees[tree.subtrees.index(subtree)] = copy
+            subtree = copy
+        end = min(len(subtree.value), len(prefix))
+        if subtree.value[i:end] != prefix[i:end]:
+            return
+        tree = subtree
+        i = len(tree.value)
+    if leaf_value is not None and len(tree.value) == len(prefix):
+        for j, subtree in enumerate(tree.subtrees):
+            if not subtree.subtrees and subtree.value == leaf_value:
+                tree.subtrees[j] = _copy_tree(subtree)
+
+
+def _reposition(subtrees: List, child: Any) -> None:
+    """Move <child> within <subtrees> to keep it in non-increasing weight order.
+
+    Precondition: <child> is in <subtrees>, and <subtrees> was sorted before
+    the weight of <child> changed.
+    """
+    i = subtrees.index(child)
+    j = i
+    while j > 0 and subtrees[j - 1].weight < child.weight:
+        j -= 1
+    if j == i:
+        while j + 1 < len(subtrees) and subtrees[j + 1].weight > child.weight:
+            j += 1
+    if j != i:
+        del subtrees[i]
+        subtrees.insert(j, child)
+
+
+def _split(tree: Any, subtree: Any, length: int) -> Any:
+    """Split <subtree>, a child of <tree>, after its first <length> elements.
+
+    A new tree with value subtree.value[:length] takes the place of <subtree>
+    under <tree>, and <subtree> becomes its only child. Return the new tree.
+    """
+    middle = type(tree)(tree.weight_type)
+    middle.value = subtree.value[:length]
+    middle.weight = subtree.weight
+    middle.leaf = subtree.leaf
+    middle.max_leaf_weight = subtree.max_leaf_weight
+    middle._total = subtree._total
+    middle.subtrees.append(subtree)
+    middle._children[subtree.value[length]] = subtree
+    tree.subtrees[tree.subtrees.index(subtree)] = middle
+    tree._children[middle.value[len(tree.value)]] = middle
+    return middle
+
+
+def _split_label(tree: CompactPrefixTree, subtree: CompactPrefixTree,
+                 length: int) -> CompactPrefixTree:
+    """Split <subtree>, a child of <tree>, after the first <length> elements
+    of its label, like _split. Return the new tree.
+
+    The subtrees of <subtree> keep pointing at its old cell, which spells out
+    the same prefix as its new one.
+    """
+    base, label = subtree._prefix
+    middle = CompactPrefixTree(tree.weight_type)
+    middle._prefix = (base, label[:length])
+    middle.weight = subtree.weight
+    middle.leaf = subtree.leaf
+    middle.max_leaf_weight = subtree.max_leaf_weight
+    middle._total = subtree._total
+    subtree._prefix = (middle._prefix, label[length:])
+    middle.subtrees.append(subtree)
+    tree.subtrees[tree.subtrees.index(subtree)] = middle
+    return middle
+
+
+def _compact(tree: CompressedPrefixTree) -> CompactPrefixTree:
+    """Return a CompactPrefixTree with the same trees as <tree>."""
+    with _paused_gc():
+        root = CompactPrefixTree(tree.weight_type)
+        stack = [(tree, root)]
+        while stack:
+            old, new = stack.pop()
+            new.weight = old.weight
+            new.leaf = old.leaf
+            new.max_leaf_weight = old.max_leaf_weight
+            new._total = old._total
+            if not old.subtrees:
+                if old.leaf:
+                    new._prefix = old.value[0]
+                continue
+            start = len(old.value)
+            for subtree in old.subtrees:
+                child = CompactPrefixTree(tree.weight_type)
+                if subtree.subtrees:
+                    child._prefix = (new._prefix,
+                                     tuple(subtree.value[start:]))
+                new.subtrees.append(child)
+                stack.append((subtree, child))
+    return root
+
+
+def _aggregate(items: Iterable[Tuple[Any, float, List]]) \
+        -> List[Tuple[Any, float, List]]:
+    """Return <items> with the weights of equal values added together,
+    sorted by prefix.
+    """
+    totals = {}
+    for value, weight, prefix in items:
+        if value in totals:
+            totals[value][0] += weight
+        else:
+            totals[value] = [weight, prefix]
+    aggregated = [(value, weight, prefix)
+                  for value, (weight, prefix) in totals.items()]
+    aggregated.sort(key=lambda item: item[2])
+    return aggregated
+
+
+@contextmanager
+def _paused_gc() -> Iterator[None]:
+    """Pause the cyclic garbage collector for the body of a with statement.
+
+    This is used while building whole trees: nothing built becomes garbage,
+    but the collector would otherwise rescan the growing tree every few
+    thousand new trees.
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _from_items(root: Any, items: Iterable[Tuple[Any, float, List]],
+                compressed: bool, workers: int) -> Any:
+    """Fill the empty tree <root> with <items> and return it.
+
+    See SimplePrefixTree.from_items; <compressed> tells whether <root> is a
+    CompressedPrefixTree.
+    """
+    if workers <= 1:
+        with _paused_gc():
+            return _build(root, _aggregate(items), compressed)
+    # items with an empty prefix are leaves of <root>, and every other item
+    # belongs to the shard for the first element of its prefix.
+    shards = {}
+    top = []
+    for item in items:
+        if item[2]:
+            shards.setdefault(item[2][0], []).append(item)
+        else:
+            top.append(item)
+    # hand out the biggest shards first, so no process is left with a big
+    # shard at the end.
+    jobs = [(type(root), root.weight_type, shard)
+            for shard in sorted(shards.values(), key=len, reverse=True)]
+    with ProcessPoolExecutor(workers) as pool:
+        with _paused_gc():
+            for value, weight, _ in _aggregate(top):
+                root.subtrees.append(_new_leaf(root, value, weight))
+            for records in pool.map(_build_shard, jobs):
+                _attach(root, _unflatten(root, records, []))
+            if root.subtrees:
+                _finish(root)
+    return root
+
+
+def _build_shard(job: Tuple[type, str, List[Tuple[Any, float, List]]]) \
+        -> List[Tuple]:
+    """Build the tree for one shard of items in a worker process.
+
+    <job> is (tree class, weight type, items), where every item's prefix
+    starts with the same element. Return the _flatten records of the one
+    subtree of the root that holds them. Trees are sent back flattened
+    because pickle recurses once per level, and simple prefix trees can be
+    deeper than the recursion limit.
+    """
+    tree_class, weight_type, items = job
+    tree = tree_class.from_items(weight_type, items)
+    with _paused_gc():
+        return _flatten(tree.subtrees[0], 0)
+
+
+def _flatten(tree: Any, start: int) -> List[Tuple]:
+    """Return a list of records describing <tree>, in preorder.
+
+    Each record is (number of subtrees, item, weight, total, max leaf
+    weight, leaf count). The item of a leaf is its stored value; the item of
+    any other tree is the part of its value after its parent's, where the
+    parent's value has length <start> for <tree> itself.
+    """
+    records = []
+    stack = [(tree, start)]
+    while stack:
+        tree, start = stack.pop()
+        if tree.subtrees:
+            records.append((len(tree.subtrees), tree.value[start:],
+                            tree.weight, tree._total, tree.max_leaf_weight,
+                            tree.leaf))
+            end = len(tree.value)
+            stack.extend((subtree, end) for subtree in reversed(tree.subtrees))
+        elif tree.leaf:
+            records.append((0, tree.value[0], tree.weight, tree._total,
+                            tree.max_leaf_weight, tree.leaf))
+    return records
+
+
+def _unflatten(tree: Any, records: Iterable[Tuple], base: List) -> Any:
+    """Return the tree described by <records>, as made by _flatten.
+
+    The new trees have the same type and weight type as <tree>, and the value
+    of the first (root) tree is <base> followed by its item.
+    """
+    tree_type = type(tree)
+    weight_type = tree.weight_type
+    root = None
+    # stack holds [tree, number of its subtrees still to come]
+    stack = []
+    for count, item, weight, total, max_leaf_weight, leaf in records:
+        new = tree_type(weight_type)
+        new.weight = weight
+        new._total = total
+        new.max_leaf_weight = max_leaf_weight
+        new.leaf = leaf
+        if not stack:
+            new.value = base + item
+            root = new
+        else:
+            parent = stack[-1]
+            if count:
+                new.value = parent[0].value + item
+                parent[0]._children[item[0]] = new
+            else:
+                new.value = [item]
+            parent[0].subtrees.append(new)
+            parent[1] -= 1
+        if count:
+            stack.append([new, count])
+        else:
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+    if root is None:
+        return type(tree)(tree.weight_type)
+    return root
+
+
+################################################################################
+# Snapshots
+################################################################################
+# A snapshot file is a little-endian header followed by sections, each
+# preceded by its length in bytes as an unsigned 64-bit integer:
+#
+#   header:   b'PFXT', format version (uint16), tree class (uint8, index into
+#             _SNAPSHOT_CLASSES), weight type (uint8, index into
+#             _WEIGHT_TYPES), number of trees (uint64)
+#   tokens:   pickled list of the distinct prefix elements
+#   values:   pickled list of the values stored at the leaves, in preorder
+#   counts:   uint32 per tree: its number of subtrees (0 for a leaf)
+#   lengths:  uint32 per tree: the length of its item (see _flatten)
+#   labels:   uint32 token indices: every non-leaf item, concatenated
+#   weights, totals, maxima: float64 per tree
+#   leaves:   uint64 per tree: its leaf count
+#
+# Trees are stored in preorder, as _flatten lists them.
+_SNAPSHOT_MAGIC = b'PFXT'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sHBBQ')
+_SNAPSHOT_LENGTH = struct.Struct('<Q')
+_SNAPSHOT_CLASSES = ['SimplePrefixTree', 'CompressedPrefixTree']
+_WEIGHT_TYPES = ['sum', 'average']
+
+
+def _save(tree: Any, path: str) -> None:
+    """Save <tree> to the snapshot file at <path>."""
+    tokens = {}
+    values = []
+    counts = array('I')
+    lengths = array('I')
+    labels = array('I')
+    columns = [array('d'), array('d'), array('d'), array('Q')]
+    with _paused_gc():
+        records = _flatten(tree, 0)
+    for count, item, weight, total, max_leaf_weight, leaf in records:
+        counts.append(count)
+        if count:
+            lengths.append(len(item))
+            for element in item:
+                labels.append(tokens.setdefault(element, len(tokens)))
+        else:
+            lengths.append(0)
+            values.append(item)
+        for column, number in zip(columns, [weight, total, max_leaf_weight,
+                                            leaf]):
+            column.append(number)
+    sections = [pickle.dumps(list(tokens), pickle.HIGHEST_PROTOCOL),
+                pickle.dumps(values, pickle.HIGHEST_PROTOCOL)]
+    for column in [counts, lengths, labels] + columns:
+        if sys.byteorder == 'big':
+            column.byteswap()
+        sections.append(column.tobytes())
+    with open(path, 'wb') as f:
+        f.write(_SNAPSHOT_HEADER.pack(
+            _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION,
+            _SNAPSHOT_CLASSES.index(type(tree).__name__),
+            _WEIGHT_TYPES.index(tree.weight_type), len(records)))
+        for section in sections:
+            f.write(_SNAPSHOT_LENGTH.pack(len(section)))
+            f.write(section)
+
+
+def _load(tree_type: type, path: str) -> Any:
+    """Return the tree of <tree_type> saved in the snapshot file at <path>.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_SNAPSHOT_HEADER.size)
+        if len(header) < _SNAPSHOT_HEADER.size:
+            raise ValueError(f'{path} is not a prefix tree snapshot')
+        magic, version, kind, weight_type, size = \
+            _SNAPSHOT_HEADER.unpack(header)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a prefix tree snapshot')
+        if version != _SNAPSHOT_VERSION:
+            raise ValueError(f'{path} has unsupported snapshot version '
+                             f'{version}')
+        if kind >= len(_SNAPSHOT_CLASSES):
+            raise ValueError(f'{path} holds an unknown tree kind {kind}')
+        if weight_type >= len(_WEIGHT_TYPES):
+            raise ValueError(f'{path} has unknown weight type {weight_type}')
+        if _SNAPSHOT_CLASSES[kind] != tree_type.__name__:
+            raise ValueError(f'{path} holds a {_SNAPSHOT_CLASSES[kind]}, '
+                             f'not a {tree_type.__name__}')
+        sections = []
+        for _ in range(9):
+            length = _SNAPSHOT_LENGTH.unpack(f.read(_SNAPSHOT_LENGTH.size))[0]
+            sections.append(f.read(length))
+    tokens = pickle.loads(sections[0])
+    values = pickle.loads(sections[1])
+    columns = []
+    for typecode, section in zip('IIIdddQ', sections[2:]):
+        column = array(typecode)
+        column.frombytes(section)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+    counts, lengths, labels, weights, totals, maxima, leaves = \
+        [column.tolist() for column in columns]
+    if len(counts) != size:
+        raise ValueError(f'{path} is truncated')
+    with _paused_gc():
+        elements = [tokens[i] for i in labels]
+        values = iter(values)
+        items = []
+        start = 0
+        for count, length in zip(counts, lengths):
+            if count:
+                items.append(elements[start:start + length])
+                start += length
+            else:
+                items.append(next(values))
+        return _unflatten(tree_type(_WEIGHT_TYPES[weight_type]),
+                          zip(counts, items, weights, totals, maxima, leaves),
+                          [])
+
+
+################################################################################
+# Frozen prefix tree files
+################################################################################
+# A frozen prefix tree file is a header, a table of (start, end) byte offsets
+# of each column, and then the columns themselves, each starting on an 8-byte
+# boundary. Numbers are in the byte order of the machine that wrote the file.
+#
+#   header:   b'PFXF', format version (uint16), weight type (uint8, index
+#             into _WEIGHT_TYPES), 1 if little-endian else 0 (uint8), number
+#             of values (uint64)
+#
+# Nodes are numbered in breadth-first order from the root (node 0), so the
+# subtrees of a node are consecutive, in non-increasing weight order. The
+# columns, in _FROZEN_COLUMNS order, are:
+#
+#   starts, lengths (uint32 per node): where the node's label (the part of
+#                                      its value after its parent's) is in
+#                                      labels
+#   labels (uint32):                   token ids of every label, concatenated
+#   firsts, counts (uint32 per node):  the node's first subtree and number
+#                                      of subtrees
+#   values (int32 per node):           the index of the value stored in a
+#                                      leaf, or -1
+#   weights, maxima (float64 per node): the weight and max leaf weight
+#   offsets (uint64 per value, plus 1): where each pickled value is in blob
+#   blob:                              the pickled values, concatenated
+#   tokens:                            the pickled list of prefix elements,
+#                                      indexed by token id
+_FROZEN_MAGIC = b'PFXF'
+_FROZEN_VERSION = 1
+_FROZEN_HEADER = struct.Struct('=4sHBBQ')
+_FROZEN_SECTION = struct.Struct('=QQ')
+_FROZEN_COLUMNS = 'IIIIIiddQBB'
+
+
+def _write_frozen(tree: Any, path: str) -> None:
+    """Write <tree> to the frozen prefix tree file at <path>."""
+    tokens = {}
+    columns = [array(typecode) for typecode in _FROZEN_COLUMNS[:-2]]
+    starts, lengths, labels, firsts, counts, values, weights, maxima, \
+        offsets = columns
+    blob = bytearray()
+    offsets.append(0)
+    queue = deque([(tree, 0)])
+    size = 1
+    while queue:
+        node, start = queue.popleft()
+        label = node.value[start:] if node.subtrees else []
+        starts.append(len(labels))
+        lengths.append(len(label))
+        for element in label:
+            labels.append(tokens.setdefault(element, len(tokens)))
+        firsts.append(size)
+        counts.append(len(node.subtrees))
+        if node.subtrees or not node.leaf:
+            values.append(-1)
+        else:
+            values.append(len(offsets) - 1)
+            blob += pickle.dumps(node.value[0], pickle.HIGHEST_PROTOCOL)
+            offsets.append(len(blob))
+        weights.append(node.weight)
+        maxima.append(node.max_leaf_weight)
+        end = len(node.value)
+        for subtree in node.subtrees:
+            queue.append((subtree, end))
+        size += len(node.subtrees)
+    sections = [column.tobytes() for column in columns]
+    sections.append(bytes(blob))
+    sections.append(pickle.dumps(list(tokens), pickle.HIGHEST_PROTOCOL))
+    position = _FROZEN_HEADER.size + _FROZEN_SECTION.size * len(sections)
+    table = []
+    for section in sections:
+        position += -position % 8
+        table.append((position, position + len(section)))
+        position += len(section)
+    with open(path, 'wb') as f:
+        f.write(_FROZEN_HEADER.pack(_FROZEN_MAGIC, _FROZEN_VERSION,
+                                    _WEIGHT_TYPES.index(tree.weight_type),
+                                    sys.byteorder == 'little', tree.leaf))
+        for start, end in table:
+            f.write(_FROZEN_SECTION.pack(start, end))
+        for (start, _), section in zip(table, sections):
+            f.write(bytes(start - f.tell()))
+            f.write(section)
+
+
+def _build(root: Any, items: List[Tuple[Any, float, List]],
+           compressed: bool) -> Any:
+    """Fill the empty tree <root> with <items> and return it.
+
+    <items> must be sorted by prefix, with no repeated values. The trees on
+    the path to the latest item are kept on a stack; each new item closes
+    the trees below its common prefix with the item before it, and opens
+    trees for the rest of its own prefix. If <compressed> is True, only trees
+    where prefixes branch (or values end) are opened.
+    """
+    stack = [root]
+    previous = []
+    for value, weight, prefix in items:
+        common = 0
+        end = min(len(previous), len(prefix))
+        while common < end and previous[common] == prefix[common]:
+            common += 1
+        while len(stack[-1].value) > common:
+            tree = stack.pop()
+            _finish(tree)
+            if len(stack[-1].value) < common:
+                # only reached for compressed trees: <tree> and <prefix>
+                # branch apart below stack[-1].
+                middle = type(root)(root.weight_type)
+                middle.value = prefix[:common]
+                stack.append(middle)
+            _attach(stack[-1], tree)
+        if compressed:
+            if len(prefix) > common:
+                tree = type(root)(root.weight_type)
+                tree.value = list(prefix)
+                stack.append(tree)
+        else:
+            for i in range(common, len(prefix)):
+                tree = type(root)(root.weight_type)
+                tree.value = stack[-1].value + [prefix[i]]
+                stack.append(tree)
+        stack[-1].subtrees.append(_new_leaf(root, value, weight))
+        previous = prefix
+    while len(stack) > 1:
+        tree = stack.pop()
+        _finish(tree)
+        _attach(stack[-1], tree)
+    if root.subtrees:
+        _finish(root)
+    return root
+
+
+def _finish(tree: Any) -> None:
+    """Set the aggregate attributes of <tree> from its complete subtrees,
+    and sort them.
+    """
+    tree.leaf = 0
+    tree._total = 0.0
+    tree.max_leaf_weight = 0.0
+    for subtree in tree.subtrees:
+        tree.leaf += subtree.leaf
+        tree._total += subtree._total
+        if subtree.max_leaf_weight > tree.max_leaf_weight:
+            tree.max_leaf_weight = subtree.max_leaf_weight
+    if tree.weight_type == 'sum':
+        tree.weight = tree._total
+    else:
+        tree.weight = tree._total / tree.leaf
+    tree.subtrees.sort(key=lambda x: x.weight, reverse=True)
+
+
+def _attach(tree: Any, subtree: Any) -> None:
+    """Add the non-leaf <subtree> to the subtrees of <tree>."""
+    tree.subtrees.append(subtree)
+    tree._children[subtree.value[len(tree.value)]] = subtree
+
+
+def _search(tree: Any, root: Any, limit: Optional[int],
+            search: str) -> List[Tuple[Any, float]]:
+    """Return up to <limit> matches in <root>, a subtree of <tree>, found by
+    <search> as described in Autocompleter.autocomplete.
+
+    A stored top list of <root> is used instead when it is long enough.
+    """
+    if root._top is not None and limit is not None \
+            and limit <= tree._top_settings[0]:
+        return root._top[:limit]
+    if search == 'depth-first':
+        return _top_k_pruned(root, limit)
+    return _top_k(root, limit)
+
+
+def _search_many(tree: Any, roots: List[Optional[Any]], limit: Optional[int],
+                 search: str) -> List[List[Tuple[Any, float]]]:
+    """Return _search(tree, root, limit, search) for each root in <roots>, or
+    [] where the root is None. A root that appears more than once is only
+    searched once.
+    """
+    results = []
+    # id(root) -> its matches
+    searched = {}
+    for root in roots:
+        if root is None:
+            results.append([])
+        elif id(root) in searched:
+            results.append(list(searched[id(root)]))
+        else:
+            searched[id(root)] = _search(tree, root, limit, search)
+            results.append(searched[id(root)])
+    return results
+
+
+def _sorted_order(prefixes: List[List]) -> List[int]:
+    """Return the indices of <prefixes> in sorted order of the prefixes, or
+    in their given order if their elements cannot be compared.
+    """
+    order = list(range(len(prefixes)))
+    try:
+        order.sort(key=prefixes.__getitem__)
+    except TypeError:
+        pass
+    return order
+
+
+def _common_length(first: Optional[List], second: List) -> int:
+    """Return the length of the longest common prefix of <first> and
+    <second>, where None has no elements in common with anything.
+    """
+    if first is None:
+        return 0
+    common = 0
+    end = min(len(first), len(second))
+    while common < end and first[common] == second[common]:
+        common += 1
+    return common
+
+
+def _materialize(root: Any, k: int, depth: int) -> None:
+    """Store the top <k> list of every non-leaf tree in <root> reached by a
+    prefix of at most <depth> elements, or drop every list if <k> is 0.
+
+    The trees holding lists always form a connected part of the tree at the
+    root, so a search for them stops at the first tree without one.
+    """
+    stack = [root]
+    while stack:
+        tree = stack.pop()
+        if tree._top is not None:
+            tree._top = None
+            stack.extend(tree.subtrees)
+    root._top_settings = None
+    if not k:
+        return
+    root._top_settings = (k, depth)
+    stack = [root]
+    while stack:
+        tree = stack.pop()
+        tree._top = _top_k(tree, k)
+        if len(tree.value) < depth:
+            stack.extend(subtree for subtree in tree.subtrees
+                         if subtree.subtrees)
+
+
+def _update_tops(path: List, leaf: Any, settings: Tuple[int, int]) -> None:
+    """Update the top lists of the trees in <path>, from the root down to
+    the parent of <leaf>, after <leaf> was inserted or gained weight.
+
+    <settings> is the root's (k, depth). Trees in <path> that are new, and
+    are reached by a prefix of at most depth elements, get new lists.
+    """
+    k, depth = settings
+    value = leaf.value[0]
+    weight = leaf.weight
+    for i, tree in enumerate(path):
+        top = tree._top
+        if top is None:
+            if i == 0 or len(path[i - 1].value) < depth:
+                tree._top = _top_k(tree, k)
+            continue
+        for j, (other, _) in enumerate(top):
+            if other == value:
+                del top[j]
+                break
+        # weights only grow on insert, so <value> can only move up the list
+        if len(top) < k or weight > top[-1][1]:
+            j = len(top)
+            while j > 0 and top[j - 1][1] < weight:
+                j -= 1
+            top.insert(j, (value, weight))
+            del top[k:]
+
+
+def _refresh_tops(root: Any, path: List,
+                  settings: Optional[Tuple[int, int]]) -> None:
+    """Recompute the top lists of the trees in <path> after a removal from
+    <root>, which had materialize_top <settings> before it.
+
+    <path> holds the trees that lost values, as _remove_path leaves it. The
+    next heaviest values are not stored anywhere, so each list is searched
+    for again.
+    """
+    if settings is None:
+        return
+    if not path:
+        # the root was emptied, and its settings were reset with it.
+        root._top_settings = settings
+        root._top = []
+    for tree in path:
+        if tree._top is not None:
+            tree._top = _top_k(tree, settings[0])
+
+
+def _top_k(root: Any, limit: Optional[int]) -> List[Tuple[Any, float]]:
+    """Return the <limit> heaviest (value, weight) pairs in the tree <root>.
+
+    The pairs are in non-increasing weight order; if limit is None, every
+    value in <root> is returned.
+
+    This is a best-first search: trees are expanded in order of their
+    max_leaf_weight, so a leaf is only popped once no unexpanded tree can
+    hold a heavier one, and the search ends after <limit> leaves.
+    """
+    return _top_k_any([root], limit)
+
+
+def _top_k_any(roots: List[Any],
+               limit: Optional[int]) -> List[Tuple[Any, float]]:
+    """Return the <limit> heaviest (value, weight) pairs in the trees
+    <roots>, by one best-first search over all of them as in _top_k.
+
+    Precondition: no tree in <roots> is inside another one.
+    """
+    result = []
+    # heap items are (-max_leaf_weight, tie breaker, tree). Ties go to the
+    # most recently pushed tree, so equal bounds are searched depth-first
+    # (heaviest sibling first) instead of level by level.
+    heap = [(-root.max_leaf_weight, -i, root)
+            for i, root in enumerate(roots) if root.leaf]
+    heapq.heapify(heap)
+    count = -len(heap)
+    while heap and (limit is None or len(result) < limit):
+        tree = heapq.heappop(heap)[2]
+        if not tree.subtrees:
+            result.append((tree.value[0], tree.weight))
+        else:
+            for subtree in reversed(tree.subtrees):
+                count -= 1
+                heapq.heappush(heap, (-subtree.max_leaf_weight, count,
+                                      subtree))
+    return result
+
+
+def _fuzzy_search(root: Any, query: List, k: int,
+                  limit: Optional[int]) -> Tuple[List[Tuple[Any, float]], int]:
+    """Return the <limit> heaviest (value, weight) pairs in <root> that match
+    <query> with at most <k> edits, as autocomplete_fuzzy does, and the
+    number of trees visited to find them: the root, and each subtree looked
+    at when its parent is expanded.
+
+    Each tree reached carries the row of a Levenshtein table: row[j] is the
+    edit distance between the tree's prefix and query[:j], or k + 1 if it is
+    more than k. The next element's row never has a smaller minimum, so a
+    tree whose row minimum is above k holds no match, and one whose row
+    minimum is not below the best distance on its path holds nothing closer
+    than that: every value in it matches at that distance, and its rows are
+    no longer needed. Rows are the states of a Levenshtein automaton for
+    <query>, and there are few of them for small k, so each step from a row
+    to the next is worked out once and then looked up.
+
+    When an element not in <query> would leave no match below a tree, only
+    an element query[j] with row[j] <= k can, by matching it, so only the
+    subtrees starting with those are looked at, through _children.
+
+    Trees are expanded best-first as in _top_k, by max_leaf_weight and then
+    by the least distance a value in them can have, so the search ends
+    after <limit> leaves.
+    """
+    result = []
+    visits = 1
+    if not root.leaf:
+        return result, visits
+    wanted = set(query)
+    # (row, element, or _OTHER for one not in query) -> (next row, its
+    # minimum)
+    steps = {}
+    first = tuple(min(j, k + 1) for j in range(len(query) + 1))
+    # heap items are (-max_leaf_weight, least distance, tie breaker, tree,
+    # row after the tree's prefix or None if it is no longer needed, row
+    # minimum, best distance on the tree's path)
+    heap = [(-root.max_leaf_weight, 0, 0, root, first, 0, first[-1])]
+    count = 0
+    while heap and (limit is None or len(result) < limit):
+        _, _, _, tree, row, lowest, best = heapq.heappop(heap)
+        if not tree.subtrees:
+            result.append((tree.value[0], tree.weight))
+            continue
+        subtrees = tree.subtrees
+        if row is not None and best <= k and lowest >= best:
+            row = None
+        elif row is not None and best > k:
+            key = (row, _OTHER)
+            step = steps.get(key)
+            if step is None:
+                step = steps[key] = _next_row(row, query, _OTHER, k)
+            if step[1] > k:
+                children = tree._children
+                subtrees = [children[element] for element in dict.fromkeys(
+                    needed for needed, before in zip(query, row)
+                    if before <= k) if element in children]
+        visits += len(subtrees)
+        start = len(tree.value)
+        for subtree in reversed(subtrees):
+            count -= 1
+            if row is None or not subtree.subtrees:
+                if best <= k:
+                    heapq.heappush(heap, (-subtree.max_leaf_weight, best,
+                                          count, subtree, row, lowest, best))
+                continue
+            below = row
+            below_lowest = lowest
+            distance = best
+            for element in subtree.value[start:]:
+                key = (below, element if element in wanted else _OTHER)
+                step = steps.get(key)
+                if step is None:
+                    step = steps[key] = _next_row(below, query, element, k)
+                below, below_lowest = step
+                if below[-1] < distance:
+                    distance = below[-1]
+                if below_lowest > k or below_lowest >= distance:
+                    break
+            if distance <= k or below_lowest <= k:
+                heapq.heappush(heap, (-subtree.max_leaf_weight,
+                                      min(distance, below_lowest), count,
+                                      subtree, below, below_lowest, distance))
+    return result, visits
+
+
+def _matching_roots(root: Any, start: Any,
+                    step: Callable[[Any, Any], Optional[Any]],
+                    accepts: Callable[[Any], bool]) -> List[Any]:
+    """Return the trees holding every value in <root> matched by the
+    automaton <start>, <step> and <accepts>, as in autocomplete_matching.
+
+    This is a depth-first search that carries the automaton's state after
+    each tree's prefix. A tree is not walked any further once its state is
+    accepted, since every value in it matches, or once step returns None.
+    Each step from a state on an element is worked out once. The trees
+    returned hold disjoint sets of values.
+    """
+    found = []
+    # (state, element) -> the state after it
+    steps = {}
+    stack = [(root, start)]
+    while stack:
+        tree, state = stack.pop()
+        if accepts(state):
+            found.append(tree)
+            continue
+        start_length = len(tree.value)
+        for subtree in tree.subtrees:
+            if not subtree.subtrees:
+                continue
+            below = state
+            for element in subtree.value[start_length:]:
+                key = (below, element)
+                if key in steps:
+                    below = steps[key]
+                else:
+                    below = steps[key] = step(below, element)
+                if below is None or accepts(below):
+                    break
+            if below is not None:
+                stack.append((subtree, below))
+    return found
+
+
+# Stands for every element not in the query in _fuzzy_search, since they all
+# lead from a row to the same next row.
+_OTHER = object()
+
+
+def _next_row(row: Tuple[int, ...], query: List, element: Any,
+              k: int) -> Tuple[Tuple[int, ...], int]:
+    """Return the row of the Levenshtein table after <element>, given the
+    row <row> before it, and its minimum, as in _fuzzy_search.
+    """
+    cap = k + 1
+    left = min(row[0] + 1, cap)
+    below = [left]
+    lowest = left
+    for diagonal, up, wanted in zip(row, row[1:], query):
+        # the cheapest of a match or substitution, an insertion and a
+        # deletion, but no more than cap
+        if wanted != element:
+            diagonal += 1
+        left = min(diagonal, up + 1, left + 1, cap)
+        below.append(left)
+        if left < lowest:
+            lowest = left
+    return tuple(below), lowest
+
+
+def _top_k_pruned(root: Any,
+                  limit: Optional[int]) -> List[Tuple[Any, float]]:
+    """Return the same pairs as _top_k, using a depth-first branch and bound.
+
+    Trees are visited in stored order, and a tree is skipped once <limit>
+    values at least as heavy as its max_leaf_weight have been found.
+    """
+    if not root.leaf:
+        return []
+    # best is a min-heap of (weight, tie breaker, value) of size <= limit
+    best = []
+    count = 0
+    stack = [root]
+    while stack:
+        tree = stack.pop()
+        if limit is not None and len(best) == limit \
+                and tree.max_leaf_weight <= best[0][0]:
+            continue
+        if not tree.subtrees:
+            item = (tree.weight, count, tree.value[0])
+            count += 1
+            if limit is not None and len(best) == limit:
+                heapq.heapreplace(best, item)
+            else:
+                heapq.heappush(best, item)
+        else:
+            stack.extend(reversed(tree.subtrees))
+    best.sort(reverse=True)
+    return [(value, weight) for weight, _, value in best]
+
 if __name__ == '__main__':
     import python_ta
     python_ta.check_all(config={